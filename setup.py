@@ -16,6 +16,11 @@ setup(
     entry_points={
         "console_scripts": [
             "wdd_bridge = wdd_bridge.scripts.wdd_bridge:main",
+            "wdd_bridge_comb_simulator = wdd_bridge.scripts.comb_simulator:main",
+            "wdd_bridge_replay = wdd_bridge.scripts.replay:main",
+            "wdd_bridge_load_generator = wdd_bridge.scripts.load_generator:main",
+            "wdd_bridge_benchmark = wdd_bridge.scripts.benchmark:main",
+            "wdd_bridge_ui = wdd_bridge.scripts.ui:main",
         ]
     },
     install_requires=reqs,
@@ -0,0 +1,99 @@
+import math
+
+import numpy as np
+
+from wdd_bridge.dance_detector import AngleConsensus, calculate_angle_consensus
+
+
+def circmean(angles):
+    return math.atan2(np.sum(np.sin(angles)), np.sum(np.cos(angles))) % (2.0 * np.pi)
+
+def exact_search(angles, inlier_cutoff=np.pi/4.0):
+    """Tries every angle as the start of the arc. Returns (consensus angle, max inliers, arc start)."""
+    angles = np.array([a for a in angles if a is not None and not math.isnan(a)]) % (2.0 * np.pi)
+    arc_length = 2.0 * inlier_cutoff
+    best = (0, None, None)
+    for start in sorted(angles):
+        end = start + arc_length
+        if end <= 2.0 * np.pi:
+            inliers = (angles >= start) & (angles < end)
+        else:
+            inliers = (angles >= start) | (angles < end - 2.0 * np.pi)
+        if np.sum(inliers) > best[0]:
+            best = (np.sum(inliers), start, circmean(angles[inliers]))
+    n_inliers, start, consensus_angle = best
+    return consensus_angle, n_inliers, start
+
+def baseline_ransac(all_angles, inlier_cutoff=np.pi/4.0, random_state=None):
+    """The RANSAC of the original calculate_angle_consensus (with scipy.stats.circmean written out)."""
+    all_angles = (np.array(all_angles) + 2.0 * np.pi) % (2.0 * np.pi)
+    max_inliers, inlier_indices = 0, None
+    for _ in range(all_angles.shape[0] * 4):
+        samples = random_state.choice(np.arange(all_angles.shape[0]), size=2)
+        consensus_angle = circmean(all_angles[samples])
+        differences0 = np.abs(all_angles - consensus_angle)
+        differences1 = (2.0 * np.pi) - differences0
+        inliers = (differences0 < inlier_cutoff) | (differences1 < inlier_cutoff)
+        if np.sum(inliers) > max_inliers:
+            max_inliers, inlier_indices = np.sum(inliers), inliers
+    return circmean(all_angles[inlier_indices]), max_inliers
+
+def random_dance(rng, n_angles, noise, n_outliers):
+    direction = rng.uniform(-np.pi, np.pi)
+    angles = list(direction + rng.normal(0.0, noise, size=n_angles)) + list(rng.uniform(-np.pi, np.pi, size=n_outliers))
+    rng.shuffle(angles)
+    return angles
+
+
+def test_consensus_matches_exact_search():
+    rng = np.random.RandomState(0)
+    for _ in range(300):
+        angles = random_dance(rng, rng.randint(2, 30), rng.uniform(0.05, 1.5), rng.randint(0, 10))
+        if rng.uniform() < 0.2:
+            angles.insert(rng.randint(len(angles)), None)
+
+        consensus = AngleConsensus()
+        for n, angle in enumerate(angles, start=1):
+            consensus.add(angle)
+            if n < 2:
+                continue
+            expected_angle, expected_inliers, expected_start = exact_search(angles[:n])
+            consensus_angle, n_inliers = consensus.get_consensus()
+            assert n_inliers == expected_inliers
+            assert consensus.best_arc_start == expected_start
+            assert abs(consensus_angle - expected_angle) < 1e-9
+
+def test_result_does_not_depend_on_order():
+    rng = np.random.RandomState(1)
+    for _ in range(100):
+        angles = random_dance(rng, 20, 0.3, 5)
+        expected = calculate_angle_consensus(angles)
+        rng.shuffle(angles)
+        consensus_angle, n_inliers = calculate_angle_consensus(angles)
+        assert n_inliers == expected[1]
+        assert abs(consensus_angle - expected[0]) < 1e-9
+
+def test_consensus_is_at_least_as_good_as_the_baseline_ransac():
+    rng = np.random.RandomState(2)
+    for _ in range(200):
+        angles = random_dance(rng, rng.randint(2, 30), rng.uniform(0.05, 1.5), rng.randint(0, 10))
+        _, ransac_inliers = baseline_ransac(angles, random_state=rng)
+        _, n_inliers = calculate_angle_consensus(angles)
+        assert n_inliers >= ransac_inliers
+
+def test_clear_dances_match_the_baseline_ransac():
+    rng = np.random.RandomState(3)
+    for _ in range(100):
+        # A tight dance and a few outliers far away from it.
+        direction = rng.uniform(0.0, 2.0 * np.pi)
+        angles = list(direction + rng.normal(0.0, 0.05, size=15)) + list(direction + np.pi + rng.uniform(-0.5, 0.5, size=3))
+        ransac_angle, ransac_inliers = baseline_ransac(angles, random_state=rng)
+        consensus_angle, n_inliers = calculate_angle_consensus(angles)
+        assert n_inliers == ransac_inliers == 15
+        assert abs(consensus_angle - ransac_angle) < 1e-9
+
+def test_special_cases():
+    assert calculate_angle_consensus([1.0]) == (1.0, 1)
+    assert calculate_angle_consensus([None, None]) == (None, 1)
+    consensus_angle, n_inliers = calculate_angle_consensus([0.1, 2.0 * np.pi - 0.1])
+    assert n_inliers == 2 and min(consensus_angle, 2.0 * np.pi - consensus_angle) < 1e-9
@@ -0,0 +1,69 @@
+import pytest
+
+from wdd_bridge.comb_connector import (CombConnector, LinkAllActuatorsToSignal, SetLEDsMessage, TriggerMessage,
+                                       get_serial_register)
+
+
+class FakeSerial:
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+def make_connector():
+    """Returns a CombConnector without a serial port and the serial lines it writes."""
+    serial_lines = []
+
+    def log_fn(message, text=None, **kwargs):
+        if message == "serial message":
+            serial_lines.append(text)
+
+    connector = CombConnector(port="", actuator_count=8, print_fn=lambda *args: None, log_fn=log_fn)
+    # The messages are written by the tests themselves.
+    connector.close()
+    return connector, serial_lines
+
+
+@pytest.mark.parametrize("line, register", [
+    ("MUX 3 1", "MUX 3"),
+    ("TRIG 2 11", "TRIG"),
+    ("STOP_TRIG", "TRIG"),
+    ("LEDS 5", "LEDS"),
+])
+def test_serial_registers(line, register):
+    assert get_serial_register(line) == register
+
+def test_only_the_last_line_per_register_is_written():
+    connector, serial_lines = make_connector()
+    connector.con = FakeSerial()
+
+    connector._write_serial_lines(["MUX 0 1", "MUX 1 1", "MUX 0 0", "TRIG 3 11", "STOP_TRIG", "LEDS 2"])
+    # In the order the registers were first set.
+    assert serial_lines == ["MUX 0 0", "MUX 1 1", "STOP_TRIG", "LEDS 2"]
+    assert connector.con.written == [b"MUX 0 0\n\r", b"MUX 1 1\n\r", b"STOP_TRIG\n\r", b"LEDS 2\n\r"]
+
+def test_lines_the_comb_already_has_are_skipped():
+    connector, serial_lines = make_connector()
+
+    connector._write_serial_lines(["MUX 0 1", "MUX 1 1", "LEDS 2"])
+    connector._write_serial_lines(["MUX 0 1", "MUX 1 2", "LEDS 2"])
+    assert serial_lines == ["MUX 0 1", "MUX 1 1", "LEDS 2", "MUX 1 2"]
+
+    # After reconnecting, the state of the comb is unknown.
+    connector.sent_serial_state = dict()
+    connector._write_serial_lines(["LEDS 2"])
+    assert serial_lines[-1:] == ["LEDS 2"]
+
+def test_messages_are_coalesced():
+    connector, serial_lines = make_connector()
+
+    connector._send_serial_messages([SetLEDsMessage(3), LinkAllActuatorsToSignal(1), SetLEDsMessage(4),
+                                     TriggerMessage(2, None, duration=1.0)])
+    # The activation is written first.
+    assert serial_lines == ["TRIG 2 11", "LEDS 4"] + ["MUX {} 1".format(i) for i in range(8)]
+
+    del serial_lines[:]
+    connector._send_serial_messages([LinkAllActuatorsToSignal(1), SetLEDsMessage(5)])
+    assert serial_lines == ["LEDS 5"]
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from wdd_bridge.benchmarks import BENCHMARK_CAMERA_CONFIG, StaticAzimuthUpdater, print_nothing
+from wdd_bridge.comb_mapper import CombMapper
+
+
+@pytest.mark.parametrize("origin", ["top left", "bottom right"])
+@pytest.mark.parametrize("raster_cell_size", [4.0, None])
+def test_map_to_comb_matches_batch(origin, raster_cell_size):
+    mapper = CombMapper(dict(BENCHMARK_CAMERA_CONFIG, origin=origin), azimuth_updater=StaticAzimuthUpdater(),
+                        print_fn=print_nothing, raster_cell_size=raster_cell_size)
+    rng = np.random.RandomState(0)
+    # Includes positions outside of the image (and thus the raster).
+    xs, ys, angles = rng.uniform(-100.0, 2000.0, 500), rng.uniform(-100.0, 1100.0, 500), rng.uniform(-4.0, 4.0, 500)
+
+    batch_xy, (batch_waggle_angles, batch_world_angles), (batch_indices, batch_distances) = mapper.map_to_comb_batch(
+        xs, ys, angles)
+
+    for i, (x, y, angle) in enumerate(zip(xs, ys, angles)):
+        xy, (waggle_angle, world_angle), (sensor_index, distance) = mapper.map_to_comb(x, y, angle)
+        assert np.allclose(xy, batch_xy[i])
+        assert waggle_angle == pytest.approx(batch_waggle_angles[i], abs=1e-9)
+        assert world_angle == pytest.approx(batch_world_angles[i], abs=1e-9)
+        assert sensor_index == batch_indices[i]
+        assert distance == pytest.approx(batch_distances[i], abs=1e-9)
+
+def test_map_to_comb_without_actuators():
+    mapper = CombMapper(dict(BENCHMARK_CAMERA_CONFIG, actuators=[]), azimuth_updater=StaticAzimuthUpdater(),
+                        print_fn=print_nothing)
+    _, _, (sensor_index, distance) = mapper.map_to_comb(500.0, 500.0, 1.0)
+    assert sensor_index is None and distance == np.inf
@@ -0,0 +1,104 @@
+import datetime
+import math
+import random
+
+import pytest
+
+from wdd_bridge.dance_detector import DanceDetector, SpatialGrid, Waggle
+
+
+class LinearScanDetector:
+    """The clustering of the original DanceDetector.process: a scan over all open dances in the order they were opened.
+
+    Dances are lists of waggles.
+    """
+
+    def __init__(self, waggle_max_distance=200.0, waggle_max_gap=7.0):
+        self.waggle_max_distance = waggle_max_distance
+        self.waggle_max_gap = waggle_max_gap
+        self.open_dances = []
+
+    def process(self, waggle):
+        """Returns the dance the waggle was added to."""
+        indices_to_delete = []
+        matched_dance = None
+
+        for idx, dance in enumerate(self.open_dances):
+            offset = (waggle.timestamp - dance[-1].timestamp).total_seconds()
+            if offset > self.waggle_max_gap or offset < 0:
+                indices_to_delete.append(idx)
+                continue
+
+            min_distance = min(math.sqrt((w.x - waggle.x) ** 2.0 + (w.y - waggle.y) ** 2.0) for w in dance)
+            if min_distance > self.waggle_max_distance:
+                continue
+
+            dance.append(waggle)
+            matched_dance = dance
+            break
+
+        for idx in indices_to_delete[::-1]:
+            del self.open_dances[idx]
+
+        if matched_dance is None:
+            matched_dance = [waggle]
+            self.open_dances.append(matched_dance)
+        return matched_dance
+
+def generate_stream(rng, n_waggles, shuffle_probability):
+    """Waggles around a few nearby spots with pauses. Some waggles are swapped with earlier ones."""
+    start = datetime.datetime(2024, 6, 1, 10, 0)
+    spots = [(rng.uniform(0.0, 1000.0), rng.uniform(0.0, 600.0)) for _ in range(6)]
+    waggles = []
+    time = 0.0
+    for i in range(n_waggles):
+        time += rng.expovariate(1.0) if rng.random() < 0.97 else rng.uniform(5.0, 20.0)
+        x, y = rng.choice(spots)
+        waggles.append(Waggle(x + rng.gauss(0.0, 60.0), y + rng.gauss(0.0, 60.0), rng.uniform(-math.pi, math.pi), 0.5,
+                              start + datetime.timedelta(seconds=time), "cam0", uuid=i))
+
+    for i in range(1, len(waggles)):
+        if rng.random() < shuffle_probability:
+            j = max(0, i - rng.randint(1, 20))
+            waggles[i], waggles[j] = waggles[j], waggles[i]
+    return waggles
+
+def get_detector_dances(detector):
+    return [dance.waggle_ids for dance in detector.open_dances.values()]
+
+
+@pytest.mark.parametrize("shuffle_probability", [0.0, 0.1, 0.5, 1.0])
+def test_same_clustering_as_linear_scan(shuffle_probability):
+    rng = random.Random(shuffle_probability)
+    for _ in range(5):
+        linear_scan = LinearScanDetector()
+        detector = DanceDetector(print_fn=lambda *args: None, log_fn=lambda *args, **kwargs: None)
+
+        for waggle in generate_stream(rng, 1000, shuffle_probability):
+            expected_dance = linear_scan.process(waggle)
+            list(detector.process(waggle))
+
+            assert get_detector_dances(detector) == [[w.uuid for w in dance] for dance in linear_scan.open_dances]
+            assert [w.uuid for w in expected_dance][-1] == waggle.uuid
+
+def test_grid_finds_dances_within_cell_size():
+    rng = random.Random(0)
+    grid = SpatialGrid(cell_size=50.0)
+    dances = []
+    for i in range(30):
+        dance = "dance{}".format(i)
+        coords = [(rng.uniform(-200.0, 200.0), rng.uniform(-200.0, 200.0)) for _ in range(3)]
+        for (x, y) in coords:
+            grid.add(dance, x, y)
+        dances.append((dance, coords))
+
+    for _ in range(200):
+        x, y = rng.uniform(-250.0, 250.0), rng.uniform(-250.0, 250.0)
+        expected = {dance for dance, coords in dances
+                    if any(math.sqrt((cx - x) ** 2.0 + (cy - y) ** 2.0) <= 50.0 for (cx, cy) in coords)}
+        assert grid.get_nearby_dances(x, y) == expected
+
+@pytest.mark.parametrize("cell_size", [0.0, -1.0])
+def test_grid_rejects_invalid_cell_size(cell_size):
+    with pytest.raises(ValueError):
+        SpatialGrid(cell_size=cell_size)
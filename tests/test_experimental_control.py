@@ -0,0 +1,121 @@
+import datetime
+import math
+import random
+
+import numpy as np
+import pytz
+
+from wdd_bridge.experimental_control import ExperimentalControl
+
+
+START = pytz.UTC.localize(datetime.datetime(2024, 6, 1, 10, 0))
+
+
+def evaluate_rules(timetable, tolerance_rad, world_angle, now, print_fn, log_fn):
+    """The uncompiled evaluation of the original filter_message: all rules are matched for every message."""
+    world_angle = (world_angle + 2.0 * np.pi) % (2.0 * np.pi)
+    current_ruleset = [rule for rule in timetable if rule["ts_from"] <= now and rule["ts_to"] >= now]
+    if len(current_ruleset) == 0:
+        print_fn("No rule set for current time.")
+        return dict()
+
+    def handle_action_set(rules):
+        mapping_keys = dict()
+        for rule in rules:
+            for k, v in rule["all_keys"].items():
+                if k in mapping_keys and mapping_keys[k] != v:
+                    print_fn("Warning: Two conflicting values for key {} ({} vs. {}).".format(k, v, mapping_keys[k]))
+            mapping_keys = {**mapping_keys, **rule["all_keys"]}
+
+        action_set = set(rule["rule"] for rule in rules)
+        if "vibrate" in action_set and "no_vibrate" in action_set:
+            print_fn("Warning: Two concrete, opposing rules for this world angle.")
+        if "no_vibrate" in action_set:
+            log_fn("prevented vibration")
+            return True, None
+        elif "vibrate" in action_set:
+            log_fn("allowed vibration")
+            return True, dict(mapping_keys)
+        return False, None
+
+    concrete_rules = []
+    for rule in current_ruleset:
+        if math.isnan(rule["angle_rad"]):
+            continue
+        diff0 = abs(rule["angle_rad"] - world_angle)
+        if diff0 < tolerance_rad or (2.0 * np.pi) - diff0 < tolerance_rad:
+            concrete_rules.append(rule)
+    if len(concrete_rules) > 0:
+        handled, message = handle_action_set(concrete_rules)
+        if handled:
+            return message
+
+    general_rules = [rule for rule in current_ruleset if math.isnan(rule["angle_rad"])]
+    if len(general_rules) > 0:
+        handled, message = handle_action_set(general_rules)
+        if handled:
+            return message
+
+    print_fn("Warning: No rule handled current experiment.")
+    return None
+
+def generate_timeslots(rng, n_slots):
+    """Overlapping slots of concrete rules, some of them with a general rule."""
+    timeslots = []
+    for i in range(n_slots):
+        start = START + datetime.timedelta(minutes=20 * i)
+        end = start + datetime.timedelta(minutes=rng.choice([10, 20, 30, 45]))
+        if rng.random() < 0.7:
+            timeslots.append({"from": start.isoformat(), "to": end.isoformat(), "rule": rng.choice(["vibrate", "no_vibrate"])})
+        for _ in range(rng.randint(0, 5)):
+            timeslots.append({"from": start.isoformat(), "to": end.isoformat(), "rule": rng.choice(["vibrate", "no_vibrate"]),
+                              "angle_deg": rng.choice([rng.uniform(-180.0, 360.0), rng.randint(0, 12) * 30.0]),
+                              "sound_index": rng.randint(0, 2)})
+    return timeslots
+
+def get_random_angle(rng, control):
+    # Often exactly at the tolerance boundary of a rule.
+    if rng.random() < 0.3:
+        rule = rng.choice(control.timetable)
+        if not math.isnan(rule["angle_rad"]):
+            return rule["angle_rad"] + rng.choice([-1.0, 1.0]) * control.tolerance_rad
+    return rng.uniform(-np.pi, 2.0 * np.pi)
+
+def get_random_time(rng, control):
+    # Often exactly at the start or end of a rule.
+    if rng.random() < 0.2:
+        return rng.choice(control.slot_boundaries)
+    return START + datetime.timedelta(seconds=rng.uniform(-600.0, 12.0 * 3600.0))
+
+
+def test_compiled_decisions_match_rule_evaluation():
+    rng = random.Random(0)
+    for max_compiled_slots in (1, 8):
+        messages = []
+        control = ExperimentalControl(dict(tolerance_deg=rng.choice([15.0, 30.0]), timeslots=generate_timeslots(rng, 36)),
+                                      print_fn=lambda *args: None, log_fn=lambda *args: None,
+                                      max_compiled_slots=max_compiled_slots)
+        control.print_fn = control.log_fn = lambda text, *args: messages.append(text.format(*args))
+
+        expected_messages = []
+        for _ in range(5000):
+            world_angle, now = get_random_angle(rng, control), get_random_time(rng, control)
+
+            result = control.filter_message(dict, world_angle, now=now)
+            expected = evaluate_rules(control.timetable, control.tolerance_rad, world_angle, now,
+                                      expected_messages.append, expected_messages.append)
+            assert result == expected
+            assert messages == expected_messages
+
+        assert len(control.compiled_slots) <= max_compiled_slots
+
+def test_slots_are_compiled_when_reached():
+    control = ExperimentalControl(dict(tolerance_deg=30.0, timeslots=generate_timeslots(random.Random(1), 36)),
+                                  print_fn=lambda *args: None, log_fn=lambda *args: None, max_compiled_slots=2)
+    assert len(control.compiled_slots) == 0
+
+    first_slot = control.get_current_slot(START + datetime.timedelta(minutes=5))
+    control.get_current_slot(START + datetime.timedelta(hours=3, minutes=5))
+    # Moving back within the cache keeps the compilation.
+    assert control.get_current_slot(START + datetime.timedelta(minutes=5)) is first_slot
+    assert len(control.compiled_slots) == 2
@@ -0,0 +1,43 @@
+from wdd_bridge.log_buffer import LogBuffer, LogMessage
+
+
+def get_messages(log, n=100):
+    # Strips the time of the lines.
+    return [line.split("] ", 1)[1] for line in log.get_lines(n)]
+
+
+def test_rate_limit_is_per_template():
+    log = LogBuffer(rate_limit=1.0, burst_size=2)
+    kept = [log.add("waggle {}", (i,), now=0.0) for i in range(5)]
+    assert kept == [True, True, False, False, False]
+    # Other templates have their own bucket.
+    assert log.add("dance {}", (0,), now=0.0)
+
+    # One token per second is refilled. The next kept message shows how many were suppressed.
+    assert log.add("waggle {}", (5,), now=1.0)
+    assert get_messages(log) == ["waggle 0", "waggle 1", "dance 0", "waggle 5 (3 similar messages suppressed)"]
+    assert log.n_suppressed == 3
+
+def test_template_count_is_bounded():
+    log = LogBuffer(rate_limit=1.0, burst_size=1, max_templates=3)
+    for i in range(100):
+        log.add("message {}".format(i), now=0.0)
+    assert list(log.buckets) == ["message 97", "message 98", "message 99"]
+
+    # Using a template makes it the most recently used one.
+    log.add("message 97", now=0.0)
+    log.add("message 100", now=0.0)
+    assert list(log.buckets) == ["message 99", "message 97", "message 100"]
+
+def test_capacity():
+    log = LogBuffer(capacity=3)
+    for i in range(10):
+        log.add("line {}", (i,))
+    assert len(log) == 3
+    assert get_messages(log, 2) == ["line 8", "line 9"]
+
+def test_messages_without_arguments_are_literal():
+    log = LogBuffer()
+    log.add("{not a field}")
+    assert get_messages(log) == ["{not a field}"]
+    assert str(LogMessage("{} - {}", (1, "a"))) == "1 - a"
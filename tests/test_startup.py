@@ -0,0 +1,36 @@
+import threading
+
+import pytest
+
+from wdd_bridge.startup import StartupReport
+
+
+def test_run_concurrently_returns_results():
+    report = StartupReport()
+    assert report.run_concurrently(dict(a=lambda: 1, b=lambda: 2)) == dict(a=1, b=2)
+    assert sorted(name for name, _, _ in report.phases) == ["a", "b"]
+
+def test_run_concurrently_cleans_up_after_an_error():
+    report = StartupReport()
+    a_finished = threading.Event()
+    cleaned_up = []
+
+    def fail():
+        # Fails only after the other phase finished.
+        a_finished.wait(timeout=5.0)
+        raise ValueError("phase failed")
+
+    def cleanup_b():
+        raise RuntimeError("cleanup failed")
+
+    with pytest.raises(ValueError):
+        report.run_concurrently(dict(a=a_finished.set, b=fail, c=lambda: None),
+                                cleanups=dict(a=lambda: cleaned_up.append("a"), b=cleanup_b,
+                                              c=lambda: cleaned_up.append("c")))
+    # Later phases are undone first. A failing cleanup does not prevent the others.
+    assert cleaned_up == ["c", "a"]
+
+def test_run_concurrently_does_not_clean_up_on_success():
+    cleaned_up = []
+    StartupReport().run_concurrently(dict(a=lambda: None), cleanups=dict(a=lambda: cleaned_up.append("a")))
+    assert cleaned_up == []
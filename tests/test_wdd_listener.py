@@ -0,0 +1,133 @@
+import datetime
+import queue
+import random
+
+import pytest
+
+from wdd_bridge.dance_detector import Waggle
+from wdd_bridge.wdd_listener import IngestionBuffer, ReorderBuffer
+
+
+START = datetime.datetime(2024, 6, 1, 10, 0, tzinfo=datetime.timezone.utc)
+
+
+def make_waggle(uuid, cam_id="cam0", x=0.0, y=0.0, time=0.0):
+    return Waggle(x, y, 1.0, 0.5, START + datetime.timedelta(seconds=time), cam_id, uuid=uuid)
+
+def get_uuids(waggles):
+    return [waggle.uuid for waggle in waggles]
+
+def get_all(buffer):
+    uuids = []
+    while True:
+        try:
+            uuids.append(buffer.get(block=False).uuid)
+        except queue.Empty:
+            return uuids
+
+
+def test_drop_oldest_policy():
+    buffer = IngestionBuffer(max_size_per_camera=3, overflow_policy="drop_oldest")
+    for uuid, cam_id in [("a0", "cam0"), ("a1", "cam0"), ("b0", "cam1"), ("a2", "cam0"), ("a3", "cam0"), ("a4", "cam0")]:
+        buffer.put(make_waggle(uuid, cam_id))
+
+    # The full buffer of cam0 dropped its oldest waggles, the other camera is not affected.
+    assert buffer.get_counters() == dict(received_waggles=6, dropped_waggles=2, coalesced_waggles=0, buffered_waggles=4)
+    assert get_all(buffer) == ["b0", "a2", "a3", "a4"]
+
+def test_coalesce_policy():
+    buffer = IngestionBuffer(max_size_per_camera=3, overflow_policy="coalesce", coalesce_cell_size=50.0)
+    buffer.put(make_waggle("a", x=10.0, y=10.0))
+    buffer.put(make_waggle("b", x=100.0, y=10.0))
+    buffer.put(make_waggle("c", x=200.0, y=10.0))
+    # Same cell as "a": replaces it.
+    buffer.put(make_waggle("d", x=40.0, y=49.0))
+    # No waggle from the same cell: the oldest one is dropped.
+    buffer.put(make_waggle("e", x=500.0, y=500.0))
+    # Other cameras have their own buffer.
+    buffer.put(make_waggle("f", cam_id="cam1", x=200.0, y=10.0))
+
+    assert buffer.get_counters() == dict(received_waggles=6, dropped_waggles=1, coalesced_waggles=1, buffered_waggles=4)
+    assert get_all(buffer) == ["c", "d", "e", "f"]
+
+def test_none_wakes_up_the_consumer():
+    buffer = IngestionBuffer()
+    with pytest.raises(queue.Empty):
+        buffer.get(block=True, timeout=0.01)
+
+    buffer.put(make_waggle("a"))
+    buffer.put(None)
+    assert buffer.get(block=True, timeout=1.0) is None
+    assert buffer.get(block=True, timeout=1.0).uuid == "a"
+    assert buffer.get_counters()["received_waggles"] == 1
+
+def test_unknown_overflow_policy():
+    with pytest.raises(ValueError):
+        IngestionBuffer(overflow_policy="drop_newest")
+
+def test_reorder_buffer_release_order():
+    buffer = ReorderBuffer(max_hold_time=0.05)
+    # (arrival time, waggle) - the timestamps of the waggles are out of order.
+    buffer.add(make_waggle("t2", time=2.0), now=0.0)
+    buffer.add(make_waggle("t1", time=1.0), now=0.03)
+    buffer.add(make_waggle("t3", time=3.0), now=0.04)
+    buffer.add(make_waggle("other camera", cam_id="cam1", time=0.0), now=0.04)
+
+    assert buffer.pop_released(now=0.04) == []
+    assert buffer.get_time_until_next_release(now=0.04) == pytest.approx(0.01)
+    # Once "t2" is due, everything up to its timestamp is released in order.
+    assert get_uuids(buffer.pop_released(now=0.05)) == ["t1", "t2"]
+    assert buffer.get_buffered_count() == 2
+    # "t1" is due as well, but was released with "t2".
+    assert buffer.pop_released(now=0.08) == []
+    assert get_uuids(buffer.pop_released(now=0.09)) == ["t3", "other camera"]
+    assert buffer.get_time_until_next_release(now=0.09) is None
+    assert buffer.n_late == 0
+
+    # Arrives later than the hold time allows: released right away (when due) and counted as late.
+    buffer.add(make_waggle("t0.5", time=0.5), now=0.2)
+    assert get_uuids(buffer.pop_released(now=0.25)) == ["t0.5"]
+    assert buffer.n_late == 1
+    # Not late: later than all released waggles of this camera.
+    buffer.add(make_waggle("t4", time=4.0), now=0.3)
+    assert get_uuids(buffer.pop_released(now=0.35)) == ["t4"]
+    assert buffer.n_late == 1
+
+@pytest.mark.parametrize("max_delay", [0.01, 0.05, 0.2])
+def test_reorder_buffer_counts_late_waggles(max_delay):
+    """Waggles are delayed randomly by up to max_delay seconds on their way to the buffer."""
+    rng = random.Random(max_delay)
+    max_hold_time = 0.05
+    buffer = ReorderBuffer(max_hold_time=max_hold_time)
+
+    waggles = []
+    for i in range(2000):
+        cam_id = rng.choice(["cam0", "cam1"])
+        time = i * 0.01
+        waggles.append((time + rng.uniform(0.0, max_delay), make_waggle(i, cam_id=cam_id, time=time)))
+    waggles.sort(key=lambda arrival: arrival[0])
+
+    released = []
+    for arrival_time, waggle in waggles:
+        released += buffer.pop_released(now=arrival_time)
+        buffer.add(waggle, now=arrival_time)
+    released += buffer.pop_released(now=waggles[-1][0] + max_hold_time)
+    assert sorted(get_uuids(released)) == list(range(len(waggles)))
+
+    # A waggle is late if a later waggle of its camera was released before.
+    n_late = 0
+    for cam_id in ("cam0", "cam1"):
+        latest_timestamp = None
+        for waggle in released:
+            if waggle.cam_id != cam_id:
+                continue
+            if latest_timestamp is not None and waggle.timestamp < latest_timestamp:
+                n_late += 1
+            else:
+                latest_timestamp = waggle.timestamp
+    assert buffer.n_late == n_late
+    # Waggles delayed less than the hold time are always in order.
+    if max_delay <= max_hold_time:
+        assert n_late == 0
+    else:
+        assert n_late > 0
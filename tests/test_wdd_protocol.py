@@ -0,0 +1,58 @@
+import datetime
+import socket
+
+import pytz
+
+from wdd_bridge.wdd_listener import WDDListener
+from wdd_bridge.wdd_protocol import (PROTOCOL_PICKLE, PROTOCOL_WAGGLE_FRAMES, connect, decode_frame,
+                                     encode_waggle_frame, make_cam_id_map, records_to_waggles)
+
+
+def make_message(cam_id, waggle_id="waggle0"):
+    # Like the WDD, the system timestamp is naive (UTC).
+    timestamp = datetime.datetime(2024, 6, 1, 12, 0, 0, 123456)
+    return dict(cam_id=cam_id, waggle_id=waggle_id, x=100.5, y=200.25, waggle_angle=1.5, waggle_duration=0.75,
+                timestamp_waggle=pytz.UTC.localize(timestamp), system_timestamp_waggle=timestamp)
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def test_records_map_int_cam_ids_back():
+    _, records = decode_frame(encode_waggle_frame([make_message(0), make_message("cam1")]))
+
+    waggles = records_to_waggles(records, make_cam_id_map([0, "cam1"]))
+
+    assert [waggle.cam_id for waggle in waggles] == [0, "cam1"]
+    assert waggles[0].x == 100.5 and waggles[0].angle == 1.5
+    assert waggles[0].timestamp == make_message(0)["timestamp_waggle"]
+
+def test_records_keep_unknown_cam_ids():
+    _, records = decode_frame(encode_waggle_frame([make_message(7)]))
+
+    assert records_to_waggles(records)[0].cam_id == "7"
+    assert records_to_waggles(records, make_cam_id_map([0]))[0].cam_id == "7"
+
+def test_listener_int_cam_id_is_the_same_for_both_protocols():
+    port = get_free_port()
+    listener = WDDListener(port=port, authkey="test", print_fn=lambda *args, **kwargs: None,
+                           log_fn=lambda *args, **kwargs: None, cam_ids=[0])
+    try:
+        cam_ids = dict()
+        for protocol in (PROTOCOL_PICKLE, PROTOCOL_WAGGLE_FRAMES):
+            con, negotiated_protocol = connect(("localhost", port), b"test", protocols=[protocol])
+            assert negotiated_protocol == protocol
+            if protocol == PROTOCOL_WAGGLE_FRAMES:
+                con.send_bytes(encode_waggle_frame([make_message(0)]))
+            else:
+                con.send(make_message(0))
+
+            waggle = listener.incoming_queue.get(block=True, timeout=5.0)
+            cam_ids[protocol] = waggle.cam_id
+            con.close()
+
+        assert cam_ids == {PROTOCOL_PICKLE: 0, PROTOCOL_WAGGLE_FRAMES: 0}
+    finally:
+        listener.close()
@@ -1,74 +1,183 @@
-import astropy
 import datetime
 import numpy as np
 import pytz
-import queue
-import threading
-import time
+
+# Maximum deviation of the interpolated azimuth table from astropy's solar position, in degrees.
+AZIMUTH_TABLE_TOLERANCE_DEG = 0.1
+# The azimuth changes arbitrarily fast with the sun close to the zenith, so it is not validated there.
+AZIMUTH_VALIDATION_MAX_ELEVATION_DEG = 85.0
+
+def calculate_solar_azimuth(unix_timestamps, latitude, longitude):
+    """Calculates the solar azimuth (in degrees, N0 E90) for an array of UTC unix timestamps.
+
+    Uses the NOAA solar position algorithm, which is accurate to well below 0.1° for the coming decades.
+    """
+
+    unix_timestamps = np.asarray(unix_timestamps, dtype=np.float64)
+
+    julian_day = unix_timestamps / 86400.0 + 2440587.5
+    julian_century = (julian_day - 2451545.0) / 36525.0
+
+    mean_longitude = (280.46646 + julian_century * (36000.76983 + julian_century * 0.0003032)) % 360.0
+    mean_anomaly = np.radians(357.52911 + julian_century * (35999.05029 - 0.0001537 * julian_century))
+    eccentricity = 0.016708634 - julian_century * (0.000042037 + 0.0000001267 * julian_century)
+
+    equation_of_center = (np.sin(mean_anomaly) * (1.914602 - julian_century * (0.004817 + 0.000014 * julian_century))
+                            + np.sin(2.0 * mean_anomaly) * (0.019993 - 0.000101 * julian_century)
+                            + np.sin(3.0 * mean_anomaly) * 0.000289)
+    true_longitude = mean_longitude + equation_of_center
+    omega = np.radians(125.04 - 1934.136 * julian_century)
+    apparent_longitude = np.radians(true_longitude - 0.00569 - 0.00478 * np.sin(omega))
+
+    mean_obliquity = 23.0 + (26.0 + (21.448 - julian_century * (46.815 + julian_century * (0.00059 - julian_century * 0.001813))) / 60.0) / 60.0
+    obliquity = np.radians(mean_obliquity + 0.00256 * np.cos(omega))
+
+    declination = np.arcsin(np.sin(obliquity) * np.sin(apparent_longitude))
+
+    y = np.tan(obliquity / 2.0) ** 2.0
+    mean_longitude = np.radians(mean_longitude)
+    equation_of_time_min = 4.0 * np.degrees(
+        y * np.sin(2.0 * mean_longitude)
+        - 2.0 * eccentricity * np.sin(mean_anomaly)
+        + 4.0 * eccentricity * y * np.sin(mean_anomaly) * np.cos(2.0 * mean_longitude)
+        - 0.5 * y * y * np.sin(4.0 * mean_longitude)
+        - 1.25 * eccentricity * eccentricity * np.sin(2.0 * mean_anomaly))
+
+    minutes_of_day = (unix_timestamps % 86400.0) / 60.0
+    true_solar_time_min = (minutes_of_day + equation_of_time_min + 4.0 * longitude) % 1440.0
+    hour_angle = np.radians(true_solar_time_min / 4.0 - 180.0)
+
+    latitude = np.radians(latitude)
+    azimuth = np.arctan2(np.sin(hour_angle),
+                         np.cos(hour_angle) * np.sin(latitude) - np.tan(declination) * np.cos(latitude))
+
+    return (np.degrees(azimuth) + 180.0) % 360.0
+
+def calculate_astropy_solar_position(unix_timestamps, latitude, longitude):
+    """Calculates the solar azimuth (N0 E90) and elevation in degrees with astropy. Slow, only used for validation."""
+
+    import astropy.coordinates
+    import astropy.units as u
+    import astropy.time
+
+    earth_loc = astropy.coordinates.EarthLocation(lat=latitude*u.deg, lon=longitude*u.deg, height=0*u.m)
+    times = astropy.time.Time(np.asarray(unix_timestamps, dtype=np.float64), format="unix", scale="utc")
+    sun_loc = astropy.coordinates.get_sun(times)
+    sun_position = sun_loc.transform_to(astropy.coordinates.AltAz(obstime=times, location=earth_loc))
+    return sun_position.az.deg, sun_position.alt.deg
+
+def to_world_angle(azimuth_deg):
+    """Converts an azimuth in degrees (N0, E90) to the angle convention used throughout the bridge (radians, N90, E0)."""
+    # to N0, E-90
+    azimuth_rad = -np.radians(azimuth_deg)
+    # to N90, E0
+    azimuth_rad = azimuth_rad + np.pi / 2.0
+
+    return azimuth_rad
+
+def world_angle_to_direction_string(world_angle):
+    world_directions = [
+                            "E", "NEE", "NE", "NNE",
+                            "N", "NNW", "NW", "NWW",
+                            "W", "SWW", "SW", "SSW",
+                            "S", "SSE", "SE", "SEE"
+                            ]
+    world_direction_step_size = (360.0 / len(world_directions))
+    # Make sure to round to nearest by adding 0.5 * world_direction_step_size
+    angle = (2.0 * np.pi + world_angle + (world_direction_step_size / 180.0 * np.pi) / 2.0) % (2.0 * np.pi)
+    world_direction = world_directions[int((angle / np.pi * 180.0) / world_direction_step_size)]
+    return world_direction
+
+class AzimuthTable:
+    """Solar azimuth for one UTC day, precomputed at a fixed resolution and linearly interpolated."""
+
+    def __init__(self, date, latitude, longitude, resolution=60.0):
+
+        self.date = date
+        self.resolution = resolution
+        self.day_start = pytz.UTC.localize(datetime.datetime.combine(date, datetime.time(0))).timestamp()
+
+        n_samples = int(np.ceil(86400.0 / resolution)) + 1
+        self.timestamps = self.day_start + np.arange(n_samples) * resolution
+        # Unwrap, so the interpolation does not jump across north.
+        self.azimuths_deg = np.degrees(np.unwrap(np.radians(
+            calculate_solar_azimuth(self.timestamps, latitude, longitude))))
+
+    def get_azimuth_deg(self, unix_timestamps):
+        return np.interp(unix_timestamps, self.timestamps, self.azimuths_deg) % 360.0
+
+    def get_single_azimuth_deg(self, unix_timestamp):
+        # The samples are equidistant, so the neighbouring samples can be indexed directly.
+        position = (unix_timestamp - self.day_start) / self.resolution
+        index = min(max(int(position), 0), self.azimuths_deg.shape[0] - 2)
+        fraction = position - index
+        azimuth_deg = (1.0 - fraction) * self.azimuths_deg[index] + fraction * self.azimuths_deg[index + 1]
+        return float(azimuth_deg % 360.0)
 
 class AzimuthUpdater:
-    """Frequently retrieves the current azimuth in a background thread.
+    """Provides the solar azimuth at arbitrary points in time from cached daily tables.
     """
 
-    def __init__(self, latitude, longitude, update_frequency=60.0):
+    def __init__(self, latitude, longitude, table_resolution=60.0, max_cached_tables=4, precompute=True):
 
         self.latitude = latitude
         self.longitude = longitude
-        self.update_frequency = update_frequency
-
-        self.update_queue = queue.Queue()
-        self.latest_azimuth = None
-
-        self.running = True
-
-        self.listener_thread = threading.Thread(target=self.update_azimuth, args=())
-        self.listener_thread.daemon = True
-        self.listener_thread.start()
+        self.table_resolution = table_resolution
+        self.max_cached_tables = max_cached_tables
 
-    def calculate_current_azimuth(self):
+        # Maps dates to their azimuth tables, in the order they were created.
+        self.azimuth_tables = dict()
 
-        import astropy.coordinates 
-        import astropy.units as u
-        import astropy.time
+        # Precompute today's table, so the first lookup is fast. Otherwise, the caller can do that later.
+        if precompute:
+            self.get_azimuth_table(datetime.datetime.now(pytz.UTC).date())
 
-        current_time = datetime.datetime.now()
+    def get_azimuth_table(self, date):
+        table = self.azimuth_tables.get(date, None)
+        if table is None:
+            table = AzimuthTable(date, self.latitude, self.longitude, resolution=self.table_resolution)
+            self.azimuth_tables[date] = table
 
-        earth_loc = astropy.coordinates.EarthLocation(lat=self.latitude*u.deg, lon=self.longitude*u.deg, height=0*u.m)
-    
-        current_time = astropy.time.Time(current_time.astimezone(pytz.UTC), scale="utc")
-        sun_loc = astropy.coordinates.get_sun(current_time)
-        azimuth_rad = sun_loc.transform_to(astropy.coordinates.AltAz(obstime=current_time, location=earth_loc)).az.rad
+            while len(self.azimuth_tables) > self.max_cached_tables:
+                del self.azimuth_tables[next(iter(self.azimuth_tables))]
+        return table
 
-        # azimuth_rad is now at N0, E90
+    def validate_against_astropy(self, date=None, n_samples=96, tolerance_deg=AZIMUTH_TABLE_TOLERANCE_DEG):
+        """Compares the azimuth table of a day (default: today) to astropy while the sun is up.
 
-        # to N0, E-90
-        azimuth_rad = -azimuth_rad
-        # to N90, E0
-        azimuth_rad = azimuth_rad + np.pi / 2.0
+        Returns the maximum absolute deviation in degrees. Raises a ValueError if it exceeds the tolerance.
+        """
+        if date is None:
+            date = datetime.datetime.now(pytz.UTC).date()
 
-        return azimuth_rad
+        table = AzimuthTable(date, self.latitude, self.longitude, resolution=self.table_resolution)
+        timestamps = np.linspace(table.timestamps[0], table.timestamps[-1], n_samples)
 
-    def update_azimuth(self):
+        azimuths_deg, elevations_deg = calculate_astropy_solar_position(timestamps, self.latitude, self.longitude)
+        valid = (elevations_deg > 0.0) & (elevations_deg < AZIMUTH_VALIDATION_MAX_ELEVATION_DEG)
+        if not np.any(valid):
+            return 0.0
 
-        while self.running:
-            updated_azimuth = self.calculate_current_azimuth()
-            self.update_queue.put(updated_azimuth)
+        difference = table.get_azimuth_deg(timestamps[valid]) - azimuths_deg[valid]
+        max_error_deg = float(np.max(np.abs((difference + 180.0) % 360.0 - 180.0)))
+        if max_error_deg > tolerance_deg:
+            raise ValueError("Azimuth table deviates from astropy by {:1.3f}° (tolerance {:1.3f}°).".format(
+                max_error_deg, tolerance_deg))
 
-            time.sleep(self.update_frequency)
+        return max_error_deg
 
-    def get_azimuth(self):
+    def get_azimuth(self, at=None):
+        """Returns the azimuth (radians, N90, E0) at a timezone-aware datetime (default: now)."""
 
-        # Fetch latest update.
-        while not self.update_queue.empty():
-            update = self.update_queue.get()
-            self.latest_azimuth = update
+        if at is None:
+            at = datetime.datetime.now(pytz.UTC)
+        else:
+            at = at.astimezone(pytz.UTC)
 
-        # If, for some reason, the azimuth is requested immediately, just wait a bit.
-        if self.latest_azimuth is None:
-            update = self.update_queue.get()
-            self.latest_azimuth = update
+        table = self.get_azimuth_table(at.date())
+        azimuth_deg = table.get_single_azimuth_deg(at.timestamp())
 
-        return self.latest_azimuth
+        return float(to_world_angle(azimuth_deg))
 
     def close(self):
-        self.running = False
+        pass
@@ -0,0 +1,285 @@
+"""Microbenchmarks for the functions on the bridge's hot path.
+
+All inputs are generated with fixed seeds, so the results of two commits can be compared.
+"""
+import datetime
+import json
+import os
+import pickle
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pytz
+
+from .dance_detector import Dance, DanceDetector, calculate_angle_consensus
+from .load_generator import SyntheticCamera
+from .wdd_listener import message_to_waggle
+
+# Registered benchmarks by name. Each one is a function that prepares its inputs and returns the callable to time
+# and, optionally, a function to clean up afterwards.
+BENCHMARKS = dict()
+
+BENCHMARK_CAMERA_CONFIG = dict(
+    cam_id="cam0",
+    origin="top left",
+    homography=dict(
+        pixels=[102, 58, 1830, 75, 1812, 1004, 95, 990],
+        units=[0, 0, 400, 0, 400, 220, 0, 220],
+    ),
+    actuators=[dict(name="actuator{}".format(i), x=50.0 + 100.0 * (i % 4), y=55.0 + 110.0 * (i // 4)) for i in range(8)],
+)
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+def print_nothing(*args, **kwargs):
+    pass
+
+class StaticAzimuthUpdater:
+    def get_azimuth(self, at=None):
+        return 0.5
+
+def generate_waggles(n_waggles, concurrent_dances=4, waggle_interval=0.2, seed=0):
+    camera = SyntheticCamera("cam0", (95.0, 58.0, 1830.0, 1004.0), random.Random(seed), concurrent_dances=concurrent_dances)
+    start = datetime.datetime(2024, 6, 1, 10, 0)
+    return [message_to_waggle(camera.next_message(start + datetime.timedelta(seconds=i * waggle_interval)))
+            for i in range(n_waggles)]
+
+def generate_messages(n_messages, seed=0):
+    camera = SyntheticCamera("cam0", (95.0, 58.0, 1830.0, 1004.0), random.Random(seed))
+    start = datetime.datetime(2024, 6, 1, 10, 0)
+    return [camera.next_message(start + datetime.timedelta(seconds=i * 0.2)) for i in range(n_messages)]
+
+@benchmark
+def unpickle_message_to_waggle_32():
+    messages = [pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL) for message in generate_messages(32)]
+
+    def run():
+        for data in messages:
+            message_to_waggle(pickle.loads(data))
+    return run
+
+@benchmark
+def decode_waggle_frame_32():
+    from .wdd_protocol import decode_frame, encode_waggle_frame, records_to_waggles
+    frame = encode_waggle_frame(generate_messages(32))
+
+    def run():
+        _, records = decode_frame(frame)
+        records_to_waggles(records)
+    return run
+
+@benchmark
+def calculate_angle_consensus_20():
+    rng = np.random.RandomState(0)
+    angle_sets = [list(rng.normal(rng.uniform(-np.pi, np.pi), 0.3, size=20)) for _ in range(100)]
+    cursor = [0]
+
+    def run():
+        cursor[0] = (cursor[0] + 1) % len(angle_sets)
+        calculate_angle_consensus(angle_sets[cursor[0]])
+    return run
+
+@benchmark
+def dance_get_min_distance_20():
+    dance = Dance()
+    for waggle in generate_waggles(20, concurrent_dances=1):
+        dance.append(waggle)
+    rng = np.random.RandomState(0)
+    points = rng.uniform(0.0, 1000.0, size=(100, 2)).tolist()
+    cursor = [0]
+
+    def run():
+        cursor[0] = (cursor[0] + 1) % len(points)
+        dance.get_min_distance(*points[cursor[0]])
+    return run
+
+@benchmark
+def dance_detector_process():
+    waggles = generate_waggles(5000, concurrent_dances=8)
+    state = dict(detector=None, cursor=len(waggles))
+
+    def run():
+        # Start over with a fresh detector after each pass, so the number of open dances stays realistic.
+        if state["cursor"] >= len(waggles):
+            state["detector"] = DanceDetector(print_fn=print_nothing, log_fn=print_nothing)
+            state["cursor"] = 0
+        waggle = waggles[state["cursor"]]
+        state["cursor"] += 1
+        waggle.stage_timestamps = dict()
+        for _ in state["detector"].process(waggle):
+            pass
+    return run
+
+@benchmark
+def comb_mapper_map_to_comb():
+    from .comb_mapper import CombMapper
+    mapper = CombMapper(BENCHMARK_CAMERA_CONFIG, azimuth_updater=StaticAzimuthUpdater(), print_fn=print_nothing)
+    rng = np.random.RandomState(0)
+    inputs = np.column_stack((rng.uniform(95.0, 1830.0, 100), rng.uniform(58.0, 1004.0, 100),
+                              rng.uniform(-np.pi, np.pi, 100))).tolist()
+    cursor = [0]
+
+    def run():
+        cursor[0] = (cursor[0] + 1) % len(inputs)
+        mapper.map_to_comb(*inputs[cursor[0]])
+    return run
+
+@benchmark
+def experimental_control_filter_message():
+    from .experimental_control import ExperimentalControl
+    start = datetime.datetime.now(pytz.UTC) - datetime.timedelta(hours=1)
+    rng = random.Random(0)
+    timeslots = []
+    for i in range(48):
+        slot_start = start + datetime.timedelta(minutes=30 * i)
+        timeslots.append({"from": slot_start.isoformat(), "to": (slot_start + datetime.timedelta(minutes=30)).isoformat(),
+                          "rule": "no_vibrate"})
+        for _ in range(4):
+            timeslots.append({"from": slot_start.isoformat(), "to": (slot_start + datetime.timedelta(minutes=30)).isoformat(),
+                              "rule": "vibrate", "angle_deg": rng.uniform(0.0, 360.0)})
+    control = ExperimentalControl(dict(tolerance_deg=30.0, timeslots=timeslots), print_fn=print_nothing, log_fn=print_nothing)
+    angles = np.random.RandomState(0).uniform(-np.pi, np.pi, 100).tolist()
+    cursor = [0]
+
+    def run():
+        cursor[0] = (cursor[0] + 1) % len(angles)
+        control.filter_message(lambda keys: keys, angles[cursor[0]])
+    return run
+
+@benchmark
+def world_angle_to_direction_string():
+    from .azimuth import world_angle_to_direction_string
+    angles = np.random.RandomState(0).uniform(-np.pi, np.pi, 100).tolist()
+    cursor = [0]
+
+    def run():
+        cursor[0] = (cursor[0] + 1) % len(angles)
+        world_angle_to_direction_string(angles[cursor[0]])
+    return run
+
+@benchmark
+def statistics_log():
+    from .statistics import Statistics
+    directory = tempfile.TemporaryDirectory()
+    stats = Statistics(os.path.join(directory.name, "stats.jsonl"), report_interval=None)
+    timestamp = datetime.datetime(2024, 6, 1, 10, 0, tzinfo=pytz.UTC)
+
+    def run():
+        stats.log("decoded dance", world_direction="NE", world_angle=0.8, dance_duration=0.9, cam_id="cam0",
+                  dance_angle_to_gravity=0.3, dance_angle_raw=0.25, azimuth=1.2, first_waggle_id="cam0_1",
+                  waggle_timestamp=timestamp)
+
+    def cleanup():
+        stats.close()
+        directory.cleanup()
+    return run, cleanup
+
+@benchmark
+def comb_connector_send_serial_message():
+    from .comb_connector import CombConnector, ActuatorSignalSelectionMessage
+    comb = CombConnector(port="", actuator_count=8, print_fn=print_nothing, log_fn=print_nothing)
+    # Let the connector process its initial messages first.
+    while comb.get_queue_depth() > 0:
+        time.sleep(0.01)
+    # The deactivations are scheduled far enough in the future not to interfere.
+    messages = [ActuatorSignalSelectionMessage(i % 8, signal_index=1 + (i % 2), duration=3600.0) for i in range(16)]
+    cursor = [0]
+
+    def run():
+        cursor[0] = (cursor[0] + 1) % len(messages)
+        comb._send_serial_message(messages[cursor[0]])
+    return run, comb.close
+
+def time_benchmark(fn, repeat=5, min_time=0.2):
+    """Returns the times per call (in seconds) of repeat runs, each of which takes at least about min_time seconds."""
+
+    # Find the number of calls per run.
+    number = 1
+    while True:
+        start_time = time.perf_counter()
+        for _ in range(number):
+            fn()
+        duration = time.perf_counter() - start_time
+        if duration >= min_time / 10.0:
+            break
+        number *= 10
+    number = max(1, int(number * min_time / max(duration, 1e-9)))
+
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start_time) / number)
+    return number, times
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(names=None, repeat=5, min_time=0.2, print_fn=print_nothing):
+    """Runs the given (default: all) benchmarks and returns the results as a json-serializable dict."""
+
+    results = dict()
+    for name, setup_fn in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+
+        fn = setup_fn()
+        cleanup_fn = None
+        if isinstance(fn, tuple):
+            fn, cleanup_fn = fn
+        try:
+            number, times = time_benchmark(fn, repeat=repeat, min_time=min_time)
+        finally:
+            if cleanup_fn is not None:
+                cleanup_fn()
+
+        results[name] = dict(
+            min=min(times),
+            median=statistics.median(times),
+            number=number,
+            repeat=repeat,
+        )
+        print_fn("{:40s} {:10.2f} µs (median {:10.2f} µs)".format(name, min(times) * 1e6, statistics.median(times) * 1e6))
+
+    return dict(
+        commit=get_commit(),
+        timestamp=datetime.datetime.utcnow().isoformat(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        benchmarks=results,
+    )
+
+def compare_results(old_results, new_results, print_fn=print_nothing):
+    """Prints the relative change of the minimum time of all benchmarks contained in both results.
+
+    Returns the ratios (new / old) by name.
+    """
+    ratios = dict()
+    print_fn("{:40s} {:>12s} {:>12s} {:>8s}".format("benchmark", "old (µs)", "new (µs)", "ratio"))
+    for name, new in new_results["benchmarks"].items():
+        old = old_results["benchmarks"].get(name, None)
+        if old is None:
+            continue
+        ratios[name] = new["min"] / old["min"]
+        print_fn("{:40s} {:12.2f} {:12.2f} {:8.2f}".format(name, old["min"] * 1e6, new["min"] * 1e6, ratios[name]))
+    return ratios
+
+def load_results(filename):
+    with open(filename, "r") as f:
+        return json.load(f)
+
+def save_results(results, filename):
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=2)
@@ -1,30 +1,21 @@
-from .wdd_listener import WDDListener
+from .wdd_listener import WDDListener, ReorderBuffer
 from .dance_detector import DanceDetector
 from .comb_connector import CombConnector, ActuatorSignalSelectionMessage, TriggerMessage
 from .comb_mapper import CombMapper
 from .experimental_control import ExperimentalControl
 from .statistics import Statistics
-from .azimuth import AzimuthUpdater
+from .azimuth import AzimuthUpdater, world_angle_to_direction_string
+from .latency import LatencyTracker, LatencyServer
+from .capture import CaptureWriter
+from .log_buffer import LogBuffer, LogMessage
+from .startup import StartupReport
+from .ui import TerminalUI, UIPublisher, parse_ui_key, SNAPSHOT_LOG_LINES
 
-import asciimatics
-import asciimatics.screen
 import collections
 import datetime
 import json
 import numpy as np
-
-def world_angle_to_direction_string(world_angle):
-    world_directions = [
-                            "E", "NEE", "NE", "NNE",
-                            "N", "NNW", "NW", "NWW",
-                            "W", "SWW", "SW", "SSW",
-                            "S", "SSE", "SE", "SEE"
-                            ]
-    world_direction_step_size = (360.0 / len(world_directions))
-    # Make sure to round to nearest by adding 0.5 * world_direction_step_size
-    angle = (2.0 * np.pi + world_angle + (world_direction_step_size / 180.0 * np.pi) / 2.0) % (2.0 * np.pi)
-    world_direction = world_directions[int((angle / np.pi * 180.0) / world_direction_step_size)]
-    return world_direction
+import time
 
 class HiveSide:
     """In case a single frame is recorded from both sides, they need separate dance clustering and homography mappings."""
@@ -36,6 +27,7 @@ class HiveSide:
                     use_all_actuators,
                     use_hardwired_signals,
                     use_soundboard=(0,),
+                    raster_max_error=2.0,
                     detector_kws={}):
         self.cam_id = cam_id
         self.log_fn = log_fn
@@ -48,8 +40,13 @@ class HiveSide:
         self.use_hardwired_signals = use_hardwired_signals
         self.use_soundboard = use_soundboard
 
-        self.dance_detector = DanceDetector(print_fn=print_fn, log_fn=self.log_fn, **detector_kws)
-        self.comb_mapper = CombMapper(config=comb_config, azimuth_updater=azimuth_updater, print_fn=self.print_fn)
+        self.comb_mapper = CombMapper(config=comb_config, azimuth_updater=azimuth_updater, print_fn=self.print_fn,
+                                      raster_max_error=raster_max_error)
+        # The comb positions are only needed for the UI, but are cached once per waggle instead of once per frame.
+        self.dance_detector = DanceDetector(print_fn=print_fn, log_fn=self.log_fn,
+                                            position_fn=self.comb_mapper.map_position_to_comb, **detector_kws)
+        # Number of comb points of each open dance that were already passed to the UI.
+        self.ui_dance_cursors = dict()
 
         self.hardwired_signals = []
 
@@ -94,10 +91,18 @@ class HiveSide:
                         groups_label.append("+".join(map(str, indices)) + " " + signal_groups_identifiers[signal_group_key])
                         for index in indices:
                             self.hardwired_signals[index][1]["manual_actuator_index"] = indices
-                    self.print_fn("Found {} actuator groups: {}.".format(len(signal_groups), ", ".join(groups_label)))
+                    self.print_fn("Found {} actuator groups: {}.", len(signal_groups), ", ".join(groups_label))
                 
     def close(self):
         pass
+
+    def get_comb_dance_positions(self):
+        """Returns (dance index, index of the first new point, [(x, y, raw waggle angle), ...]) in comb coordinates
+        for all open dances. Only the points added since the last call are included."""
+        return self.dance_detector.get_comb_dance_points(self.ui_dance_cursors)
+
+    def expire_dances(self, now):
+        return self.dance_detector.expire_dances(now)
     
     def get_activation_message(self, actuator_index, remapping_keys):
         
@@ -136,13 +141,15 @@ class HiveSide:
     def process(self, waggle_info):
         coordinates = self.dance_detector.process(waggle_info)
 
-        for (x, y, waggle_angle, waggle_duration, first_waggle_id) in coordinates:
+        for (x, y, waggle_angle, waggle_duration, first_waggle_id, last_waggle_timestamp) in coordinates:
             
             waggle_angle_orig = waggle_angle
-            xy, (waggle_angle, world_angle), (idx, distance) = self.comb_mapper.map_to_comb(x, y, waggle_angle)
+            xy, (waggle_angle, world_angle), (idx, distance) = self.comb_mapper.map_to_comb(
+                x, y, waggle_angle, timestamp=last_waggle_timestamp)
+            stage_timestamps = dict(waggle_info.stage_timestamps, mapped=time.monotonic())
 
             world_direction = world_angle_to_direction_string(world_angle)
-            azimuth = self.azimuth_updater.get_azimuth()
+            azimuth = self.azimuth_updater.get_azimuth(at=last_waggle_timestamp)
 
             self.log_fn(
                 "decoded dance",
@@ -156,20 +163,46 @@ class HiveSide:
                 first_waggle_id=first_waggle_id
             )
 
-            self.print_fn("Dance for {} ({:1.1f}°), {:1.2f}s ('{}', grav. {:1.1f}° [raw {:1.1f}°, az. {:1.1f}°])".format(
+            self.print_fn("Dance for {} ({:1.1f}°), {:1.2f}s ('{}', grav. {:1.1f}° [raw {:1.1f}°, az. {:1.1f}°])",
                 world_direction, world_angle / np.pi * 180.0, waggle_duration, self.cam_id,
-                waggle_angle / np.pi * 180.0, waggle_angle_orig / np.pi * 180.0, azimuth / np.pi * 180.0))
+                waggle_angle / np.pi * 180.0, waggle_angle_orig / np.pi * 180.0, azimuth / np.pi * 180.0)
 
             yield (world_angle,
-                   lambda remapping_keys: self.get_activation_message(idx, remapping_keys=remapping_keys))
+                   lambda remapping_keys: self.get_activation_message(idx, remapping_keys=remapping_keys),
+                   stage_timestamps)
 
 
 class Bridge:
     def __init__(
         self, wdd_port, wdd_authkey, comb_port, comb_config, draw_arrows, stats_file, no_gui=False,
         sound_index=0, signal_index=1, all_actuators=False, hardwired_signals=False, signal_duration=1.0,
-        waggle_max_gap=7.0, waggle_min_count=3, waggle_max_distance=200.0, use_soundboard=[], only_one_signal=False
+        waggle_max_gap=7.0, waggle_min_count=3, waggle_max_distance=200.0, use_soundboard=[], only_one_signal=False,
+        stats_flush_interval=1.0, stats_fsync_policy="never", metrics_port=None, latency_report_interval=60.0,
+        capture_file=None, max_buffered_waggles=100, overflow_policy="drop_oldest", waggle_max_age=None,
+        reorder_hold_time=0.05, ui_port=None, ui_frame_rate=10.0, ui_log_size=1000, ui_log_rate_limit=5.0,
+        startup_report=None, actuator_raster_max_error=2.0
     ):
+        """wdd_port: Port to listen on for the WDD. If None, no listener is started and waggles have to be
+            passed to process_waggle directly (e.g. when replaying a capture).
+        capture_file: Filename to record all messages received from the WDD to (see capture.CaptureWriter).
+        max_buffered_waggles, overflow_policy: Capacity per camera of the buffer of received waggles and
+            what happens when it is full (see wdd_listener.IngestionBuffer).
+        waggle_max_age: Waggles older than this (in seconds) when they are processed still take part in the
+            clustering, but never trigger a signal. None disables the cutoff.
+        reorder_hold_time: Maximum time in seconds that received waggles are held back to process them in the
+            order of their timestamps (see wdd_listener.ReorderBuffer).
+        ui_port: If set, the UI is not drawn by the bridge itself. Instead, snapshots of its state are published
+            on this port for separate UI processes (see ui.UIViewer), using the WDD's authkey.
+        ui_frame_rate: Rate (per second) at which the UI is updated.
+        ui_log_size: Number of messages kept for the UI.
+        ui_log_rate_limit: Messages per second (on average) that are kept in the UI log for every kind of message.
+            The statistics file still gets all messages.
+        startup_report: StartupReport to record the duration of the initialization phases to. Independent
+            phases (e.g. opening the serial connection and binding the WDD port) are run concurrently.
+        actuator_raster_max_error: Maximum error (in comb units) of the distance to the nearest actuator when
+            it is looked up in a precomputed raster. Cameras whose raster is less accurate compute it exactly
+            (see comb_mapper.CombMapper). Can be overwritten by 'actuator_raster_max_error' in the camera config.
+        """
         if use_soundboard is None or len(use_soundboard) == 0:
             use_soundboard = (0,)
 
@@ -179,136 +212,231 @@ class Bridge:
         self.draw_arrows = draw_arrows
         self.no_gui = no_gui
 
+        if startup_report is None:
+            startup_report = StartupReport()
+        self.startup_report = startup_report
+
         # Advanced logging.
         if stats_file:
-            self.statistics = Statistics(filename=stats_file)
+            with startup_report.phase("statistics"):
+                self.statistics = Statistics(filename=stats_file, flush_interval=stats_flush_interval, fsync_policy=stats_fsync_policy)
             self.log_fn = self.statistics.log
         else:
             self.statistics = None
             self.log_fn = lambda _, **_kwargs: None
 
-        # Printing in the UI.
-        self.log = []
+        # Printing in the UI. If args are given, x is a format string that is only formatted when needed.
+        self.log = LogBuffer(capacity=ui_log_size, rate_limit=ui_log_rate_limit)
 
-        def print_fn(x, **kwargs):
-            self.log.append(
-                "[{}] {}".format(datetime.datetime.utcnow().time().isoformat(), x)
-            )
+        def print_fn(x, *args, **kwargs):
+            # The rate limit only applies to the UI. The statistics file gets every message.
+            self.log.add(x, args)
             if self.statistics is not None:
-                self.log_fn("log", text=x, **kwargs)
+                self.log_fn("log", text=LogMessage(x, args), **kwargs)
 
         self.print_fn = print_fn
 
+        self.latency_tracker = LatencyTracker()
+        self.latency_report_interval = latency_report_interval
+        self.latency_server = None
+
+        self.waggle_max_age = waggle_max_age
+        self.reorder_buffer = ReorderBuffer(max_hold_time=reorder_hold_time)
+        self.n_stale_waggles = 0
+        self.n_suppressed_messages = 0
+
         self.running = True
 
-        with open(comb_config, "r") as f:
-            config = json.load(f)
-        
-        if "experiment" in config:
-            self.experimental_control = ExperimentalControl(config["experiment"], print_fn=self.print_fn, log_fn=self.log_fn)
-        else:
-            self.experimental_control = None
+        try:
+            with startup_report.phase("config"):
+                with open(comb_config, "r") as f:
+                    config = json.load(f)
+
+                if "experiment" in config:
+                    self.experimental_control = ExperimentalControl(config["experiment"], print_fn=self.print_fn, log_fn=self.log_fn)
+                else:
+                    self.experimental_control = None
+
+            # Today's table is computed concurrently to the other phases below.
+            self.azimuth_updater = AzimuthUpdater(
+                    latitude=config["latitude"],
+                    longitude=config["longitude"],
+                    precompute=False
+                    )
+        except BaseException:
+            # Otherwise, the statistics thread keeps the process alive.
+            self.close_statistics()
+            raise
 
-        self.azimuth_updater = AzimuthUpdater(
-                latitude=config["latitude"],
-                longitude=config["longitude"]
+        self.cameras = dict()
+        self.capture_writer = None
+        self.wdd = None
+        self.comb = None
+        self.ui_frame_rate = ui_frame_rate
+        self.terminal_ui = None
+        self.ui_publisher = None
+
+        def init_azimuth():
+            self.azimuth_updater.get_azimuth_table(datetime.datetime.now(datetime.timezone.utc).date())
+
+        def init_cameras():
+            for camera_config in config["cameras"]:
+                self.cameras[camera_config["cam_id"]] = HiveSide(
+                    cam_id=camera_config["cam_id"],
+                    log_fn=self.log_fn,
+                    print_fn=self.print_fn,
+                    comb_config=camera_config,
+                    azimuth_updater=self.azimuth_updater,
+                    suppression_soundfile_index=sound_index,
+                    suppression_signal_index=signal_index,
+                    suppression_signal_duration=signal_duration,
+                    use_all_actuators=all_actuators,
+                    use_hardwired_signals=hardwired_signals,
+                    use_soundboard=use_soundboard,
+                    raster_max_error=actuator_raster_max_error,
+                    detector_kws=dict(
+                        waggle_max_gap=waggle_max_gap,
+                        waggle_min_count=waggle_min_count,
+                        waggle_max_distance=waggle_max_distance,
+                    )
+                )
+            print("Loaded configs for {} cameras.".format(len(self.cameras)))
+
+        def init_wdd():
+            if capture_file:
+                self.capture_writer = CaptureWriter(capture_file)
+
+            if wdd_port is not None:
+                print("Initializing WDD connection..", flush=True)
+                self.wdd = WDDListener(
+                    port=wdd_port, authkey=wdd_authkey, print_fn=print_fn, log_fn=self.log_fn,
+                    capture_writer=self.capture_writer,
+                    max_buffered_waggles=max_buffered_waggles, overflow_policy=overflow_policy,
+                    cam_ids=[camera_config["cam_id"] for camera_config in config["cameras"]]
                 )
 
-        self.cameras = dict()
-        for camera_config in config["cameras"]:
-            self.cameras[camera_config["cam_id"]] = HiveSide(
-                cam_id=camera_config["cam_id"],
+        def init_comb():
+            print("Initializing serial connection..", flush=True)
+            self.comb = CombConnector(
+                port=comb_port,
+                # Same as the comb mapper's actuator count of the first camera, which might not exist yet.
+                actuator_count=len(config["cameras"][0]["actuators"]),
+                print_fn=print_fn,
                 log_fn=self.log_fn,
-                print_fn=self.print_fn,
-                comb_config=camera_config,
-                azimuth_updater=self.azimuth_updater,
-                suppression_soundfile_index=sound_index,
-                suppression_signal_index=signal_index,
-                suppression_signal_duration=signal_duration,
-                use_all_actuators=all_actuators,
-                use_hardwired_signals=hardwired_signals,
+                all_actuators=all_actuators,
+                hardwired_signals=hardwired_signals,
+                signal_index=signal_index,
+                sound_index=sound_index,
                 use_soundboard=use_soundboard,
-                detector_kws=dict(
-                    waggle_max_gap=waggle_max_gap,
-                    waggle_min_count=waggle_min_count,
-                    waggle_max_distance=waggle_max_distance,
-                )
+                only_one_signal=only_one_signal,
+                latency_fn=lambda stage_timestamps: self.latency_tracker.record_stages(stage_timestamps, from_stage="clustered")
             )
-        print("Loaded configs for {} cameras.".format(len(self.cameras)))
 
-        print("Initializing WDD connection..", flush=True)
-        self.wdd = WDDListener(
-            port=wdd_port, authkey=wdd_authkey, print_fn=print_fn, log_fn=self.log_fn
-        )
+        def init_ui():
+            if metrics_port:
+                self.latency_server = LatencyServer(self.latency_tracker, port=metrics_port)
 
-        print("Initializing serial connection..", flush=True)
-        self.comb = CombConnector(
-            port=comb_port,
-            actuator_count=next(iter(self.cameras.values())).comb_mapper.get_actuator_count(),
-            print_fn=print_fn,
-            log_fn=self.log_fn,
-            all_actuators=all_actuators,
-            hardwired_signals=hardwired_signals,
-            signal_index=signal_index,
-            sound_index=sound_index,
-            use_soundboard=use_soundboard,
-            only_one_signal=only_one_signal
-        )
+            if ui_port:
+                self.ui_publisher = UIPublisher(ui_port, authkey=wdd_authkey, command_fn=self.handle_ui_command, print_fn=print_fn)
+            elif not no_gui:
+                self.terminal_ui = TerminalUI(draw_arrows=draw_arrows)
+
+        try:
+            startup_report.run_concurrently(dict(
+                azimuth=init_azimuth,
+                cameras=init_cameras,
+                wdd=init_wdd,
+                comb=init_comb,
+                ui=init_ui,
+            ), cleanups=dict(
+                cameras=self.close_cameras,
+                wdd=self.close_wdd,
+                comb=self.close_comb,
+                ui=self.close_ui,
+            ))
+        except BaseException:
+            self.close_statistics()
+            raise
+
+    def close_ui(self):
+        if self.terminal_ui is not None:
+            self.terminal_ui.close()
+        if self.ui_publisher is not None:
+            self.ui_publisher.close()
+        if self.latency_server is not None:
+            self.latency_server.close()
+
+    def close_wdd(self):
+        if self.wdd is not None:
+            self.wdd.close()
+        if self.capture_writer is not None:
+            self.capture_writer.close()
+
+    def close_comb(self):
+        if self.comb is not None:
+            self.comb.close()
+
+    def close_cameras(self):
+        for cam in self.cameras.values():
+            cam.close()
 
-        self.screen = None
+    def close_statistics(self):
+        if self.statistics is not None:
+            self.statistics.close()
 
     def stop(self):
         if self.running:
             self.log_fn("stopping execution")
             self.running = False
 
-            if self.screen is not None:
-                self.screen.close()
-
-            self.wdd.close()
-            self.comb.close()
-            for cam in self.cameras.values():
-                cam.close()
-
-            if self.statistics is not None:
-                self.statistics.close()
+            self.close_ui()
+            self.close_wdd()
+            self.close_comb()
+            self.close_cameras()
+            self.close_statistics()
 
 
     def run(self):
 
         self.log_fn("starting execution")
+        last_report_time = time.monotonic()
+        next_ui_update_time = time.monotonic()
         try:
             while self.running:
                 
-                if not self.no_gui:
-                    self.run_ui()
-
-                # Poll with a timeout, so we can e.g. interrupt the process.
-                waggle_info = self.wdd.get_message(block=True, timeout=1.0)
+                if self.terminal_ui is not None or self.ui_publisher is not None:
+                    if time.monotonic() >= next_ui_update_time:
+                        self.update_ui()
+                        next_ui_update_time = time.monotonic() + 1.0 / self.ui_frame_rate
+                    if not self.running:
+                        break
+
+                # Poll with a timeout, so we can e.g. interrupt the process, release held back waggles
+                # or update the UI in time.
+                timeout = self.reorder_buffer.get_time_until_next_release()
+                timeout = 1.0 if timeout is None else min(timeout, 1.0)
+                if self.terminal_ui is not None or self.ui_publisher is not None:
+                    timeout = min(timeout, max(0.0, next_ui_update_time - time.monotonic()))
+                waggle_info = self.wdd.get_message(block=True, timeout=timeout)
 
                 if not self.running:
                     self.stop()
                     break
 
-                if not waggle_info:
-                    continue
-                waggle_cam_id = waggle_info.cam_id
-                if waggle_cam_id not in self.cameras:
-                    self.print_fn("Received waggle for invalid camera ID.")
-
-                messages_factories = self.cameras[waggle_cam_id].process(waggle_info)
-
-                for world_angle, message_factory in messages_factories:
-                    
-                    if message_factory is None:
-                        continue
-
-                    if self.experimental_control is not None:
-                        message = self.experimental_control.filter_message(message_factory, world_angle)
-                    
-                    if message is not None:
-                        self.log_fn("sending comb message", what=str(message))
-                        self.comb.send_message(message)
+                # Drop dances that can not be continued anymore, even if their camera went quiet.
+                self.expire_dances(datetime.datetime.now(datetime.timezone.utc))
+
+                if time.monotonic() - last_report_time >= self.latency_report_interval:
+                    self.log_fn("latency summary", stages=self.latency_tracker.get_summary())
+                    self.log_fn("ingestion status", **self.get_ingestion_counters())
+                    last_report_time = time.monotonic()
+
+                if waggle_info:
+                    waggle_info.stage_timestamps["dequeued"] = time.monotonic()
+                    self.reorder_buffer.add(waggle_info)
+
+                for released_waggle in self.reorder_buffer.pop_released():
+                    self.process_waggle(released_waggle)
         except Exception as e:
             import traceback
             self.log_fn("Main loop received exception: {}".format(str(e)), stacktrace=traceback.format_exc())
@@ -316,134 +444,124 @@ class Bridge:
         finally:
             self.stop()
 
-    def run_ui(self):
-        def ui(screen):
-            
-            # Use the general information from any one side/camera (e.g. number of sensors).
-            any_side = next(iter(self.cameras.values()))
-            _, origin_y = any_side.comb_mapper.get_origin()
-            screen.clear_buffer(7, 2, 0)
-
-            ev = screen.get_key()
-            is_number_key = ev is not None and (ev >= ord("0") and ev <= ord("9"))
-
-            if ev in (ord("Q"), ord("q")):
-                self.stop()
-                print("Aborting!", flush=True)
-                return
-            elif ev in (ord("t"), ord("T")) or is_number_key:
-                import pytz
-                from .wdd_listener import Waggle
-                x, y = 600, 200
-
-                if is_number_key:
-                    index = ev - ord("0")
-                    w, h = any_side.comb_mapper.get_image_shape()
-                    cols = 5
-                    y = (1 + 2 * (index // cols)) * h / 4.0
-                    x = (2 + (index % cols)) * (w / (cols + 2))
-
-                waggle = Waggle(
-                        x, y, 104 / 180.0 * np.pi, 0.42, pytz.UTC.localize(datetime.datetime.now()), "cam0", uuid=0
-                    )
-                self.wdd.incoming_queue.put(waggle)
+    def get_ingestion_counters(self):
+        counters = dict(stale_waggles=self.n_stale_waggles, suppressed_messages=self.n_suppressed_messages,
+                        late_waggles=self.reorder_buffer.n_late, held_waggles=self.reorder_buffer.get_buffered_count())
+        if self.wdd is not None:
+            counters.update(self.wdd.incoming_queue.get_counters())
+        return counters
 
-            # Draw outline.
+    def expire_dances(self, now):
+        for hive_side in self.cameras.values():
+            hive_side.expire_dances(now)
 
-            hx0, hy0, hx1, hy1 = any_side.comb_mapper.get_comb_rectangle()
-            hwidth, hheight = hx1 - hx0, hy1 - hy0
+    def process_waggle(self, waggle_info, now=None):
+        """Clusters a waggle and sends the resulting comb messages.
 
-            # Make sure we have enough space for the logs below the screen.
-            log_margin_lines = 10
+        now: Time at which the experimental rules are evaluated (default: the current time).
+        """
+        if waggle_info.detection_delay is not None:
+            self.latency_tracker.record("detected_to_received", waggle_info.detection_delay)
 
-            # Usually, fonts are higher than wide. Account a bit for that.
-            for font_width_factor in (1.5, 1.25, 1.0):
-                ctop, cbottom = 3, int(screen.height - log_margin_lines)
-                cheight = cbottom - ctop
-                cwidth = int(font_width_factor * cheight * (hwidth / hheight))
-                if cwidth < screen.width:
-                    break
+        waggle_cam_id = waggle_info.cam_id
+        if waggle_cam_id not in self.cameras:
+            self.print_fn("Received waggle for invalid camera ID.")
+            return
 
-            cleft, cright = int(0.5 * (screen.width - cwidth)), int(0.5 * (screen.width + cwidth))
-
-            def draw_border(start, to):
-                screen.move(*start)
-                screen.draw(*to)
-
-            draw_border((cleft, ctop), (cright, ctop))
-            draw_border((cright, ctop), (cright, cbottom))
-            draw_border((cright, cbottom), (cleft, cbottom))
-            draw_border((cleft, cbottom), (cleft, ctop))
-
-            def draw_at_comb_position(xy, char, color):
-                xy = xy.astype(np.float32)
-                xy -= np.array([hx0, hy0], dtype=np.float32)
-                xy /= np.array([hwidth, hheight], dtype=np.float32)
-                xy *= np.array([cwidth, cheight], dtype=np.float32)
-                xy += np.array([cleft, ctop], dtype=np.float32)
-                x, y = xy.astype(np.int32)
-                if origin_y == "bottom":
-                    y = cheight - (y - ctop) + ctop
-                screen.print_at(char, x, y, colour=color)
-
-            # Draw current open dances.
-            arrows = ["→", "↗", "↑", "↖", "←", "↙", "↓", "↘", "→"]
-            side_colors = [
-                asciimatics.screen.Screen.COLOUR_YELLOW,
-                asciimatics.screen.Screen.COLOUR_CYAN,
-            ]
-            for side_index, hive_side in enumerate(self.cameras.values()):
-                for dance_positions in hive_side.dance_detector.get_dance_positions():
-                    for idx, ((x, y), o) in enumerate(dance_positions):
-                        xy, _, _ = hive_side.comb_mapper.map_to_comb(
-                            x, y, waggle_angle=0.0, find_sensor=False
-                        )
-                        char = "." if idx < len(dance_positions) - 1 else "o"
-                        if self.draw_arrows and o is not None:
-                            o = o / np.pi * 180
-                            o = (o + 360) % 360
-                            char = arrows[int(round(o / 45, 0))]
-                        draw_at_comb_position(
-                            xy, char=char, color=side_colors[side_index]
-                        )
-
-            for actuator_index, (x, y) in enumerate(any_side.comb_mapper.get_sensor_coordinates()):
-                is_active = self.comb.is_actuator_active(actuator_index)
-
-                draw_at_comb_position(
-                    np.array([x, y]),
-                    char="X",
-                    color=asciimatics.screen.Screen.COLOUR_BLUE if not is_active else asciimatics.screen.Screen.COLOUR_YELLOW,
-                )
+        is_stale = False
+        if self.waggle_max_age is not None:
+            age = ((now or datetime.datetime.now(datetime.timezone.utc)) - waggle_info.timestamp).total_seconds()
+            is_stale = age > self.waggle_max_age
+            if is_stale:
+                self.n_stale_waggles += 1
+
+        messages_factories = self.cameras[waggle_cam_id].process(waggle_info)
+
+        for world_angle, message_factory, stage_timestamps in messages_factories:
+            
+            if message_factory is None:
+                continue
+
+            if is_stale:
+                # The dance might have ended long ago.
+                self.n_suppressed_messages += 1
+                self.log_fn("suppressed stale dance", waggle_id=waggle_info.uuid, cam_id=waggle_cam_id)
+                continue
+
+            if self.experimental_control is not None:
+                message = self.experimental_control.filter_message(message_factory, world_angle, now=now)
+            else:
+                message = message_factory(dict())
+            
+            if message is not None:
+                stage_timestamps["filtered"] = time.monotonic()
+                message.stage_timestamps = stage_timestamps
+                self.log_fn("sending comb message", what=str(message))
+                self.comb.send_message(message)
+
+        self.latency_tracker.record_stages(waggle_info.stage_timestamps)
+
+    def get_ui_snapshot(self):
+        """Collects the state shown in the UI into a compact, picklable dict.
+
+        The dances only contain the points added since the previous snapshot (see ui.apply_dance_deltas).
+        So every snapshot has to be rendered or merged into the next one (see ui.merge_snapshots).
+        """
+        # Use the general information from any one side/camera (e.g. number of sensors).
+        any_side = next(iter(self.cameras.values()))
+        _, origin_y = any_side.comb_mapper.get_origin()
+
+        return dict(
+            timestamp=datetime.datetime.utcnow(),
+            layout=dict(
+                comb_rectangle=tuple(float(v) for v in any_side.comb_mapper.get_comb_rectangle()),
+                origin_y=origin_y,
+                sensor_coordinates=[(float(x), float(y)) for (x, y) in any_side.comb_mapper.get_sensor_coordinates()],
+            ),
+            dances=[hive_side.get_comb_dance_positions() for hive_side in self.cameras.values()],
+            actuator_remaining_times=self.comb.get_actuator_remaining_times(),
+            azimuth=self.azimuth_updater.get_azimuth(),
+            log=self.log.get_lines(SNAPSHOT_LOG_LINES),
+        )
+
+    def inject_test_waggle(self, index=None):
+        """Simulates a waggle from the WDD, in the middle of the image or at one of ten spots (index 0-9)."""
+        if self.wdd is None:
+            return
 
-            current_azimuth = self.azimuth_updater.get_azimuth()
-            screen.print_at(
-                "{} -- sun at {} ({:3.1f}°)".format(
-                    datetime.datetime.utcnow().isoformat(),
-                    world_angle_to_direction_string(current_azimuth), current_azimuth / np.pi * 180
-                ),
-                1,
-                1,
-                colour=asciimatics.screen.Screen.COLOUR_CYAN,
+        import pytz
+        from .wdd_listener import Waggle
+        x, y = 600, 200
+
+        if index is not None:
+            any_side = next(iter(self.cameras.values()))
+            w, h = any_side.comb_mapper.get_image_shape()
+            cols = 5
+            y = (1 + 2 * (index // cols)) * h / 4.0
+            x = (2 + (index % cols)) * (w / (cols + 2))
+
+        waggle = Waggle(
+                x, y, 104 / 180.0 * np.pi, 0.42, pytz.UTC.localize(datetime.datetime.utcnow()), "cam0", uuid=0
             )
+        self.wdd.incoming_queue.put(waggle)
 
-            space = screen.height - cbottom - 1
-            if space > 0:
-                log = self.log[-space:]
-                for i in range(min(len(log), space)):
-                    screen.print_at(
-                        log[i],
-                        0,
-                        cbottom + 1 + i,
-                        colour=asciimatics.screen.Screen.COLOUR_CYAN,
-                    )
+    def handle_ui_command(self, command):
+        if command[0] == "test_waggle":
+            self.inject_test_waggle(command[1])
+
+    def update_ui(self):
+        snapshot = self.get_ui_snapshot()
 
-            screen.refresh()
+        if self.ui_publisher is not None:
+            self.ui_publisher.publish(snapshot)
+            return
 
-        if self.screen is not None and self.screen.has_resized():
-            self.screen.close()
-            self.screen = None
+        command = parse_ui_key(self.terminal_ui.get_key())
+        if command == ("quit",):
+            self.stop()
+            print("Aborting!", flush=True)
+            return
+        elif command is not None:
+            self.handle_ui_command(command)
 
-        if self.screen is None:
-            self.screen = asciimatics.screen.Screen.open()
-        ui(self.screen)
+        self.terminal_ui.render(snapshot)
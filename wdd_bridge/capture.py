@@ -0,0 +1,115 @@
+import pickle
+import struct
+import threading
+import time
+
+from .wdd_listener import message_to_waggle
+from .wdd_protocol import FRAME_WAGGLES, decode_frame, make_cam_id_map, records_to_waggles
+
+# Capture files start with this marker, followed by the records.
+CAPTURE_FILE_MAGIC = b"WDDCAP1\n"
+# Each record: receive time (unix timestamp), index of the connection, length of the pickled message.
+# Binary frames (see wdd_protocol) are stored as pickled bytes.
+CAPTURE_RECORD_HEADER = struct.Struct("<dII")
+
+
+class CaptureWriter:
+    """Appends the raw messages received from the WDD to a capture file, so they can be replayed later.
+
+    Every record is flushed right away, so a crash loses at most the record being written.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.n_records = 0
+
+        self.file = open(filename, "ab")
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_FILE_MAGIC)
+            self.file.flush()
+
+    def write(self, message, connection_index=0, received_at=None):
+        if received_at is None:
+            received_at = time.time()
+
+        data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(CAPTURE_RECORD_HEADER.pack(received_at, connection_index, len(data)) + data)
+            self.file.flush()
+            self.n_records += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_capture(filename):
+    """Yields (received_at, connection_index, message) for every record in a capture file.
+
+    An incomplete record at the end of the file (e.g. after a crash) is ignored.
+    """
+    with open(filename, "rb") as f:
+        if f.read(len(CAPTURE_FILE_MAGIC)) != CAPTURE_FILE_MAGIC:
+            raise ValueError("{} is not a WDD capture file.".format(filename))
+
+        while True:
+            header = f.read(CAPTURE_RECORD_HEADER.size)
+            if len(header) < CAPTURE_RECORD_HEADER.size:
+                return
+            received_at, connection_index, length = CAPTURE_RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield received_at, connection_index, pickle.loads(data)
+
+
+def replay_capture(bridge, filename, speed=1.0, print_fn=None):
+    """Feeds the waggles of a capture file through the bridge's processing pipeline.
+
+    speed: Factor relative to the original pace of the messages. None or 0 replays as fast as possible.
+    Returns the number of replayed messages (or frames) and waggles and the duration of the replay in seconds.
+    """
+    print_fn = print_fn or (lambda _: None)
+
+    n_messages, n_waggles = 0, 0
+    first_received_at = None
+    cam_id_map = make_cam_id_map(bridge.cameras)
+    start_time = time.monotonic()
+
+    for received_at, _, message in read_capture(filename):
+        if not bridge.running:
+            break
+
+        if first_received_at is None:
+            first_received_at = received_at
+
+        if speed:
+            delay = (received_at - first_received_at) / speed - (time.monotonic() - start_time)
+            if delay > 0.0:
+                time.sleep(delay)
+
+        n_messages += 1
+        try:
+            if isinstance(message, bytes):
+                frame_type, records = decode_frame(message)
+                waggles = records_to_waggles(records, cam_id_map) if frame_type == FRAME_WAGGLES else []
+            else:
+                waggle = message_to_waggle(message)
+                waggles = [waggle] if waggle is not None else []
+        except ValueError:
+            print_fn("Replay: Skipping invalid message ({}).".format(str(message)))
+            continue
+
+        for waggle in waggles:
+            n_waggles += 1
+            waggle.stage_timestamps["received"] = waggle.stage_timestamps["dequeued"] = time.monotonic()
+            # The experimental rules and the expiry of dances follow the clock of the capture.
+            bridge.process_waggle(waggle, now=waggle.timestamp)
+
+    duration = time.monotonic() - start_time
+    return n_messages, n_waggles, duration
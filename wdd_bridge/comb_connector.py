@@ -1,11 +1,31 @@
-import datetime
+import functools
+import heapq
+import numpy as np
 import queue
-import serial
 import time
 import threading
 
 
+# Start bit, seven data bits, parity bit and two stop bits.
+SERIAL_BITS_PER_CHARACTER = 11
+
+@functools.lru_cache(maxsize=None)
+def encode_serial_line(line):
+    return (line + "\n\r").encode("utf-8")
+
+def get_serial_register(line):
+    """Returns the part of the comb's state that a serial line sets. Later lines for the same register supersede earlier ones."""
+    command = line.split(" ")
+    if command[0] == "MUX":
+        return "MUX " + command[1]
+    if command[0] == "STOP_TRIG":
+        return "TRIG"
+    return command[0]
+
 class CombActuatorMessage:
+    # Times at which the message (and the waggle it results from) passed the stages of the bridge, if tracked.
+    stage_timestamps = None
+
     def is_activation_message(self):
         return False
 
@@ -212,34 +232,137 @@ class DisableAllActuators(LinkAllActuatorsToSignal):
     def __str__(self):
         return "DisableAllActuators()"
         
-class Actuator:
-    """We need to keep a virtual sensor map around so two simultaneuos signals for one sensor don't interfere."""
+class ActuatorStates:
+    """We need to keep a virtual sensor map around so two simultaneuos signals for one sensor don't interfere.
+
+    Stores the time (time.monotonic) until which each actuator is active.
+    """
+
+    def __init__(self, actuator_count, margin=0.1):
+        self.active_until = np.full(actuator_count, -np.inf)
+        self.latest_deadline = -np.inf
+        # Actuators that will be deactivated within the margin already count as inactive.
+        self.margin = margin
+
+    def __len__(self):
+        return self.active_until.shape[0]
+
+    def is_active(self, index, now=None):
+        if now is None:
+            now = time.monotonic()
+        return self.active_until[index] - now > self.margin
+
+    def get_active(self, indices=None, now=None):
+        """Returns a boolean array with the state of the selected actuators (default: all)."""
+        if now is None:
+            now = time.monotonic()
+        active_until = self.active_until if indices is None else self.active_until[indices]
+        return active_until - now > self.margin
+
+    def get_remaining_times(self, now=None):
+        """Returns the number of seconds each actuator stays active (0 if inactive)."""
+        if now is None:
+            now = time.monotonic()
+        return np.maximum(self.active_until - now - self.margin, 0.0)
+
+    def is_any_active(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        return self.latest_deadline - now > self.margin
+
+    def set_active_for(self, indices, seconds):
+        """Sets the selected actuators (None for all) active for the given duration."""
+        deadline = time.monotonic() + seconds
+        if indices is None:
+            indices = slice(None)
+        self.active_until[indices] = deadline
+
+        if deadline >= self.latest_deadline:
+            self.latest_deadline = deadline
+        else:
+            # Actuators can also be shortened, so the latest deadline might have changed.
+            self.latest_deadline = float(np.max(self.active_until))
 
-    def __init__(self):
-        self.active_until = None
+class DeactivationScheduler:
+    """Sends scheduled deactivation messages from a single background thread.
+
+    Deactivations are identified by their message, so scheduling the same deactivation
+    again (e.g. when an active actuator is extended) moves the existing one instead of adding another.
+    """
+
+    def __init__(self, send_fn):
+        self.send_fn = send_fn
 
-    def is_active(self, dt=None):
-        if self.active_until is None:
-            return False
+        self.condition = threading.Condition()
+        # Min-heap of (deadline, sequence number, key). Entries that were rescheduled since are skipped.
+        self.heap = []
+        # Maps the key of each pending deactivation to its (deadline, sequence number, message).
+        self.pending = dict()
+        self.sequence_number = 0
 
-        if dt is None:
-            dt = datetime.datetime.utcnow()
-        return (self.active_until - dt).total_seconds() > 0.1
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, delay, message):
+        """Schedules the message to be sent in delay seconds. Returns True if an existing deactivation was moved."""
+        key = str(message)
+        deadline = time.monotonic() + delay
+
+        with self.condition:
+            rescheduled = key in self.pending
+            self.sequence_number += 1
+            self.pending[key] = (deadline, self.sequence_number, message)
+            heapq.heappush(self.heap, (deadline, self.sequence_number, key))
+            self.condition.notify()
+
+        return rescheduled
+
+    def get_pending_count(self):
+        with self.condition:
+            return len(self.pending)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    # Drop outdated entries.
+                    while len(self.heap) > 0:
+                        _, sequence_number, key = self.heap[0]
+                        entry = self.pending.get(key, None)
+                        if entry is not None and entry[1] == sequence_number:
+                            break
+                        heapq.heappop(self.heap)
+
+                    if len(self.heap) == 0:
+                        self.condition.wait()
+                        continue
+
+                    timeout = self.heap[0][0] - time.monotonic()
+                    if timeout <= 0.0:
+                        break
+                    self.condition.wait(timeout)
+
+                if not self.running:
+                    return
 
-    def set_active_for(self, seconds):
-        self.set_active_until(
-            datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
-        )
+                _, _, key = heapq.heappop(self.heap)
+                _, _, message = self.pending.pop(key)
 
-    def set_active_until(self, timestamp):
-        self.active_until = timestamp
+            self.send_fn(message)
 
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
 
 class CombConnector:
 
-    def __init__(self, port, actuator_count, print_fn, log_fn, character_delay=0.001,
+    def __init__(self, port, actuator_count, print_fn, log_fn, baudrate=9600,
                 all_actuators=False, hardwired_signals=False, signal_index=0, sound_index=0, use_soundboard=(0,),
-                only_one_signal=False):
+                only_one_signal=False, latency_fn=None):
 
         self.audio_file = None
         if port.endswith(".wav"):
@@ -247,10 +370,14 @@ class CombConnector:
             port = ""
 
         self.only_one_signal = only_one_signal
-        self.actuators = [Actuator() for i in range(actuator_count)]
+        self.actuators = ActuatorStates(actuator_count)
         self.current_soundboard_state = [None, None]
 
-        self.character_delay = character_delay
+        self.baudrate = baudrate
+        # Time it takes to transmit one character. Used to pace the writes to the comb.
+        self.character_duration = SERIAL_BITS_PER_CHARACTER / baudrate
+        # Last line written for each register of the comb (see get_serial_register).
+        self.sent_serial_state = dict()
         self.dummy_mode = not port
         self.port = port
 
@@ -258,8 +385,11 @@ class CombConnector:
 
         self.print_fn = print_fn
         self.log_fn = log_fn
+        # Called with the stage timestamps of every message after it was written to the comb.
+        self.latency_fn = latency_fn
 
         self.output_queue = queue.Queue()
+        self.deactivation_scheduler = DeactivationScheduler(send_fn=self.output_queue.put)
 
         run_fn = self.run_connector
         if self.audio_file is not None:
@@ -300,9 +430,11 @@ class CombConnector:
     def setup_connection(self):
 
         if not self.dummy_mode:
+            # Not needed in dummy or audio-only mode.
+            import serial
             self.con = serial.Serial(
                 port=self.port,
-                baudrate=9600,
+                baudrate=self.baudrate,
                 parity=serial.PARITY_ODD,
                 stopbits=serial.STOPBITS_TWO,
                 bytesize=serial.SEVENBITS,
@@ -320,6 +452,7 @@ class CombConnector:
 
     def close(self):
         self.running = False
+        self.deactivation_scheduler.close()
 
         if self.con and self.con.isOpen():
             self.con.close()
@@ -347,35 +480,52 @@ class CombConnector:
             if is_still_playing:
                 action = "continuing_last_sound"
             
-            self.print_fn("{} - {}".format(str(message), action))
+            self.print_fn("{} - {}", message, action)
             self.log_fn(action, file=self.audio_file)
 
             if not is_still_playing:
                 try:
                     audio_replay = audio.play()
                 except Exception as e:
-                    self.print_fn("Error when playing sound! {}: {}".format(type(e).__name__, str(e)))
+                    self.print_fn("Error when playing sound! {}: {}", type(e).__name__, e)
 
     def process_queue_for_serial_connection(self):
         assert self.dummy_mode or self.con.isOpen()
 
+        # The comb's state is unknown after (re)connecting.
+        self.sent_serial_state = dict()
+
         while self.running:
 
             message = self.output_queue.get()
             if message is None or not self.running:
                 break
 
+            # Process everything that is waiting at once, so superseded commands are never written.
+            messages = [message]
+            stopping = False
+            while True:
+                try:
+                    message = self.output_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if message is None:
+                    stopping = True
+                    break
+                messages.append(message)
+
             if self.con is not None and not self.con.isOpen():
                 self.print_fn("Comb: Serial connection broken. Message dropped.")
                 break
-            
+
             try:
-                self._send_serial_message(message)
+                self._send_serial_messages(messages)
             except Exception as e:
-                self.print_fn("Error when writing to serial connection: {}".format(str(e)))
+                self.print_fn("Error when writing to serial connection: {}", e)
                 break
 
-
+            if stopping:
+                break
 
     def run_connector(self):
 
@@ -395,30 +545,59 @@ class CombConnector:
             
 
     def send_message(self, message):
+        if message.stage_timestamps is not None:
+            message.stage_timestamps["enqueued"] = time.monotonic()
         self.output_queue.put(message)
 
+    def get_queue_depth(self):
+        return self.output_queue.qsize()
+
+    def get_pending_deactivation_count(self):
+        return self.deactivation_scheduler.get_pending_count()
+
     def is_any_actuator_active(self):
-        return any((a.is_active() for a in self.actuators))
+        return self.actuators.is_any_active()
 
     def _send_serial_message(self, message: CombActuatorMessage):
-
-        # Potentially schedule deactivation.
-        def schedule_deactivation(delay, deactivation_message):
-            time.sleep(delay)
-            self.output_queue.put(deactivation_message)
+        self._send_serial_messages([message])
+
+    def _send_serial_messages(self, messages):
+        # Activations take priority over everything else (e.g. deactivations or flashing the LEDs).
+        messages = sorted(messages, key=lambda m: 0 if m.is_activation_message() else 1)
+
+        serial_lines = []
+        written_messages = []
+        for message in messages:
+            message_lines = self._process_message(message)
+            serial_lines += message_lines
+            if message_lines:
+                written_messages.append(message)
+
+        self._write_serial_lines(serial_lines)
+
+        if self.latency_fn is not None:
+            now = time.monotonic()
+            for message in written_messages:
+                if message.stage_timestamps is not None:
+                    message.stage_timestamps["written"] = now
+            # Messages without effect on the comb (e.g. for an actuator that is already active) end at "enqueued".
+            for message in messages:
+                if message.stage_timestamps is not None:
+                    self.latency_fn(message.stage_timestamps)
+
+    def _process_message(self, message: CombActuatorMessage):
+        """Updates the actuator and soundboard state for a message and returns the serial lines to send."""
 
         def message_to_actuator_label(message):
 
             selected_actuator_index = message.get_actuator_index()
-            selected_actuators = self.actuators
             actuator_label = "all actuators"
             if selected_actuator_index is not None:
                 if not isinstance(selected_actuator_index, list):
                     selected_actuator_index = [selected_actuator_index]
-                selected_actuators = [selected_actuators[i] for i in selected_actuator_index]
                 actuator_label = "actuator {}".format("+".join(map(str, selected_actuator_index)))
 
-            return selected_actuators, actuator_label
+            return selected_actuator_index, actuator_label
 
         if message.is_activation_message():
 
@@ -427,37 +606,31 @@ class CombConnector:
             if deactivation_message is not None:
                 selected_actuators, actuator_label = message_to_actuator_label(message)
 
-                all_are_active = all((a.is_active() for a in selected_actuators))
+                all_are_active = bool(np.all(self.actuators.get_active(selected_actuators)))
                 any_is_active = self.is_any_actuator_active()
 
                 # Only one signal permitted and some other actuators are still playing?
                 if self.only_one_signal and not all_are_active and any_is_active:
-                    self.print_fn("Skipping {} activation.".format(actuator_label))
-                    return
+                    self.print_fn("Skipping {} activation.", actuator_label)
+                    return []
 
-                for actuator in selected_actuators:
-                    actuator.set_active_for(delay)
+                self.actuators.set_active_for(selected_actuators, delay)
 
-                scheduling_thread = threading.Thread(
-                    target=schedule_deactivation,
-                    args=(delay, deactivation_message),
-                    kwargs=dict(),
-                )
-                scheduling_thread.start()
+                # Potentially schedule deactivation.
+                self.deactivation_scheduler.schedule(delay, deactivation_message)
 
                 if all_are_active:
-                    self.print_fn("Holding {} for {:3.2f} s more".format(actuator_label, delay))
-                    return
+                    self.print_fn("Holding {} for {:3.2f} s more", actuator_label, delay)
+                    return []
 
-                self.print_fn("Triggering {} for {:3.2f} s".format(actuator_label, delay))
+                self.print_fn("Triggering {} for {:3.2f} s", actuator_label, delay)
 
         elif message.is_deactivation_message():
             # Only deactivate if no other message activated it in the meantime.
             selected_actuators, actuator_label = message_to_actuator_label(message)
-            for actuator in selected_actuators:
-                if actuator.is_active():
-                    self.log_fn("Skipping actuator deactivation.")
-                    return
+            if np.any(self.actuators.get_active(selected_actuators)):
+                self.log_fn("Skipping actuator deactivation.")
+                return []
 
         # Especially in hardwired mode, we should not stop a signal on soundboard A just because we play one on soundboard B.
         message.merge_with_soundboard_trigger_state(self.current_soundboard_state)
@@ -465,8 +638,9 @@ class CombConnector:
         if new_soundboard_state is not None:
             self.current_soundboard_state = new_soundboard_state
 
-        # Unpack and send the message.
+        # Unpack the message.
         serial_messages = [message]
+        serial_lines = []
 
         while len(serial_messages) > 0:
             message = serial_messages.pop(0)
@@ -481,20 +655,38 @@ class CombConnector:
                 serial_messages = message + serial_messages
                 continue
 
-            message = str(message).upper()
+            serial_lines.append(str(message).upper())
 
-            self.log_fn(
-                "serial message", text=message, character_delay=self.character_delay
-            )
+        return serial_lines
+
+    def _write_serial_lines(self, serial_lines):
 
-            message = message + "\n\r"
+        # Only the last line for each register matters.
+        final_lines = dict()
+        for line in serial_lines:
+            final_lines[get_serial_register(line)] = line
+
+        for register, line in final_lines.items():
+            # Don't write what the comb already has.
+            if self.sent_serial_state.get(register, None) == line:
+                continue
 
-            for char in message:
-                if self.con is not None:
-                    self.con.write(char.encode("utf-8"))
+            self.log_fn("serial message", text=line, baudrate=self.baudrate)
 
-                if self.character_delay:
-                    time.sleep(self.character_delay)
+            buffer = encode_serial_line(line)
+            if self.con is not None:
+                self.con.write(buffer)
+                # Don't send faster than the line can transmit, so that later commands can still be coalesced.
+                time.sleep(len(buffer) * self.character_duration)
+
+            self.sent_serial_state[register] = line
 
     def is_actuator_active(self, actuator_index):
-        return self.actuators[actuator_index].is_active()
+        return self.actuators.is_active(actuator_index)
+
+    def get_actuator_remaining_times(self):
+        return self.actuators.get_remaining_times().tolist()
+
+    def get_active_actuators(self):
+        """Returns a boolean array with the state of all actuators."""
+        return self.actuators.get_active()
@@ -1,10 +1,38 @@
-import cv2
 import math
 import numpy as np
 
 
+def find_homography(source, target):
+    """Returns the 3x3 homography mapping the four source points exactly onto the four target points."""
+
+    # Solve the direct linear transform with the bottom right entry fixed to 1.
+    A = np.zeros((8, 8), dtype=np.float64)
+    b = np.zeros(8, dtype=np.float64)
+    for i, ((x, y), (u, v)) in enumerate(zip(source, target)):
+        A[2 * i] = [x, y, 1.0, 0.0, 0.0, 0.0, -u * x, -u * y]
+        A[2 * i + 1] = [0.0, 0.0, 0.0, x, y, 1.0, -v * x, -v * y]
+        b[2 * i] = u
+        b[2 * i + 1] = v
+
+    h = np.linalg.solve(A, b)
+    return np.append(h, 1.0).reshape(3, 3)
+
+def apply_homography(homography, xs, ys):
+    """Maps arrays of points with a homography. Returns an array of shape (N, 2)."""
+    points = np.stack((xs, ys, np.ones_like(xs)), axis=0)
+    points = homography @ points
+    return (points[:2] / points[2]).T
+
 class CombMapper:
-    def __init__(self, config, azimuth_updater, print_fn):
+    def __init__(self, config, azimuth_updater, print_fn, raster_cell_size=4.0, raster_max_error=2.0):
+        """
+        raster_cell_size: Size (in pixels) of the cells of the precomputed nearest-actuator raster.
+            Can be overwritten by 'actuator_raster_cell_size' in the camera config. None disables the raster.
+        raster_max_error: Maximum tolerated error (in comb units) of the actuator distances looked up in the raster.
+            If the error bound of the raster is larger, the raster is not used and the nearest actuators are
+            always computed exactly. Can be overwritten by 'actuator_raster_max_error' in the camera config.
+            None accepts any error.
+        """
         
         self.print_fn = print_fn
         self.actuators = []
@@ -30,12 +58,79 @@ class CombMapper:
             assert "right" in origin
             self.origin_x = "right"
 
-        self.homography, _ = cv2.findHomography(
+        self.homography = find_homography(
             self.pixel_coordinates, self.unit_coordinates
         )
+        self.homography_rows = self.homography.tolist()
+        self.actuator_coordinates = np.array(self.actuators, dtype=np.float64).reshape(-1, 2)
 
         self.azimuth_updater = azimuth_updater
 
+        self.raster_cell_size = config.get("actuator_raster_cell_size", raster_cell_size)
+        self.raster_max_error = config.get("actuator_raster_max_error", raster_max_error)
+        self.actuator_raster_indices = None
+        self.raster_error_bound = None
+        if self.raster_cell_size and self.actuator_coordinates.shape[0] > 0:
+            self.build_actuator_raster()
+
+            if self.raster_max_error is not None and self.raster_error_bound > self.raster_max_error:
+                self.print_fn("Actuator raster error bound ({:1.3f}) exceeds the maximum error ({:1.3f}). Not using it.",
+                    self.raster_error_bound, self.raster_max_error)
+                self.actuator_raster_indices = None
+
+    def find_nearest_actuators(self, comb_xy):
+        """Takes comb positions (N x 2) and returns the indices of and distances to the nearest actuators."""
+        distances = np.hypot(
+            comb_xy[:, 0:1] - self.actuator_coordinates[:, 0],
+            comb_xy[:, 1:2] - self.actuator_coordinates[:, 1])
+        sensor_indices = np.argmin(distances, axis=1)
+        min_distances = distances[np.arange(comb_xy.shape[0]), sensor_indices]
+        return sensor_indices, min_distances
+
+    def build_actuator_raster(self):
+        """Precomputes the nearest actuator for the center of every raster cell over the image.
+
+        The distance to the nearest actuator changes at most as much as the position on the comb. So the actuator
+        looked up for a position is at most twice the largest distance between a cell center and its corners on
+        the comb (the raster error bound) farther away than the actual nearest actuator.
+        """
+        cell_size = float(self.raster_cell_size)
+        width, height = self.get_image_shape()
+        n_cols, n_rows = int(np.ceil(width / cell_size)), int(np.ceil(height / cell_size))
+
+        center_xs, center_ys = np.meshgrid(
+            (np.arange(n_cols) + 0.5) * cell_size, (np.arange(n_rows) + 0.5) * cell_size)
+        centers = apply_homography(self.homography, center_xs.ravel(), center_ys.ravel())
+        sensor_indices, _ = self.find_nearest_actuators(centers)
+        self.actuator_raster_indices = sensor_indices.reshape(n_rows, n_cols).astype(np.int16)
+
+        corner_xs, corner_ys = np.meshgrid(np.arange(n_cols + 1) * cell_size, np.arange(n_rows + 1) * cell_size)
+        corners = apply_homography(self.homography, corner_xs.ravel(), corner_ys.ravel()).reshape(n_rows + 1, n_cols + 1, 2)
+        centers = centers.reshape(n_rows, n_cols, 2)
+        max_radius = 0.0
+        for (row_offset, col_offset) in ((0, 0), (0, 1), (1, 0), (1, 1)):
+            cell_corners = corners[row_offset:row_offset + n_rows, col_offset:col_offset + n_cols]
+            radius = np.hypot(*np.moveaxis(cell_corners - centers, -1, 0))
+            max_radius = max(max_radius, float(np.max(radius)))
+        self.raster_error_bound = 2.0 * max_radius
+
+        self.print_fn("Precomputed actuator raster with {}x{} cells (error bound {:1.3f}).",
+            n_cols, n_rows, self.raster_error_bound)
+
+    def lookup_actuator_raster(self, xs, ys):
+        """Takes image positions and returns the raster's actuator indices.
+
+        Also returns a mask of the positions that lie within the raster. Other indices are not valid.
+        """
+        n_rows, n_cols = self.actuator_raster_indices.shape
+        with np.errstate(invalid="ignore"):
+            cols = np.floor(xs / self.raster_cell_size)
+            rows = np.floor(ys / self.raster_cell_size)
+            inside = (cols >= 0) & (cols < n_cols) & (rows >= 0) & (rows < n_rows)
+        cols = np.where(inside, cols, 0).astype(np.int64)
+        rows = np.where(inside, rows, 0).astype(np.int64)
+        return self.actuator_raster_indices[rows, cols].astype(np.int64), inside
+
     def get_actuator_metadata(self):
         return self.actuator_metadata
         
@@ -59,42 +154,100 @@ class CombMapper:
     def get_sensor_coordinates(self):
         return self.actuators
 
-    def map_to_comb(self, x, y, waggle_angle, find_sensor=True):
-        
-        waggle_offset_x = np.cos(waggle_angle)
-        waggle_offset_y = np.sin(waggle_angle)
+    def map_position_to_comb(self, x, y):
+        """Maps a single image position to the comb. Cheaper than map_to_comb_batch for one point."""
+        (h00, h01, h02), (h10, h11, h12), (h20, h21, h22) = self.homography_rows
+        w = h20 * x + h21 * y + h22
+        return (float((h00 * x + h01 * y + h02) / w), float((h10 * x + h11 * y + h12) / w))
+
+    def map_to_comb_batch(self, xs, ys, waggle_angles, find_sensor=True, timestamp=None):
+        """Maps arrays of image positions and waggle angles to the comb.
+
+        Returns the comb positions (N x 2), the gravity and world angles (using the azimuth at the given
+        timestamp, default: now) and (if find_sensor is set) the index of and distance to the nearest actuator.
+        """
+        xs = np.asarray(xs, dtype=np.float64).reshape(-1)
+        ys = np.asarray(ys, dtype=np.float64).reshape(-1)
+        waggle_angles = np.asarray(waggle_angles, dtype=np.float64).reshape(-1)
+
+        waggle_offset_x = np.cos(waggle_angles)
+        waggle_offset_y = np.sin(waggle_angles)
         if self.origin_y == "bottom":
             waggle_offset_y *= -1
         if self.origin_x == "right":
             waggle_offset_x *= -1
         # Note that it's -sin because the angle is currently in image coordinates (origin: top left).
-        xy = np.array([[x, y],[x + waggle_offset_x, y + waggle_offset_y ]]).reshape(2, 1, 2)
-        xy = cv2.perspectiveTransform(
-            xy, self.homography
-        )
-        
+        xy = apply_homography(self.homography, xs, ys)
+        xy_offset = apply_homography(self.homography, xs + waggle_offset_x, ys + waggle_offset_y)
+
         # Rotate angle, accounting for homography.
-        waggle_angle = xy[1] - xy[0]
-        wx, wy = list(waggle_angle.flatten())
-        waggle_angle = np.arctan2(wy, wx)
+        waggle_vector = xy_offset - xy
+        waggle_angles = np.arctan2(waggle_vector[:, 1], waggle_vector[:, 0])
         # To gravity-angle. (0 top, counter-clockwise).
-        waggle_angle -= np.pi / 2.0
-
-        waggle_angle = waggle_angle % (2.0 * np.pi)
-        world_angle = (self.azimuth_updater.get_azimuth() + waggle_angle) % (2.0 * np.pi)
+        waggle_angles -= np.pi / 2.0
 
-        xy = xy[:1].flatten()
+        waggle_angles = waggle_angles % (2.0 * np.pi)
+        world_angles = (self.azimuth_updater.get_azimuth(at=timestamp) + waggle_angles) % (2.0 * np.pi)
 
         if not find_sensor:
-            return xy, (waggle_angle, world_angle), None
+            return xy, (waggle_angles, world_angles), None
+
+        if self.actuator_coordinates.shape[0] == 0:
+            return xy, (waggle_angles, world_angles), (
+                np.full(xy.shape[0], None, dtype=object), np.full(xy.shape[0], np.inf))
+
+        if self.actuator_raster_indices is None:
+            sensor_indices, min_distances = self.find_nearest_actuators(xy)
+            return xy, (waggle_angles, world_angles), (sensor_indices, min_distances)
 
-        x, y = xy
-        min_distance = np.inf
-        sensor_index = None
+        sensor_indices, inside = self.lookup_actuator_raster(xs, ys)
+        selected_actuators = self.actuator_coordinates[sensor_indices]
+        min_distances = np.hypot(xy[:, 0] - selected_actuators[:, 0], xy[:, 1] - selected_actuators[:, 1])
+        if not np.all(inside):
+            # Positions outside of the raster are computed exactly.
+            sensor_indices[~inside], min_distances[~inside] = self.find_nearest_actuators(xy[~inside])
+
+        return xy, (waggle_angles, world_angles), (sensor_indices, min_distances)
+
+    def find_nearest_actuator(self, comb_x, comb_y):
+        """Returns the index of and distance to the nearest actuator of a single comb position."""
+        sensor_index, min_distance = None, np.inf
         for idx, (ax, ay) in enumerate(self.actuators):
-            distance = math.sqrt((ax - x) ** 2.0 + (ay - y) ** 2.0)
+            distance = math.hypot(ax - comb_x, ay - comb_y)
             if distance < min_distance:
-                min_distance = distance
-                sensor_index = idx
+                sensor_index, min_distance = idx, distance
+        return sensor_index, min_distance
+
+    def map_to_comb(self, x, y, waggle_angle, find_sensor=True, timestamp=None):
+        """Maps a single image position and waggle angle to the comb, like map_to_comb_batch.
+
+        Uses plain floats, which is much cheaper than the batch version for a single waggle.
+        """
+        comb_x, comb_y = self.map_position_to_comb(x, y)
+
+        waggle_offset_x = math.cos(waggle_angle)
+        waggle_offset_y = math.sin(waggle_angle)
+        if self.origin_y == "bottom":
+            waggle_offset_y *= -1
+        if self.origin_x == "right":
+            waggle_offset_x *= -1
+        offset_x, offset_y = self.map_position_to_comb(x + waggle_offset_x, y + waggle_offset_y)
+
+        # Rotate angle, accounting for homography. To gravity-angle (0 top, counter-clockwise).
+        waggle_angle = (math.atan2(offset_y - comb_y, offset_x - comb_x) - np.pi / 2.0) % (2.0 * np.pi)
+        world_angle = (self.azimuth_updater.get_azimuth(at=timestamp) + waggle_angle) % (2.0 * np.pi)
+
+        xy = np.array([comb_x, comb_y])
+        if not find_sensor:
+            return xy, (waggle_angle, world_angle), None
+
+        if self.actuator_raster_indices is not None:
+            n_rows, n_cols = self.actuator_raster_indices.shape
+            col, row = x / self.raster_cell_size, y / self.raster_cell_size
+            if 0.0 <= col < n_cols and 0.0 <= row < n_rows:
+                sensor_index = int(self.actuator_raster_indices[int(row), int(col)])
+                ax, ay = self.actuators[sensor_index]
+                return xy, (waggle_angle, world_angle), (sensor_index, math.hypot(ax - comb_x, ay - comb_y))
 
-        return xy, (waggle_angle, world_angle), (sensor_index, min_distance)
+        # Positions outside of the raster are computed exactly.
+        return xy, (waggle_angle, world_angle), self.find_nearest_actuator(comb_x, comb_y)
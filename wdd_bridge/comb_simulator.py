@@ -0,0 +1,145 @@
+import json
+import os
+import select
+import termios
+import threading
+import time
+import tty
+
+from .comb_connector import SERIAL_BITS_PER_CHARACTER
+
+
+class CombSimulator:
+    """Simulates the comb's firmware on a pseudo-terminal, so that CombConnector can be run against it.
+
+    The serial commands (LEDS, TRIG, STOP_TRIG, MUX) are parsed like the board does. Every command keeps the
+    simulated board busy for its transmission time at the configured baud rate plus a fixed processing time.
+    All resulting states are recorded with timestamps.
+    """
+
+    def __init__(self, baudrate=9600, command_processing_time=0.002, print_fn=None):
+
+        self.baudrate = baudrate
+        self.character_duration = SERIAL_BITS_PER_CHARACTER / baudrate
+        self.command_processing_time = command_processing_time
+        self.print_fn = print_fn or (lambda _: None)
+
+        self.master_fd, self.slave_fd = os.openpty()
+        self.port = os.ttyname(self.slave_fd)
+        self.configure_terminal()
+
+        self.leds = 0
+        # Sound file per soundboard, 11 means stopped.
+        self.soundboard_state = [11, 11]
+        # Signal selected for each actuator, 0 means disconnected.
+        self.actuator_signals = [0] * 8
+
+        self.trace = []
+        self.n_commands = 0
+        self.n_invalid_commands = 0
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def configure_terminal(self):
+        """Sets up the terminal like the comb's serial port (7 data bits, odd parity, two stop bits)."""
+        tty.setraw(self.slave_fd)
+        attributes = termios.tcgetattr(self.slave_fd)
+        attributes[2] &= ~termios.CSIZE
+        attributes[2] |= termios.CS7 | termios.PARENB | termios.PARODD | termios.CSTOPB
+        speed = getattr(termios, "B{}".format(self.baudrate), termios.B9600)
+        attributes[4] = attributes[5] = speed
+        termios.tcsetattr(self.slave_fd, termios.TCSANOW, attributes)
+
+    def get_port(self):
+        return self.port
+
+    def get_active_actuators(self):
+        """Actuators linked to a signal of a soundboard that is currently playing.
+
+        Signals 1 and 2 are the channels of soundboard 0, 3 and 4 the ones of soundboard 1.
+        """
+        active = []
+        for index, signal in enumerate(self.actuator_signals):
+            if signal == 0:
+                continue
+            if self.soundboard_state[(signal - 1) // 2] != 11:
+                active.append(index)
+        return active
+
+    def process_command(self, line):
+        command = line.split()
+        if len(command) == 0:
+            return
+
+        try:
+            name, arguments = command[0], [int(a) for a in command[1:]]
+            if name == "LEDS" and len(arguments) == 1:
+                self.leds = arguments[0]
+            elif name == "TRIG" and len(arguments) == 2:
+                self.soundboard_state = arguments
+            elif name == "STOP_TRIG" and len(arguments) == 0:
+                self.soundboard_state = [11, 11]
+            elif name == "MUX" and len(arguments) == 2:
+                self.actuator_signals[arguments[0]] = arguments[1]
+            else:
+                raise ValueError("unknown command")
+        except (ValueError, IndexError) as e:
+            self.n_invalid_commands += 1
+            self.print_fn("Simulator: Invalid command '{}' ({}).".format(line, str(e)))
+            return
+
+        self.n_commands += 1
+        self.trace.append(dict(
+            timestamp=time.time(),
+            monotonic_timestamp=time.monotonic(),
+            command=line,
+            leds=self.leds,
+            soundboard_state=list(self.soundboard_state),
+            actuator_signals=list(self.actuator_signals),
+            active_actuators=self.get_active_actuators(),
+        ))
+
+    def run(self):
+        buffer = b""
+        board_ready_at = time.monotonic()
+
+        while self.running:
+            try:
+                # Time out regularly, so the simulator can be stopped.
+                readable, _, _ = select.select([self.master_fd], [], [], 0.5)
+                if not readable:
+                    continue
+                data = os.read(self.master_fd, 1024)
+            except OSError:
+                break
+            if not data:
+                break
+
+            buffer += data
+            # The connector terminates lines with "\n\r".
+            buffer = buffer.replace(b"\r", b"")
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+
+                # The board handles one command after another.
+                board_ready_at = max(board_ready_at, time.monotonic()) \
+                    + (len(line) + 2) * self.character_duration + self.command_processing_time
+                delay = board_ready_at - time.monotonic()
+                if delay > 0.0:
+                    time.sleep(delay)
+
+                self.process_command(line.decode("utf-8", errors="replace").strip().upper())
+
+    def write_trace(self, filename):
+        with open(filename, "w") as f:
+            for entry in self.trace:
+                f.write(json.dumps(entry) + "\n")
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        for fd in (self.slave_fd, self.master_fd):
+            os.close(fd)
@@ -1,58 +1,139 @@
+import bisect
+import collections
+import heapq
 import math
 import numpy as np
-import pandas
-import scipy.stats
+import time
+
+class AngleConsensus:
+    """Maintains the exact maximum-inlier consensus of a growing set of angles.
+
+    An angle is an inlier of a consensus angle if their circular difference is below the inlier cutoff.
+    The largest inlier set thus is the largest set of angles fitting into an arc shorter than twice the cutoff.
+    The angles are kept sorted, so that such an arc can be found with a sliding window over the circle.
+    The sums of sin and cos of the best arc are updated as long as it does not move.
+    """
+
+    def __init__(self, inlier_cutoff=np.pi/4.0):
+        self.inlier_cutoff = inlier_cutoff
+        self.arc_length = 2.0 * inlier_cutoff
+
+        self.first_angle = None
+        self.n_angles = 0
+        # Valid angles, normalized to [0, 2 * np.pi) and sorted.
+        self.sorted_angles = []
+
+        # The best arc starts at an angle and covers [best_arc_start, best_arc_start + arc_length).
+        # Ties are broken by the smallest start, so the result does not depend on the insertion order.
+        self.best_arc_start = None
+        self.max_inliers = 0
+        # Sums of sin and cos of the inliers of the best arc, None if they have to be recomputed.
+        self.best_arc_sums = None
+
+    def count_arc(self, start):
+        angles = self.sorted_angles
+        if self.arc_length >= 2.0 * np.pi:
+            return len(angles)
+
+        end = start + self.arc_length
+        first = bisect.bisect_left(angles, start)
+        if end <= 2.0 * np.pi:
+            return bisect.bisect_left(angles, end) - first
+        return (len(angles) - first) + bisect.bisect_left(angles, end - 2.0 * np.pi)
+
+    def get_arc_starts_containing(self, angle):
+        """Returns all stored angles whose arc contains the given angle."""
+        angles = self.sorted_angles
+        if self.arc_length >= 2.0 * np.pi:
+            return angles
+
+        start = angle - self.arc_length
+        last = bisect.bisect_right(angles, angle)
+        if start >= 0.0:
+            return angles[bisect.bisect_right(angles, start):last]
+        return angles[bisect.bisect_right(angles, start + 2.0 * np.pi):] + angles[:last]
+
+    def add(self, angle):
+        self.n_angles += 1
+        if self.first_angle is None:
+            self.first_angle = angle
+
+        if angle is None or math.isnan(angle):
+            return
+
+        angle = angle % (2.0 * np.pi)
+        if angle >= 2.0 * np.pi:
+            # Tiny negative angles can round up to 2 * np.pi.
+            angle = 0.0
+        bisect.insort(self.sorted_angles, angle)
+
+        # Only the arcs containing the new angle gained an inlier.
+        previous_start, previous_max_inliers = self.best_arc_start, self.max_inliers
+        for arc_start in self.get_arc_starts_containing(angle):
+            n_inliers = self.count_arc(arc_start)
+            if n_inliers > self.max_inliers or (n_inliers == self.max_inliers and arc_start < self.best_arc_start):
+                self.max_inliers = n_inliers
+                self.best_arc_start = arc_start
+
+        if self.best_arc_start != previous_start:
+            self.best_arc_sums = None
+        elif self.max_inliers > previous_max_inliers and self.best_arc_sums is not None:
+            # The best arc stayed and gained the new angle.
+            sin_sum, cos_sum = self.best_arc_sums
+            self.best_arc_sums = (sin_sum + math.sin(angle), cos_sum + math.cos(angle))
+
+    def get_inliers(self):
+        if self.best_arc_start is None:
+            return []
+        if self.arc_length >= 2.0 * np.pi:
+            return list(self.sorted_angles)
+
+        angles = self.sorted_angles
+        start = self.best_arc_start
+        end = start + self.arc_length
+        first = bisect.bisect_left(angles, start)
+        if end <= 2.0 * np.pi:
+            return angles[first:bisect.bisect_left(angles, end)]
+        return angles[first:] + angles[:bisect.bisect_left(angles, end - 2.0 * np.pi)]
+
+    def get_consensus(self):
+        """Returns the circular mean of the largest inlier set and the number of inliers."""
+
+        # Special cases.
+        if self.n_angles < 2:
+            # No use performing any consensus on a small set.
+            return self.first_angle, 1
+
+        if self.max_inliers == 0:
+            return self.first_angle, 1
+
+        if self.best_arc_sums is None:
+            inliers = self.get_inliers()
+            self.best_arc_sums = (sum(math.sin(a) for a in inliers), sum(math.cos(a) for a in inliers))
+        sin_sum, cos_sum = self.best_arc_sums
+        consensus_angle = math.atan2(sin_sum, cos_sum) % (2.0 * np.pi)
+
+        return consensus_angle, self.max_inliers
 
 def calculate_angle_consensus(all_angles, inlier_cutoff=np.pi/4.0, verbose=False):
-    """Takes angles in radians. Performs RANSAC and returns consensus angle.
+    """Takes angles in radians. Finds the largest set of inliers and returns their mean angle.
     """
-    
-    all_angles = np.array(all_angles)
 
-    # Special cases.
-    if all_angles.shape[0] < 2:
-        # No use performing any consensus on a small set.
-        return all_angles[0], 1
-    
-    # Normalize angles to be [0, 2 * np.pi]
-    all_angles = (all_angles + 2.0 * np.pi) % (2.0 * np.pi)
-    
-    sample_indices = np.arange(all_angles.shape[0])
-    n_samples = all_angles.shape[0] * 4
-    
-    max_inliers = 0
-    max_inlier_consensus_angle = None
-    inlier_indices = None
-    
-    
-    for _sample_index in range(n_samples):
-        
-        samples = np.random.choice(sample_indices, size=2)
-        consensus_angle = scipy.stats.circmean(all_angles[samples])
-        
-        differences0 = np.abs(all_angles - consensus_angle)
-        differences1 = (2.0 * np.pi) - differences0
-        inliers = (differences0 < inlier_cutoff) | (differences1 < inlier_cutoff)
-        
-        n_inliers = np.sum(inliers)
-        if n_inliers > max_inliers:
-            max_inliers = n_inliers
-            max_inlier_consensus_angle = consensus_angle
-            inlier_indices = inliers
-            
-    if max_inliers == 0:
-        if verbose:
-            print("Could not find consensus at all.")
-        return all_angles[0], 1
-    
-    consensus_angle = scipy.stats.circmean(all_angles[inlier_indices])
+    consensus = AngleConsensus(inlier_cutoff=inlier_cutoff)
+    for angle in all_angles:
+        consensus.add(angle)
+
+    consensus_angle, max_inliers = consensus.get_consensus()
+
     if verbose:
-        print("Angle consensus with {} inliers ({:1.1f}° [{:1.1f}°]), {}.".format(
-            max_inliers,
-            consensus_angle / np.pi * 180.0,
-            max_inlier_consensus_angle / np.pi * 180.0,
-            list(all_angles[inlier_indices] / np.pi * 180.0)))
-        
+        if consensus.max_inliers == 0:
+            print("Could not find consensus at all.")
+        else:
+            print("Angle consensus with {} inliers ({:1.1f}°), {}.".format(
+                max_inliers,
+                consensus_angle / np.pi * 180.0,
+                [a / np.pi * 180.0 for a in consensus.get_inliers()]))
+
     return consensus_angle, max_inliers
 
 class Waggle:
@@ -65,9 +146,17 @@ class Waggle:
         self.cam_id = cam_id
         self.uuid = uuid
 
+        # Time (time.monotonic) at which the waggle passed each stage of the bridge (see latency.STAGES).
+        self.stage_timestamps = dict()
+        # Seconds between the detection on the WDD machine and the waggle's arrival, if known.
+        self.detection_delay = None
+
 
 class Dance:
-    def __init__(self):
+    def __init__(self, index=None):
+
+        # Dances are matched to waggles in the order they were opened.
+        self.index = index
 
         self.coords = []
         self.angles = []
@@ -75,6 +164,9 @@ class Dance:
         self.timestamps = []
         self.triggered = 0
         self.waggle_ids = []
+        # (x, y, raw angle) of each waggle in comb coordinates, if the detector has a position_fn.
+        self.comb_points = []
+        self.angle_consensus = AngleConsensus()
 
         self._dance_angle = None
         self._n_inliers = None
@@ -100,6 +192,7 @@ class Dance:
 
         self.coords.append((waggle.x, waggle.y))
         self.angles.append(waggle.angle)
+        self.angle_consensus.add(waggle.angle)
         self.durations.append(waggle.duration)
         self.timestamps.append(waggle.timestamp)
         self.waggle_ids.append(waggle.uuid)
@@ -112,7 +205,7 @@ class Dance:
 
     def _ensure_dance_angle(self):
         if self._dance_angle is None:
-            self._dance_angle, self._n_inliers = calculate_angle_consensus(self.angles)
+            self._dance_angle, self._n_inliers = self.angle_consensus.get_consensus()
 
     def get_dance_angle(self):
         self._ensure_dance_angle()
@@ -123,8 +216,8 @@ class Dance:
         return self._n_inliers
 
     def get_waggle_duration(self):
-        durations = np.array(self.durations)
-        durations = durations[~pandas.isnull(durations)]
+        durations = np.array([d for d in self.durations if d is not None], dtype=np.float64)
+        durations = durations[~np.isnan(durations)]
         if durations.shape[0] == 0:
             return np.nan
         return np.median(durations)
@@ -132,6 +225,58 @@ class Dance:
     def get_first_waggle_id(self):
         return self.waggle_ids[0]
 
+class SpatialGrid:
+    """Uniform grid over the waggle positions of the open dances.
+
+    With the cell size set to the maximum waggle distance, all waggles close enough to
+    a position are contained in the position's cell and its eight neighbours.
+    """
+
+    def __init__(self, cell_size):
+        if not cell_size > 0:
+            raise ValueError("The cell size of the grid has to be positive (got {}).".format(cell_size))
+        self.cell_size = cell_size
+        # Maps a cell to the coordinates of each dance within that cell.
+        self.cells = collections.defaultdict(dict)
+
+    def get_cell(self, x, y):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def add(self, dance, x, y):
+        self.cells[self.get_cell(x, y)].setdefault(dance, []).append((x, y))
+
+    def remove(self, dance):
+        for (x, y) in dance.coords:
+            cell = self.get_cell(x, y)
+            dances = self.cells.get(cell)
+            if dances is None:
+                continue
+            dances.pop(dance, None)
+            if len(dances) == 0:
+                del self.cells[cell]
+
+    def get_nearby_dances(self, x, y):
+        """Returns all dances with at least one waggle within cell_size of (x, y)."""
+        cell_x, cell_y = self.get_cell(x, y)
+        nearby_dances = set()
+
+        for neighbour_x in (cell_x - 1, cell_x, cell_x + 1):
+            for neighbour_y in (cell_y - 1, cell_y, cell_y + 1):
+                dances = self.cells.get((neighbour_x, neighbour_y))
+                if dances is None:
+                    continue
+
+                for dance, coords in dances.items():
+                    if dance in nearby_dances:
+                        continue
+                    for (cx, cy) in coords:
+                        distance = math.sqrt((cx - x) ** 2.0 + (cy - y) ** 2.0)
+                        if distance <= self.cell_size:
+                            nearby_dances.add(dance)
+                            break
+
+        return nearby_dances
+
 class DanceDetector:
     def __init__(
         self,
@@ -140,68 +285,170 @@ class DanceDetector:
         waggle_min_count=3,
         print_fn=None,
         log_fn=None,
+        position_fn=None,
     ):
+        """
+        position_fn: Maps the image position (x, y) of a waggle to any other coordinates (e.g. on the comb).
+            If given, the mapped position of every waggle is stored in Dance.comb_points when it is added.
+        """
 
         self.waggle_max_distance = waggle_max_distance
         self.waggle_max_gap = waggle_max_gap
         self.waggle_min_count = waggle_min_count
 
-        self.open_dances = []
+        # Maps the index of a dance to the dance, in the order they were opened.
+        self.open_dances = dict()
+        self.dance_counter = 0
+        self.grid = SpatialGrid(cell_size=waggle_max_distance)
+        # Min-heap of (last waggle timestamp, dance index). Entries of dances that have since
+        # been continued or removed are left in place and skipped when popped.
+        self.expiry_heap = []
+        # Latest timestamp of any added waggle. Only waggles before it can end after a dance.
+        self.latest_timestamp = None
         self.print_fn = print_fn
         self.log_fn = log_fn
+        self.position_fn = position_fn
 
     def get_dance_positions(self):
         positions = []
-        for dance in self.open_dances:
+        for dance in self.open_dances.values():
             positions.append(list(zip(dance.coords, dance.angles)))
         return positions
 
-    def process(self, waggle):
-
-        indices_to_delete = []
-
-        added = False
-
-        for idx, dance in enumerate(self.open_dances):
-            last_waggle_timestamp = dance.get_last_timestamp()
-            offset = (waggle.timestamp - last_waggle_timestamp).total_seconds()
-            if offset > self.waggle_max_gap or offset < 0:
-                indices_to_delete.append(idx)
+    def get_comb_dance_points(self, cursors):
+        """Returns (dance index, index of the first new point, new comb points) of all open dances.
+
+        cursors maps a dance index to the number of its points that were already returned and is updated.
+        The points of a dance are only ever appended, so only the points added since the last call are copied.
+        """
+        dances = []
+        for dance in self.open_dances.values():
+            start = cursors.get(dance.index, 0)
+            dances.append((dance.index, start, dance.comb_points[start:]))
+            cursors[dance.index] = len(dance.comb_points)
+        if len(cursors) > len(dances):
+            for index in [index for index in cursors if index not in self.open_dances]:
+                del cursors[index]
+        return dances
+
+    def add_waggle_to_dance(self, dance, waggle):
+        dance.append(waggle)
+        if self.position_fn is not None:
+            comb_x, comb_y = self.position_fn(waggle.x, waggle.y)
+            dance.comb_points.append((comb_x, comb_y, waggle.angle))
+        self.grid.add(dance, waggle.x, waggle.y)
+        heapq.heappush(self.expiry_heap, (dance.get_last_timestamp(), dance.index))
+        if self.latest_timestamp is None or waggle.timestamp > self.latest_timestamp:
+            self.latest_timestamp = waggle.timestamp
+
+    def remove_dance(self, dance):
+        self.grid.remove(dance)
+        del self.open_dances[dance.index]
+
+    def expire_dances(self, timestamp):
+        """Removes all dances whose last waggle is more than waggle_max_gap seconds older than the timestamp.
+
+        Returns the number of removed dances.
+        """
+        n_expired = 0
+        while len(self.expiry_heap) > 0:
+            last_waggle_timestamp, index = self.expiry_heap[0]
+            if (timestamp - last_waggle_timestamp).total_seconds() <= self.waggle_max_gap:
+                break
+            heapq.heappop(self.expiry_heap)
+
+            dance = self.open_dances.get(index, None)
+            if dance is None or dance.get_last_timestamp() != last_waggle_timestamp:
                 continue
 
-            if dance.get_min_distance(waggle.x, waggle.y) > self.waggle_max_distance:
+            self.remove_dance(dance)
+            n_expired += 1
+
+        return n_expired
+
+    def remove_dances_out_of_range(self, timestamp, before_index=None):
+        """Removes the dances whose last waggle is more than waggle_max_gap seconds before or any time after
+        the timestamp. If before_index is given, only dances opened before that dance are removed.
+        """
+        # Dances that ended too long ago are at the top of the expiry heap.
+        kept_entries = []
+        while len(self.expiry_heap) > 0:
+            last_waggle_timestamp, index = self.expiry_heap[0]
+            if (timestamp - last_waggle_timestamp).total_seconds() <= self.waggle_max_gap:
+                break
+            entry = heapq.heappop(self.expiry_heap)
+
+            dance = self.open_dances.get(index, None)
+            if dance is None or dance.get_last_timestamp() != last_waggle_timestamp:
                 continue
+            if before_index is not None and index >= before_index:
+                kept_entries.append(entry)
+                continue
+            self.remove_dance(dance)
+
+        for entry in kept_entries:
+            heapq.heappush(self.expiry_heap, entry)
+
+        # Dances can only end after the timestamp if the waggles arrive out of order.
+        if self.latest_timestamp is None or timestamp >= self.latest_timestamp:
+            return
+        newer_dances = []
+        for index, dance in self.open_dances.items():
+            if before_index is not None and index >= before_index:
+                break
+            if dance.get_last_timestamp() > timestamp:
+                newer_dances.append(dance)
+        for dance in newer_dances:
+            self.remove_dance(dance)
 
-            dance.append(waggle)
-            if len(dance) >= self.waggle_min_count:
-                dance_angle = dance.get_dance_angle()
-                dance_duration = dance.get_waggle_duration()
-                n_inliers = dance.get_dance_angle_inliers()
-
-                if n_inliers >= self.waggle_min_count:
-                    dance.trigger()
-
-                    self.log_fn(
-                        "detected dance",
-                        first_waggle=dance.get_first_timestamp(),
-                        last_timestamp=dance.get_last_timestamp(),
-                        dance_angle=float(dance_angle), dance_angle_inliers=int(n_inliers),
-                        waggle_duration=float(dance_duration),
-                        cam_id=waggle.cam_id,
-                        waggle_index=len(dance),
-                        waggle_ids=dance.waggle_ids
-                    )
-
-                    yield (waggle.x, waggle.y, dance_angle, dance_duration, dance.get_first_waggle_id())
-
-
-            added = True
-            break
-
-        for idx in indices_to_delete[::-1]:
-            del self.open_dances[idx]
+    def process(self, waggle):
 
-        if not added:
-            dance = Dance()
-            dance.append(waggle)
-            self.open_dances.append(dance)
+        # Same result as scanning the open dances in the order they were opened: the waggle continues the first
+        # nearby dance that ended at most waggle_max_gap before it. The dances scanned before that one (or all,
+        # if none matches) that ended too long before or after the waggle are removed.
+        nearby_dances = self.grid.get_nearby_dances(waggle.x, waggle.y)
+        matched_dance = None
+
+        for dance in sorted(nearby_dances, key=lambda d: d.index):
+            offset = (waggle.timestamp - dance.get_last_timestamp()).total_seconds()
+            if 0 <= offset <= self.waggle_max_gap:
+                matched_dance = dance
+                break
+
+        self.remove_dances_out_of_range(
+            waggle.timestamp, before_index=None if matched_dance is None else matched_dance.index)
+
+        if matched_dance is None:
+            dance = Dance(index=self.dance_counter)
+            self.dance_counter += 1
+            self.open_dances[dance.index] = dance
+            self.add_waggle_to_dance(dance, waggle)
+            waggle.stage_timestamps["clustered"] = time.monotonic()
+            return
+
+        dance = matched_dance
+        self.add_waggle_to_dance(dance, waggle)
+        if len(dance) >= self.waggle_min_count:
+            dance_angle = dance.get_dance_angle()
+            dance_duration = dance.get_waggle_duration()
+            n_inliers = dance.get_dance_angle_inliers()
+
+            if n_inliers >= self.waggle_min_count:
+                dance.trigger()
+
+                self.log_fn(
+                    "detected dance",
+                    first_waggle=dance.get_first_timestamp(),
+                    last_timestamp=dance.get_last_timestamp(),
+                    dance_angle=float(dance_angle), dance_angle_inliers=int(n_inliers),
+                    waggle_duration=float(dance_duration),
+                    cam_id=waggle.cam_id,
+                    waggle_index=len(dance),
+                    waggle_ids=dance.waggle_ids
+                )
+
+                waggle.stage_timestamps["clustered"] = time.monotonic()
+                yield (waggle.x, waggle.y, dance_angle, dance_duration, dance.get_first_waggle_id(), dance.get_last_timestamp())
+                return
+
+        waggle.stage_timestamps["clustered"] = time.monotonic()
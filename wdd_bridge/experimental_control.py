@@ -1,23 +1,165 @@
+import bisect
+import collections
 import copy
 import datetime
+import math
 import numpy as np
-import pandas
 import pytz
 
 
+class RuleDecision:
+    """The precompiled outcome of a set of rules: what is printed and logged and which keys are passed to the message."""
+
+    def __init__(self, effects, mapping_keys):
+        # List of ("print" | "log", text) in the order they happen.
+        self.effects = effects
+        # None if no message should be sent.
+        self.mapping_keys = mapping_keys
+
+    def apply(self, message_factory, print_fn, log_fn):
+        for kind, text in self.effects:
+            if kind == "print":
+                print_fn(text)
+            else:
+                log_fn(text)
+
+        if self.mapping_keys is None:
+            return None
+        return message_factory(dict(self.mapping_keys))
+
+class TimeSlot:
+    """The rules active during a period of time in which the schedule does not change.
+
+    The decisions are precompiled per angular bin. Bins containing the tolerance boundary of a rule are
+    decided exactly for every message.
+    """
+
+    def __init__(self, rules, tolerance_rad, n_angle_bins=3600):
+
+        self.rules = rules
+        self.tolerance_rad = tolerance_rad
+        self.concrete_rules = [rule for rule in rules if not math.isnan(rule["angle_rad"])]
+        self.general_rules = [rule for rule in rules if math.isnan(rule["angle_rad"])]
+
+        # Decisions by the indices of the matching concrete rules.
+        self.decisions = dict()
+
+        self.n_angle_bins = n_angle_bins
+        self.bin_width = 2.0 * np.pi / n_angle_bins
+
+        # Mark bins which contain a tolerance boundary (with some margin for rounding errors).
+        ambiguous_bins = {0, n_angle_bins - 1}
+        margin = 1e-9
+        for rule in self.concrete_rules:
+            for boundary in (rule["angle_rad"] - tolerance_rad, rule["angle_rad"] + tolerance_rad):
+                boundary = boundary % (2.0 * np.pi)
+                first_bin = math.floor((boundary - margin) / self.bin_width)
+                last_bin = math.floor((boundary + margin) / self.bin_width)
+                for bin_index in range(first_bin, last_bin + 1):
+                    ambiguous_bins.add(bin_index % n_angle_bins)
+
+        # Match all bin centers against all concrete rules at once (like get_matching_rule_indices).
+        # The matching rules only change at the edges of the rules, so one decision is compiled per run of
+        # bins with the same matching rules.
+        bin_centers = (np.arange(n_angle_bins) + 0.5) * self.bin_width
+        rule_angles = np.array([rule["angle_rad"] for rule in self.concrete_rules], dtype=np.float64)
+        diff0 = np.abs(rule_angles[:, None] - bin_centers[None, :])
+        matches = (diff0 < tolerance_rad) | (((2.0 * np.pi) - diff0) < tolerance_rad)
+        run_starts = np.concatenate(([0], 1 + np.flatnonzero(np.any(matches[:, 1:] != matches[:, :-1], axis=0))))
+
+        # Index into bin_decision_list for every bin, -1 for the ambiguous ones.
+        self.bin_decision_list = [
+            self.get_decision_for_indices(tuple(np.flatnonzero(matches[:, start]).tolist())) for start in run_starts]
+        self.bin_decision_indices = np.repeat(
+            np.arange(len(run_starts), dtype=np.int32), np.diff(np.append(run_starts, n_angle_bins)))
+        self.bin_decision_indices[sorted(ambiguous_bins)] = -1
+
+    def get_matching_rule_indices(self, world_angle):
+        matches = []
+        for index, rule in enumerate(self.concrete_rules):
+            diff0 = abs(rule["angle_rad"] - world_angle)
+            diff1 = (2.0 * np.pi) - diff0
+            if (diff0 < self.tolerance_rad) or (diff1 < self.tolerance_rad):
+                matches.append(index)
+        return tuple(matches)
+
+    def get_decision_for_indices(self, matching_indices):
+        decision = self.decisions.get(matching_indices, None)
+        if decision is None:
+            decision = self.compile_decision([self.concrete_rules[i] for i in matching_indices])
+            self.decisions[matching_indices] = decision
+        return decision
+
+    def get_decision_for_angle(self, world_angle):
+        return self.get_decision_for_indices(self.get_matching_rule_indices(world_angle))
+
+    def get_decision(self, world_angle):
+        """Takes a world angle in [0, 2 * np.pi)."""
+        bin_index = min(int(world_angle / self.bin_width), self.n_angle_bins - 1)
+        decision_index = self.bin_decision_indices[bin_index]
+        if decision_index < 0:
+            return self.get_decision_for_angle(world_angle)
+        return self.bin_decision_list[decision_index]
+
+    def compile_decision(self, concrete_rules):
+
+        effects = []
+
+        def handle_action_set(rules):
+
+            # Rules can contain specific identifiers for soundboards/soundfiles.
+            mapping_keys = dict()
+            for rule in rules:
+                keys = rule["all_keys"]
+                # Sanity check:
+                for k, v in keys.items():
+                    if k in mapping_keys and mapping_keys[k] != v:
+                        effects.append(("print", "Warning: Two conflicting values for key {} ({} vs. {}).".format(
+                            k, v, mapping_keys[k])))
+
+                mapping_keys = {**mapping_keys, **keys}
+
+            action_set = set(rule["rule"] for rule in rules)
+            should_allow_message = "vibrate" in action_set
+            should_prevent_message = "no_vibrate" in action_set
+            if should_allow_message and should_prevent_message:
+                effects.append(("print", "Warning: Two concrete, opposing rules for this world angle."))
+            if should_prevent_message:
+                effects.append(("log", "prevented vibration"))
+                return True, None
+            elif should_allow_message:
+                effects.append(("log", "allowed vibration"))
+                return True, mapping_keys
+
+            return False, None
+
+        if len(concrete_rules) > 0:
+            handled, mapping_keys = handle_action_set(concrete_rules)
+            if handled:
+                return RuleDecision(effects, mapping_keys)
+
+        # Any general rules?
+        if len(self.general_rules) > 0:
+            handled, mapping_keys = handle_action_set(self.general_rules)
+            if handled:
+                return RuleDecision(effects, mapping_keys)
+
+        effects.append(("print", "Warning: No rule handled current experiment."))
+        return RuleDecision(effects, None)
+
 class ExperimentalControl:
 
-    def __init__(self, config, print_fn, log_fn):
-        
+    def __init__(self, config, print_fn, log_fn, max_compiled_slots=8):
+
         self.print_fn = print_fn
         self.log_fn = log_fn
-        
+
         self.tolerance_deg = config["tolerance_deg"]
         self.tolerance_rad = self.tolerance_deg / 180.0 * np.pi
 
-        timetable = []
+        self.timetable = []
         for slot_info in config["timeslots"]:
-            
+
             all_other_keys = copy.copy(slot_info)
             for required_key in ("from", "to", "rule"):
                 del all_other_keys[required_key]
@@ -30,86 +172,105 @@ class ExperimentalControl:
             timestamp_from = datetime.datetime.fromisoformat(slot_info["from"])
             timestamp_to = datetime.datetime.fromisoformat(slot_info["to"])
 
-            timetable.append(dict(
-                angle_rad=angle_deg / 180.0 * np.pi,
+            angle_rad = angle_deg / 180.0 * np.pi
+            if not math.isnan(angle_rad):
+                angle_rad = (angle_rad + 2.0 * np.pi) % (2.0 * np.pi)
+
+            self.timetable.append(dict(
+                angle_rad=angle_rad,
                 ts_from=timestamp_from.astimezone(pytz.UTC),
                 ts_to=timestamp_to.astimezone(pytz.UTC),
                 rule=slot_info["rule"],
                 all_keys=all_other_keys
             ))
 
-        self.timetable = pandas.DataFrame(timetable)
-        valid_angles = ~pandas.isnull(self.timetable.angle_rad)
-        self.timetable.loc[valid_angles, "angle_rad"] = (self.timetable.loc[valid_angles, "angle_rad"].values + 2.0 * np.pi) % (2.0 * np.pi)
+        # The schedule only changes at the start and end of a rule. Between two successive boundaries
+        # (and at each boundary, as rules are valid including their start and end) the active rules are fixed.
+        self.slot_boundaries = sorted(set(
+            [rule["ts_from"] for rule in self.timetable] + [rule["ts_to"] for rule in self.timetable]))
+        self.current_slot_index = None
+        self.current_slot = None
+        # Slots are compiled when the cursor reaches them. The most recently used ones are kept (by their
+        # active rules, so slots with the same rules share their compilation) for when the cursor moves back.
+        self.max_compiled_slots = max_compiled_slots
+        self.compiled_slots = collections.OrderedDict()
 
         today = datetime.datetime.now().astimezone(pytz.UTC).date()
         today_start = pytz.UTC.localize(datetime.datetime.combine(today, datetime.time(0)))
         today_end = today_start + datetime.timedelta(days=1)
-        today_rules = self.timetable[(
-            (self.timetable.ts_from >= today_start) & (self.timetable.ts_from < today_end)
-            | (self.timetable.ts_to >= today_start) & (self.timetable.ts_to < today_end)
-            | (self.timetable.ts_from < today_start) & (self.timetable.ts_to >= today_end))]
-        self.print_fn("Loaded {} experiment rules ({} valid today).".format(self.timetable.shape[0], today_rules.shape[0]))
+        today_rules = [rule for rule in self.timetable if (
+            (rule["ts_from"] >= today_start) and (rule["ts_from"] < today_end)
+            or (rule["ts_to"] >= today_start) and (rule["ts_to"] < today_end)
+            or (rule["ts_from"] < today_start) and (rule["ts_to"] >= today_end))]
+        self.print_fn("Loaded {} experiment rules ({} valid today).", len(self.timetable), len(today_rules))
 
-    def filter_message(self, message_factory, world_angle):
+    def is_in_slot(self, slot_index, timestamp):
+        """Even slot indices 2i are the periods before boundary i, odd indices 2i+1 are the boundaries themselves."""
+        boundaries = self.slot_boundaries
+        boundary_index = slot_index // 2
+        if slot_index % 2 == 1:
+            return timestamp == boundaries[boundary_index]
 
-        now = datetime.datetime.now().astimezone(pytz.UTC)
-        world_angle = (world_angle + 2.0 * np.pi) % (2.0 * np.pi)
+        if boundary_index > 0 and timestamp <= boundaries[boundary_index - 1]:
+            return False
+        if boundary_index < len(boundaries) and timestamp >= boundaries[boundary_index]:
+            return False
+        return True
 
-        current_ruleset = self.timetable[(self.timetable.ts_from <= now) & (self.timetable.ts_to >= now)]
-        if current_ruleset.empty:
-            self.print_fn("No rule set for current time.")
-            return message_factory(dict())
+    def find_slot_index(self, timestamp):
+        boundaries = self.slot_boundaries
+        boundary_index = bisect.bisect_left(boundaries, timestamp)
+        if boundary_index < len(boundaries) and boundaries[boundary_index] == timestamp:
+            return 2 * boundary_index + 1
+        return 2 * boundary_index
 
-        # Any rule for this specific angle?
-        concrete_indices = ~pandas.isnull(current_ruleset.angle_rad)
-        concrete_rules = current_ruleset[concrete_indices]
-        diff0 = np.abs(concrete_rules.angle_rad.values - world_angle)
-        diff1 = (2.0 * np.pi) - diff0
-        matches = (diff0 < self.tolerance_rad) | (diff1 < self.tolerance_rad)
-        concrete_rules = concrete_rules[matches]
+    def get_slot_rules(self, slot_index):
+        boundaries = self.slot_boundaries
+        boundary_index = slot_index // 2
+        if slot_index % 2 == 1:
+            timestamp = boundaries[boundary_index]
+            return [rule for rule in self.timetable if rule["ts_from"] <= timestamp and rule["ts_to"] >= timestamp]
 
-        def handle_action_set(rules, action_set):
-            
-            # Rules can contain specific identifiers for soundboards/soundfiles.
-            mapping_keys = dict()
-            for (keys,) in rules[["all_keys"]].itertuples(index=False):
-                # Sanity check:
-                for k, v in keys.items():
-                    if k in mapping_keys and mapping_keys[k] != "v":
-                        self.print_fn("Warning: Two conflicting values for key {} ({} vs. {}).".format(
-                            k, v, mapping_keys[k]))
-                        
-                mapping_keys = {**mapping_keys, **keys}
+        if boundary_index == 0 or boundary_index == len(boundaries):
+            return []
+        start, end = boundaries[boundary_index - 1], boundaries[boundary_index]
+        return [rule for rule in self.timetable if rule["ts_from"] <= start and rule["ts_to"] >= end]
 
-            action_set = set(action_set)
-            should_allow_message = "vibrate" in action_set
-            should_prevent_message = "no_vibrate" in action_set
-            if should_allow_message and should_prevent_message:
-                self.print_fn("Warning: Two concrete, opposing rules for this world angle.")
-            if should_prevent_message:
-                self.log_fn("prevented vibration")
-                return True, None
-            elif should_allow_message:
-                self.log_fn("allowed vibration")
-                return True, message_factory(mapping_keys)
-            
-            return False, None
+    def get_compiled_slot(self, slot_index):
+        rules = self.get_slot_rules(slot_index)
+        key = tuple(id(rule) for rule in rules)
+        time_slot = self.compiled_slots.get(key, None)
+        if time_slot is not None:
+            self.compiled_slots.move_to_end(key)
+            return time_slot
 
-        if not concrete_rules.empty:
-            
-            handled, message = handle_action_set(concrete_rules, concrete_rules.rule.values)
-            if handled:
-                return message
+        time_slot = TimeSlot(rules, self.tolerance_rad)
+        self.compiled_slots[key] = time_slot
+        if len(self.compiled_slots) > self.max_compiled_slots:
+            self.compiled_slots.popitem(last=False)
+        return time_slot
 
-        # Any general rules?
-        general_rules = current_ruleset[~concrete_indices]
-        if not general_rules.empty:
-            handled, message = handle_action_set(general_rules, general_rules.rule.values)
-            if handled:
-                return message
+    def get_current_slot(self, now):
+        # Only move the cursor when leaving the current slot.
+        if self.current_slot_index is None or not self.is_in_slot(self.current_slot_index, now):
+            slot_index = self.find_slot_index(now)
+            if slot_index != self.current_slot_index:
+                self.current_slot_index = slot_index
+                self.current_slot = self.get_compiled_slot(slot_index)
+        return self.current_slot
 
-        self.print_fn("Warning: No rule handled current experiment.")
-        return None
+    def filter_message(self, message_factory, world_angle, now=None):
+        """now: Timezone-aware datetime whose rules are applied (default: the current time)."""
 
+        if now is None:
+            now = datetime.datetime.now()
+        now = now.astimezone(pytz.UTC)
+        world_angle = (world_angle + 2.0 * np.pi) % (2.0 * np.pi)
+
+        current_slot = self.get_current_slot(now)
+        if len(current_slot.rules) == 0:
+            self.print_fn("No rule set for current time.")
+            return message_factory(dict())
 
+        decision = current_slot.get_decision(world_angle)
+        return decision.apply(message_factory, self.print_fn, self.log_fn)
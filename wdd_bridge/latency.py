@@ -0,0 +1,145 @@
+import http.server
+import math
+import threading
+
+# Stages a waggle (and the messages resulting from it) passes through, in order.
+# Timestamps are taken with time.monotonic().
+STAGES = ("received", "dequeued", "released", "clustered", "mapped", "filtered", "enqueued", "written")
+
+class LatencyHistogram:
+    """Counts latencies in logarithmic buckets (by default 10 per decade, from 1 µs to 100 s).
+
+    Percentiles are reported as the upper bound of the bucket they fall into.
+    """
+
+    def __init__(self, min_latency=1e-6, n_decades=8, buckets_per_decade=10):
+        self.min_latency = min_latency
+        self.buckets_per_decade = buckets_per_decade
+        # The first bucket holds everything up to min_latency, the last one everything above the range.
+        self.counts = [0] * (n_decades * buckets_per_decade + 2)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds <= self.min_latency:
+            index = 0
+        else:
+            index = 1 + int(math.log10(seconds / self.min_latency) * self.buckets_per_decade)
+            index = min(index, len(self.counts) - 1)
+
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def get_bucket_upper_bound(self, index):
+        if index == len(self.counts) - 1:
+            return self.max
+        return self.min_latency * 10.0 ** (index / self.buckets_per_decade)
+
+    def get_percentile(self, percentile):
+        if self.count == 0:
+            return None
+
+        rank = math.ceil(percentile / 100.0 * self.count)
+        cumulative_count = 0
+        for index, count in enumerate(self.counts):
+            cumulative_count += count
+            if cumulative_count >= rank:
+                return min(self.get_bucket_upper_bound(index), self.max)
+        return self.max
+
+    def get_summary(self):
+        return dict(
+            count=self.count,
+            mean=(self.sum / self.count) if self.count > 0 else None,
+            p50=self.get_percentile(50),
+            p95=self.get_percentile(95),
+            p99=self.get_percentile(99),
+            max=self.max,
+        )
+
+class LatencyTracker:
+    """Aggregates the latencies between the stages of the pipeline in histograms."""
+
+    def __init__(self):
+        self.histograms = dict()
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name, None)
+            if histogram is None:
+                histogram = LatencyHistogram()
+                self.histograms[name] = histogram
+            histogram.add(seconds)
+
+    def record_stages(self, stage_timestamps, from_stage=None):
+        """Records the time between each two consecutive stages, starting at from_stage (default: the first one).
+
+        If a message was written to the comb, the total time since receiving the waggle is recorded as well.
+        """
+        previous_stage = None
+        started = from_stage is None
+        for stage in STAGES:
+            if stage == from_stage:
+                started = True
+            if not started or stage not in stage_timestamps:
+                continue
+
+            if previous_stage is not None:
+                self.record("{}_to_{}".format(previous_stage, stage),
+                            stage_timestamps[stage] - stage_timestamps[previous_stage])
+            previous_stage = stage
+
+        if "received" in stage_timestamps and "written" in stage_timestamps:
+            self.record("received_to_written", stage_timestamps["written"] - stage_timestamps["received"])
+
+    def get_summary(self):
+        with self.lock:
+            return {name: histogram.get_summary() for name, histogram in sorted(self.histograms.items())}
+
+    def format_text(self):
+        """Formats the current summary in the Prometheus text format."""
+        lines = [
+            "# HELP wdd_bridge_latency_seconds Latency between the stages of the bridge.",
+            "# TYPE wdd_bridge_latency_seconds summary",
+        ]
+        for name, summary in self.get_summary().items():
+            for quantile in (50, 95, 99):
+                value = summary["p{}".format(quantile)]
+                lines.append('wdd_bridge_latency_seconds{{stage="{}",quantile="{}"}} {}'.format(
+                    name, quantile / 100.0, "NaN" if value is None else repr(value)))
+            lines.append('wdd_bridge_latency_seconds_count{{stage="{}"}} {}'.format(name, summary["count"]))
+        return "\n".join(lines) + "\n"
+
+class LatencyRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        buffer = self.server.latency_tracker.format_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(buffer)))
+        self.end_headers()
+        self.wfile.write(buffer)
+
+    def log_message(self, format, *args):
+        # Don't write to stderr on every request.
+        pass
+
+class LatencyServer:
+    """Serves the latency summary as text on a local port, e.g. for a metrics scraper."""
+
+    def __init__(self, latency_tracker, port):
+        self.server = http.server.ThreadingHTTPServer(("localhost", port), LatencyRequestHandler)
+        self.server.latency_tracker = latency_tracker
+
+        self.thread = threading.Thread(target=self.server.serve_forever, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
@@ -0,0 +1,238 @@
+import datetime
+import heapq
+import math
+import random
+import time
+
+from .wdd_protocol import PROTOCOL_PICKLE, PROTOCOL_WAGGLE_FRAMES, connect, encode_close_frame, encode_waggle_frame
+
+
+class SyntheticDance:
+    """A dance at a fixed spot with a fixed direction. Its waggles scatter around both."""
+
+    def __init__(self, rng, area, n_waggles, angle_noise_rad, position_noise):
+        x0, y0, x1, y1 = area
+        self.rng = rng
+        self.x = rng.uniform(x0, x1)
+        self.y = rng.uniform(y0, y1)
+        self.angle = rng.uniform(-math.pi, math.pi)
+        self.duration = rng.uniform(0.2, 2.0)
+        self.remaining_waggles = n_waggles
+        self.angle_noise_rad = angle_noise_rad
+        self.position_noise = position_noise
+
+    def is_finished(self):
+        return self.remaining_waggles <= 0
+
+    def next_waggle(self):
+        self.remaining_waggles -= 1
+        rng = self.rng
+        angle = (self.angle + rng.gauss(0.0, self.angle_noise_rad) + math.pi) % (2.0 * math.pi) - math.pi
+        return (
+            self.x + rng.gauss(0.0, self.position_noise),
+            self.y + rng.gauss(0.0, self.position_noise),
+            angle,
+            max(0.05, self.duration + rng.gauss(0.0, 0.1)),
+        )
+
+
+class SyntheticCamera:
+    """Generates WDD messages of one camera with a number of concurrent dances.
+
+    area: (x0, y0, x1, y1) in pixels in which the dances take place.
+    """
+
+    def __init__(self, cam_id, area, rng, concurrent_dances=4, waggles_per_dance=10,
+                 angle_noise_deg=10.0, position_noise=20.0):
+        self.cam_id = cam_id
+        self.area = area
+        self.rng = rng
+        self.waggles_per_dance = waggles_per_dance
+        self.angle_noise_rad = angle_noise_deg / 180.0 * math.pi
+        self.position_noise = position_noise
+
+        self.dances = [self.start_dance() for _ in range(concurrent_dances)]
+        self.waggle_counter = 0
+
+    def start_dance(self):
+        # Not all dances have the same length.
+        n_waggles = max(1, int(round(self.rng.gauss(self.waggles_per_dance, self.waggles_per_dance / 4.0))))
+        return SyntheticDance(self.rng, self.area, n_waggles, self.angle_noise_rad, self.position_noise)
+
+    def next_message(self, timestamp):
+        """Returns the message for the next waggle of any of the dances, detected at the given UTC datetime."""
+        dance_index = self.rng.randrange(len(self.dances))
+        dance = self.dances[dance_index]
+        x, y, angle, duration = dance.next_waggle()
+        if dance.is_finished():
+            self.dances[dance_index] = self.start_dance()
+
+        self.waggle_counter += 1
+        return dict(
+            x=x,
+            y=y,
+            waggle_angle=angle,
+            waggle_duration=duration,
+            timestamp_waggle=timestamp,
+            system_timestamp_waggle=timestamp,
+            cam_id=self.cam_id,
+            waggle_id="{}_{}".format(self.cam_id, self.waggle_counter),
+            predicted_class_label="waggle",
+        )
+
+
+class LoadGenerator:
+    """Sends synthetic waggles to a bridge over one or more connections per camera, like the WDD does.
+
+    The waggles of each camera arrive as a Poisson process with the given rate (waggles per second).
+    A fraction of the messages can be delivered twice or swapped with the next message of the same camera.
+    With protocol PROTOCOL_WAGGLE_FRAMES, the waggles are sent as binary frames of batch_size waggles each
+    (if the bridge supports it, see wdd_protocol).
+    """
+
+    def __init__(self, port, authkey, camera_areas, print_fn, waggle_rate=5.0, connections_per_camera=1,
+                 duplicate_probability=0.0, reorder_probability=0.0, seed=0, camera_kws={},
+                 protocol=PROTOCOL_PICKLE, batch_size=1):
+
+        self.rng = random.Random(seed)
+        self.print_fn = print_fn
+        self.waggle_rate = waggle_rate
+        self.duplicate_probability = duplicate_probability
+        self.reorder_probability = reorder_probability
+
+        self.cameras = [SyntheticCamera(cam_id, area, self.rng, **camera_kws) for cam_id, area in camera_areas.items()]
+
+        self.batch_size = batch_size
+        self.connections = []
+        # Protocol negotiated by each connection.
+        self.protocols = dict()
+        for camera in self.cameras:
+            camera_connections = []
+            for _ in range(connections_per_camera):
+                con, self.protocols[con] = connect(("localhost", port), authkey.encode(), protocols=[protocol])
+                camera_connections.append(con)
+            self.connections.append(camera_connections)
+        self.print_fn("Opened {} connections ({}).".format(
+            sum(len(c) for c in self.connections), ", ".join(sorted(set(self.protocols.values())))))
+        # Messages waiting to be sent as one frame, for each camera.
+        self.batches = [[] for _ in self.cameras]
+
+        # Next connection to use for each camera.
+        self.connection_cursors = [0] * len(self.cameras)
+        # Message held back to be sent after the next one, for each camera.
+        self.held_messages = [None] * len(self.cameras)
+
+        self.n_sent = 0
+        self.n_duplicated = 0
+        self.n_reordered = 0
+
+    def send(self, camera_index, message):
+        connections = self.connections[camera_index]
+        cursor = self.connection_cursors[camera_index]
+        con = connections[cursor]
+        self.n_sent += 1
+
+        if self.protocols[con] != PROTOCOL_WAGGLE_FRAMES:
+            self.connection_cursors[camera_index] = (cursor + 1) % len(connections)
+            con.send(message)
+            return
+
+        batch = self.batches[camera_index]
+        batch.append(message)
+        if len(batch) >= self.batch_size:
+            self.flush(camera_index)
+
+    def flush(self, camera_index):
+        batch = self.batches[camera_index]
+        if not batch:
+            return
+        connections = self.connections[camera_index]
+        cursor = self.connection_cursors[camera_index]
+        self.connection_cursors[camera_index] = (cursor + 1) % len(connections)
+        connections[cursor].send_bytes(encode_waggle_frame(batch))
+        batch.clear()
+
+    def deliver(self, camera_index, message):
+        if self.held_messages[camera_index] is None and self.rng.random() < self.reorder_probability:
+            self.held_messages[camera_index] = message
+            self.n_reordered += 1
+            return
+
+        self.send(camera_index, message)
+        if self.rng.random() < self.duplicate_probability:
+            self.send(camera_index, message)
+            self.n_duplicated += 1
+
+        held_message = self.held_messages[camera_index]
+        if held_message is not None:
+            self.held_messages[camera_index] = None
+            self.send(camera_index, held_message)
+
+    def run(self, duration, rate_step=0.0, step_duration=10.0):
+        """Sends waggles for the given duration in seconds.
+
+        The rate is increased by rate_step every step_duration seconds, so the rate at which the bridge
+        can not keep up anymore can be found in one run.
+        """
+        start_time = time.monotonic()
+        # (scheduled time relative to the start, camera index)
+        schedule = [(self.rng.expovariate(self.waggle_rate), index) for index in range(len(self.cameras))]
+        heapq.heapify(schedule)
+
+        step_index = 0
+        step_start_time = start_time
+        step_start_sent = 0
+        max_lag = 0.0
+
+        while True:
+            scheduled_time, camera_index = heapq.heappop(schedule)
+            if scheduled_time >= duration:
+                break
+
+            now = time.monotonic()
+            delay = start_time + scheduled_time - now
+            if delay > 0.0:
+                time.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+
+            message = self.cameras[camera_index].next_message(datetime.datetime.utcnow())
+            self.deliver(camera_index, message)
+
+            current_step = int(scheduled_time / step_duration)
+            if current_step != step_index:
+                self.report_step(step_index, time.monotonic() - step_start_time, self.n_sent - step_start_sent, max_lag)
+                step_index = current_step
+                step_start_time = time.monotonic()
+                step_start_sent = self.n_sent
+                max_lag = 0.0
+
+            rate = self.waggle_rate + rate_step * current_step
+            heapq.heappush(schedule, (scheduled_time + self.rng.expovariate(rate), camera_index))
+
+        self.report_step(step_index, time.monotonic() - step_start_time, self.n_sent - step_start_sent, max_lag)
+
+    def report_step(self, step_index, duration, n_sent, max_lag):
+        self.print_fn("Step {}: sent {} messages in {:3.1f} s ({:3.1f}/s over {} cameras), generator lagged up to {:3.3f} s.".format(
+            step_index, n_sent, duration, n_sent / max(duration, 1e-9), len(self.cameras), max_lag))
+
+    def close(self):
+        for camera_index, held_message in enumerate(self.held_messages):
+            if held_message is not None:
+                self.send(camera_index, held_message)
+                self.held_messages[camera_index] = None
+            self.flush(camera_index)
+
+        for camera_connections in self.connections:
+            for con in camera_connections:
+                try:
+                    if self.protocols[con] == PROTOCOL_WAGGLE_FRAMES:
+                        con.send_bytes(encode_close_frame())
+                    else:
+                        con.send("close")
+                    con.close()
+                except OSError:
+                    pass
+        self.connections = []
+        self.print_fn("Sent {} messages ({} duplicated, {} reordered).".format(
+            self.n_sent, self.n_duplicated, self.n_reordered))
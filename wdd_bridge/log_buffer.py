@@ -0,0 +1,93 @@
+import collections
+import datetime
+import itertools
+import threading
+import time
+
+
+class LogBuffer:
+    """Fixed-capacity ring buffer of the messages shown in the UI.
+
+    Only the time, the template and the format arguments of a message are stored. A line is formatted when
+    it is displayed, so most messages are never formatted at all.
+
+    Every template may add at most rate_limit messages per second on average (token bucket with bursts of
+    up to burst_size messages). The others are dropped and counted; the count is shown with the next message
+    of the same template that is kept. Only the buckets of the max_templates most recently used templates
+    are kept.
+    """
+
+    def __init__(self, capacity=1000, rate_limit=5.0, burst_size=20, max_templates=1000):
+        self.entries = collections.deque(maxlen=capacity)
+        self.rate_limit = rate_limit
+        self.burst_size = burst_size
+        self.max_templates = max_templates
+
+        # Maps the template to [tokens, time of the last update, number of suppressed messages],
+        # the least recently used first.
+        self.buckets = collections.OrderedDict()
+        self.n_suppressed = 0
+        # Messages are added from the listener, comb and UI threads.
+        self.lock = threading.Lock()
+
+    def add(self, template, args=(), now=None):
+        """Adds a message. Returns False if it was suppressed by the rate limit."""
+        if now is None:
+            now = time.monotonic()
+
+        with self.lock:
+            bucket = self.buckets.get(template)
+            if bucket is None:
+                if len(self.buckets) >= self.max_templates:
+                    self.buckets.popitem(last=False)
+                bucket = self.buckets[template] = [float(self.burst_size), now, 0]
+            else:
+                self.buckets.move_to_end(template)
+                bucket[0] = min(float(self.burst_size), bucket[0] + (now - bucket[1]) * self.rate_limit)
+                bucket[1] = now
+
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                self.n_suppressed += 1
+                return False
+
+            bucket[0] -= 1.0
+            n_suppressed, bucket[2] = bucket[2], 0
+            self.entries.append((time.time(), template, args, n_suppressed))
+            return True
+
+    def get_lines(self, n):
+        """Returns the last n messages as formatted lines, oldest first."""
+        with self.lock:
+            entries = list(itertools.islice(reversed(self.entries), n))
+        return [format_entry(*entry) for entry in reversed(entries)]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class LogMessage:
+    """A message that is only formatted when it is converted to a string."""
+
+    __slots__ = ("template", "args")
+
+    def __init__(self, template, args=()):
+        self.template = template
+        self.args = args
+
+    def __str__(self):
+        return format_message(self.template, self.args)
+
+
+def format_message(template, args):
+    # Messages without arguments are taken literally. They might contain braces.
+    if not args:
+        return template
+    return template.format(*args)
+
+def format_entry(timestamp, template, args, n_suppressed):
+    line = "[{}] {}".format(
+        datetime.datetime.utcfromtimestamp(timestamp).time().isoformat(), format_message(template, args))
+    if n_suppressed > 0:
+        line += " ({} similar messages suppressed)".format(n_suppressed)
+    return line
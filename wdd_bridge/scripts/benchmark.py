@@ -0,0 +1,41 @@
+from wdd_bridge.benchmarks import BENCHMARKS, run_benchmarks, compare_results, load_results, save_results
+
+import click
+
+
+@click.command()
+@click.option(
+    "--output", help="Filename to write the results to (json)."
+)
+@click.option(
+    "--compare",
+    help="Results (json) of an earlier run to compare against.",
+)
+@click.option(
+    "--benchmark",
+    multiple=True,
+    type=click.Choice(sorted(BENCHMARKS.keys())),
+    help="Benchmark to run. Can be passed multiple times. Defaults to all.",
+)
+@click.option(
+    "--repeat", default=5, type=click.IntRange(1), help="Number of timed runs per benchmark."
+)
+@click.option(
+    "--min-time", default=0.2, type=float, help="Minimum duration of each timed run in seconds."
+)
+def main(output, compare, benchmark, repeat, min_time):
+
+    print_fn = lambda x: print(x, flush=True)
+    results = run_benchmarks(names=benchmark, repeat=repeat, min_time=min_time, print_fn=print_fn)
+
+    if output:
+        save_results(results, output)
+        print("Wrote results to {}.".format(output))
+
+    if compare:
+        print()
+        compare_results(load_results(compare), results, print_fn=print_fn)
+
+
+if __name__ == "__main__":
+    main()
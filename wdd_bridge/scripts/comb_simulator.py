@@ -0,0 +1,49 @@
+from wdd_bridge.comb_simulator import CombSimulator
+
+import click
+import time
+
+
+@click.command()
+@click.option(
+    "--baudrate", default=9600, help="Baud rate of the simulated serial connection."
+)
+@click.option(
+    "--command-processing-time",
+    default=0.002,
+    type=float,
+    help="Time in seconds the simulated board needs to process a command (in addition to receiving it).",
+)
+@click.option(
+    "--trace-file",
+    help="Filename to write the trace of all processed commands and resulting states to. Each line is a json object.",
+)
+def main(baudrate, command_processing_time, trace_file):
+
+    simulator = CombSimulator(
+        baudrate=baudrate,
+        command_processing_time=command_processing_time,
+        print_fn=lambda x: print(x, flush=True),
+    )
+    print("Simulating comb on {} (pass it as --comb-port). Press Ctrl+C to stop.".format(simulator.get_port()), flush=True)
+
+    start_time = time.monotonic()
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        duration = time.monotonic() - start_time
+        simulator.close()
+
+    print("Processed {} commands ({} invalid) in {:3.1f} s.".format(
+        simulator.n_commands, simulator.n_invalid_commands, duration))
+
+    if trace_file:
+        simulator.write_trace(trace_file)
+        print("Wrote trace to {}.".format(trace_file))
+
+
+if __name__ == "__main__":
+    main()
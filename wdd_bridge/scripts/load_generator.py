@@ -0,0 +1,159 @@
+from wdd_bridge.load_generator import LoadGenerator
+from wdd_bridge.wdd_protocol import PROTOCOL_PICKLE, PROTOCOL_WAGGLE_FRAMES
+
+import click
+import json
+import numpy as np
+
+
+@click.command()
+@click.option(
+    "--wdd-port", default=9901, help="Local port the bridge listens on for WDD detections."
+)
+@click.option(
+    "--wdd-authkey", required=True, help="Passphrase to authenticate connections."
+)
+@click.option(
+    "--comb-config",
+    help="Comb configuration of the bridge. If given, the cameras and the areas of the dances are taken from it.",
+)
+@click.option(
+    "--cam-id",
+    multiple=True,
+    help="Camera to simulate (without --comb-config). Can be passed multiple times. Defaults to cam0.",
+)
+@click.option(
+    "--image-size",
+    default=(1920, 1080),
+    type=(int, int),
+    help="Width and height of the camera images in pixels (without --comb-config).",
+)
+@click.option(
+    "--rate",
+    default=5.0,
+    type=float,
+    help="Waggles per second and camera.",
+)
+@click.option(
+    "--rate-step",
+    default=0.0,
+    type=float,
+    help="Increase of the rate after every step.",
+)
+@click.option(
+    "--step-duration",
+    default=10.0,
+    type=float,
+    help="Duration of a step in seconds.",
+)
+@click.option(
+    "--duration",
+    default=60.0,
+    type=float,
+    help="Total duration in seconds.",
+)
+@click.option(
+    "--connections-per-camera",
+    default=1,
+    type=click.IntRange(1),
+    help="Number of connections per camera. The messages of a camera are distributed over them.",
+)
+@click.option(
+    "--concurrent-dances",
+    default=4,
+    type=click.IntRange(1),
+    help="Number of dances happening at the same time on each camera.",
+)
+@click.option(
+    "--waggles-per-dance",
+    default=10,
+    type=click.IntRange(1),
+    help="Average number of waggles per dance.",
+)
+@click.option(
+    "--angle-noise-deg",
+    default=10.0,
+    type=float,
+    help="Standard deviation of the waggle angles within a dance in degrees.",
+)
+@click.option(
+    "--position-noise",
+    default=20.0,
+    type=float,
+    help="Standard deviation of the waggle positions within a dance in pixels.",
+)
+@click.option(
+    "--duplicate-probability",
+    default=0.0,
+    type=click.FloatRange(0.0, 1.0),
+    help="Probability that a message is delivered twice.",
+)
+@click.option(
+    "--reorder-probability",
+    default=0.0,
+    type=click.FloatRange(0.0, 1.0),
+    help="Probability that a message is delivered after the next message of the same camera.",
+)
+@click.option(
+    "--protocol",
+    default="pickle",
+    type=click.Choice(["pickle", "binary"]),
+    help="Send pickled dicts or binary waggle frames (falls back to pickled dicts if the bridge does not support them).",
+)
+@click.option(
+    "--batch-size",
+    default=1,
+    type=click.IntRange(1),
+    help="Number of waggles per binary frame.",
+)
+@click.option(
+    "--seed", default=0, type=int, help="Seed of the random number generator."
+)
+def main(wdd_port, wdd_authkey, comb_config, cam_id, image_size, rate, rate_step, step_duration, duration,
+         connections_per_camera, concurrent_dances, waggles_per_dance, angle_noise_deg, position_noise,
+         duplicate_probability, reorder_probability, protocol, batch_size, seed):
+
+    camera_areas = dict()
+    if comb_config:
+        with open(comb_config, "r") as f:
+            config = json.load(f)
+        for camera_config in config["cameras"]:
+            pixels = np.array(camera_config["homography"]["pixels"], dtype=np.float64).reshape(4, 2)
+            x0, y0 = pixels.min(axis=0)
+            x1, y1 = pixels.max(axis=0)
+            camera_areas[camera_config["cam_id"]] = (x0, y0, x1, y1)
+    else:
+        width, height = image_size
+        for camera_id in (cam_id or ("cam0",)):
+            camera_areas[camera_id] = (0.0, 0.0, float(width), float(height))
+
+    generator = LoadGenerator(
+        port=wdd_port,
+        authkey=wdd_authkey,
+        camera_areas=camera_areas,
+        print_fn=lambda x: print(x, flush=True),
+        waggle_rate=rate,
+        connections_per_camera=connections_per_camera,
+        duplicate_probability=duplicate_probability,
+        reorder_probability=reorder_probability,
+        seed=seed,
+        protocol=PROTOCOL_WAGGLE_FRAMES if protocol == "binary" else PROTOCOL_PICKLE,
+        batch_size=batch_size,
+        camera_kws=dict(
+            concurrent_dances=concurrent_dances,
+            waggles_per_dance=waggles_per_dance,
+            angle_noise_deg=angle_noise_deg,
+            position_noise=position_noise,
+        )
+    )
+
+    try:
+        generator.run(duration, rate_step=rate_step, step_duration=step_duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        generator.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+# wdd_bridge_replay is kept as an alias of `wdd_bridge replay`.
+from wdd_bridge.scripts.wdd_bridge import replay as main
+
+
+if __name__ == "__main__":
+    main()
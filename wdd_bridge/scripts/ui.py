@@ -0,0 +1,6 @@
+# wdd_bridge_ui is kept as an alias of `wdd_bridge ui`.
+from wdd_bridge.scripts.wdd_bridge import ui as main
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,129 @@
-from wdd_bridge.bridge import Bridge
+import json
+import time
+
+# Start of the startup, for --startup-report.
+STARTUP_TIME = time.perf_counter()
+
+from wdd_bridge.startup import StartupReport
 
 import click
 
 
-@click.command()
+def pipeline_options(fn):
+    """Options that configure the processing of waggles. Shared by the bridge and the replay."""
+
+    options = [
+        click.option(
+            "--comb-config",
+            required=True,
+            help="Path to filename that contains comb configuration.",
+        ),
+        click.option(
+            "--stats-file",
+            help="Filename to log advanced statistics to. Each line is a json object.",
+        ),
+        click.option(
+            "--stats-flush-interval",
+            default=1.0,
+            type=float,
+            help="Interval in seconds in which the statistics file is flushed.",
+        ),
+        click.option(
+            "--stats-fsync-policy",
+            default="never",
+            type=click.Choice(["never", "flush", "batch"]),
+            help="When to fsync the statistics file: never, at every periodic flush or after every written batch.",
+        ),
+        click.option(
+            "--use-soundboard",
+            type=click.IntRange(0, 1),
+            multiple=True,
+            help="Soundboard to use in single or all-actuators mode. Can be passed multiple times to use both soundboards. Defaults to 0."
+        ),
+        click.option(
+            "--sound-index",
+            help="Number of the sound file on the sound board to play on suppression (0-10).",
+            default=0,
+            type=click.IntRange(0, 11)
+        ),
+        click.option(
+            "--signal-index",
+            help="Index of the signal to use for suppression (1-4). Corresponds to the 2 x 2 audio channels of the sound boards.",
+            default=1,
+            type=click.IntRange(1, 5)
+        ),
+        click.option(
+            "--all-actuators",
+            is_flag=True,
+            help="Play signal on all actuators simultaneously.",
+        ),
+        click.option(
+            "--hardwired-signals",
+            is_flag=True,
+            help="Assume signals (i.e. channels) have been hardwired to the actuators. Then 'soundboard_index' and 'sound_index' from the actuator's config will be used to control the playback.",
+        ),
+        click.option(
+            "--only-one-signal",
+            is_flag=True,
+            help="Do not play another signal if any actuator is still active.",
+        ),
+        click.option(
+            "--signal-duration",
+            default=1.0,
+            type=float,
+            help="Duration of the signal in seconds.",
+        ),
+        click.option(
+            "--waggle-max-distance",
+            default=200.0,
+            type=float,
+            help="Maximum distance in pixels between successive waggles to be considered one dance.",
+        ),
+        click.option(
+            "--waggle-max-gap",
+            default=7.0,
+            type=float,
+            help="Maximum time between two successive waggles to be considered one dance.",
+        ),
+        click.option(
+            "--waggle-min-count",
+            default=3,
+            type=click.IntRange(2),
+            help="Minimum number of waggles in a dance with a similar angle to trigger a signal.",
+        ),
+        click.option(
+            "--actuator-raster-max-error",
+            default=2.0,
+            type=float,
+            help="Maximum error in comb units of the precomputed nearest-actuator lookup. Cameras whose raster exceeds it find the nearest actuator exactly.",
+        ),
+    ]
+
+    for option in reversed(options):
+        fn = option(fn)
+    return fn
+
+
+class BridgeCommandGroup(click.Group):
+    """Runs the bridge if the arguments do not start with the name of another command.
+
+    Like this, `wdd_bridge --wdd-authkey ...` starts the bridge and e.g. `wdd_bridge ui ...` the viewer.
+    """
+
+    default_command = "run"
+
+    def parse_args(self, ctx, args):
+        if not args or (args[0] not in self.commands and args[0] != "--help"):
+            args = [self.default_command] + list(args)
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=BridgeCommandGroup)
+def main():
+    """Connects the waggle detection (WDD) to the comb. Without a command, the bridge is run."""
+
+
+@main.command()
 @click.option(
     "--wdd-port", default=9901, help="Local port to listen on for WDD detections."
 )
@@ -13,90 +133,174 @@ import click
 @click.option(
     "--comb-port", default="/dev/ttyUSB0", help="Serial port to connect to the comb. Use local mode (i.e. just play sound) if the 'port' is a .wav file."
 )
-@click.option(
-    "--comb-config",
-    required=True,
-    help="Path to filename that contains comb configuration.",
-)
+@pipeline_options
 @click.option(
     "--draw-arrows",
     is_flag=True,
     help="Output arrows in the UI based on waggle direction.",
 )
-@click.option(
-    "--stats-file",
-    help="Filename to log advanced statistics to. Each line is a json object.",
-)
 @click.option(
     "--no-gui",
     help="Do not present a graphical user interface. Might be useful for debugging purposes.",
 )
 @click.option(
-    "--use-soundboard",
-    type=click.IntRange(0, 1),
-    multiple=True,
-    help="Soundboard to use in single or all-actuators mode. Can be passed multiple times to use both soundboards. Defaults to 0."
+    "--ui-port",
+    type=int,
+    help="Do not draw the UI in this process, but publish the state on this local port for `wdd_bridge ui`.",
 )
 @click.option(
-    "--sound-index",
-    help="Number of the sound file on the sound board to play on suppression (0-10).",
-    default=0,
-    type=click.IntRange(0, 11)
+    "--ui-frame-rate",
+    default=10.0,
+    type=float,
+    help="Rate (per second) at which the UI is updated.",
 )
 @click.option(
-    "--signal-index",
-    help="Index of the signal to use for suppression (1-4). Corresponds to the 2 x 2 audio channels of the sound boards.",
-    default=1,
-    type=click.IntRange(1, 5)
+    "--ui-log-size",
+    default=1000,
+    type=click.IntRange(1),
+    help="Number of messages kept for the UI.",
 )
 @click.option(
-    "--all-actuators",
-    is_flag=True,
-    help="Play signal on all actuators simultaneously.",
+    "--ui-log-rate-limit",
+    default=5.0,
+    type=float,
+    help="Messages per second (on average) of each kind that are shown in the UI. The statistics file gets all messages.",
 )
 @click.option(
-    "--hardwired-signals",
-    is_flag=True,
-    help="Assume signals (i.e. channels) have been hardwired to the actuators. Then 'soundboard_index' and 'sound_index' from the actuator's config will be used to control the playback.",
+    "--max-buffered-waggles",
+    default=100,
+    type=click.IntRange(1),
+    help="Number of received waggles per camera that can wait for processing.",
 )
 @click.option(
-    "--only-one-signal",
-    is_flag=True,
-    help="Do not play another signal if any actuator is still active.",
+    "--overflow-policy",
+    default="drop_oldest",
+    type=click.Choice(["drop_oldest", "coalesce"]),
+    help="What to do with a new waggle if the camera's buffer is full: drop the oldest waiting waggle or replace a waiting waggle from the same spot.",
 )
 @click.option(
-    "--signal-duration",
-    default=1.0,
+    "--reorder-hold-time",
+    default=0.05,
     type=float,
-    help="Duration of the signal in seconds.",
+    help="Maximum time in seconds that received waggles are held back to process them in the order of their timestamps.",
 )
 @click.option(
-    "--waggle-max-distance",
-    default=200.0,
+    "--waggle-max-age",
     type=float,
-    help="Maximum distance in pixels between successive waggles to be considered one dance.",
+    help="Waggles older than this (in seconds) when they are processed are still clustered, but never trigger a signal.",
+)
+@click.option(
+    "--capture-file",
+    help="Filename to record all raw messages from the WDD to. Can be replayed with `wdd_bridge replay`.",
+)
+@click.option(
+    "--metrics-port",
+    type=int,
+    help="Local port on which the per-stage latency histograms are served in the Prometheus text format.",
 )
 @click.option(
-    "--waggle-max-gap",
-    default=7.0,
+    "--latency-report-interval",
+    default=60.0,
     type=float,
-    help="Maximum time between two successive waggles to be considered one dance.",
+    help="Interval in seconds in which a latency summary and the ingestion counters are written to the statistics file.",
+)
+@click.option(
+    "--validate-azimuth",
+    is_flag=True,
+    help="Check today's solar azimuth table against astropy (needs astropy to be installed) before starting.",
 )
 @click.option(
-    "--waggle-min-count",
-    default=3,
-    type=click.IntRange(2),
-    help="Minimum number of waggles in a dance with a similar angle to trigger a signal.",
+    "--startup-report",
+    is_flag=True,
+    help="Print the time taken by each phase of the startup.",
 )
-def main(**kwargs):
+def run(validate_azimuth, startup_report, **kwargs):
+    """Runs the bridge (the default command)."""
+
+    report = StartupReport(start_time=STARTUP_TIME)
+    # Imported here, so e.g. --help does not have to load numpy.
+    with report.phase("imports"):
+        from wdd_bridge.bridge import Bridge
 
     print("Initializing bridge..", flush=True)
 
-    bridge = Bridge(**kwargs)
+    bridge = Bridge(startup_report=report, **kwargs)
+
+    if validate_azimuth:
+        with report.phase("azimuth validation"):
+            max_error_deg = bridge.azimuth_updater.validate_against_astropy()
+        print("Azimuth table deviates from astropy by at most {:1.3f}°.".format(max_error_deg), flush=True)
+
+    if startup_report:
+        print(report.format_text(), flush=True)
 
     print("Starting bridge..", flush=True)
     bridge.run()
 
 
+@main.command()
+@click.argument("capture-file")
+@click.option(
+    "--comb-port", default="", help="Serial port to send the resulting comb messages to (e.g. of wdd_bridge_comb_simulator). By default, they are only processed."
+)
+@pipeline_options
+@click.option(
+    "--speed",
+    default=1.0,
+    type=float,
+    help="Replay speed relative to the original pace of the messages (e.g. 10 for 10x). 0 replays as fast as possible.",
+)
+def replay(capture_file, speed, **kwargs):
+    """Feeds a capture file (see --capture-file) through the bridge."""
+    from wdd_bridge.bridge import Bridge
+    from wdd_bridge.capture import replay_capture
+
+    print("Initializing bridge..", flush=True)
+
+    bridge = Bridge(wdd_port=None, wdd_authkey=None, draw_arrows=False, no_gui=True, **kwargs)
+
+    print("Replaying {}..".format(capture_file), flush=True)
+    try:
+        n_messages, n_waggles, duration = replay_capture(
+            bridge, capture_file, speed=speed, print_fn=lambda x: print(x, flush=True))
+
+        # Let the comb connector catch up before stopping it.
+        while bridge.comb.get_queue_depth() > 0:
+            time.sleep(0.1)
+    finally:
+        bridge.stop()
+
+    print("Replayed {} messages ({} waggles) in {:3.2f} s ({:3.1f} waggles/s).".format(
+        n_messages, n_waggles, duration, n_waggles / max(duration, 1e-9)))
+    print("Latencies (seconds):")
+    print(json.dumps(bridge.latency_tracker.get_summary(), indent=2))
+
+
+@main.command()
+@click.option(
+    "--ui-port", default=9902, help="Local port the bridge publishes its state on (its --ui-port)."
+)
+@click.option(
+    "--wdd-authkey", required=True, help="Passphrase of the bridge."
+)
+@click.option(
+    "--draw-arrows",
+    is_flag=True,
+    help="Output arrows in the UI based on waggle direction.",
+)
+@click.option(
+    "--frame-rate",
+    default=10.0,
+    type=float,
+    help="Maximum number of frames drawn per second.",
+)
+def ui(ui_port, wdd_authkey, draw_arrows, frame_rate):
+    """Draws the UI of a bridge that was started with --ui-port."""
+    from wdd_bridge.ui import UIViewer
+
+    viewer = UIViewer(ui_port, authkey=wdd_authkey, draw_arrows=draw_arrows, frame_rate=frame_rate)
+    viewer.run()
+
+
 if __name__ == "__main__":
     main()
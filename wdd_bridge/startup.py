@@ -0,0 +1,71 @@
+import contextlib
+import threading
+import time
+
+
+class StartupReport:
+    """Measures the phases of the startup. Independent phases can be run concurrently with run_concurrently."""
+
+    def __init__(self, start_time=None):
+        # perf_counter() time the startup began, e.g. before the imports.
+        self.start_time = time.perf_counter() if start_time is None else start_time
+        # (name, start relative to start_time, duration) of each finished phase.
+        self.phases = []
+        self.lock = threading.Lock()
+
+    def add_phase(self, name, start_time, end_time):
+        with self.lock:
+            self.phases.append((name, start_time - self.start_time, end_time - start_time))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, start_time, time.perf_counter())
+
+    def run_concurrently(self, phases, cleanups=None):
+        """Runs the functions of a dict {phase name: fn} in parallel threads and returns their results by name.
+
+        Re-raises the first exception of any of the functions after all of them finished. Before, the functions
+        of the dict cleanups {phase name: fn} are called (in reverse order) to undo the phases, so e.g. the threads
+        they started do not keep the process alive. The cleanup of the failed phase is called as well, as it may
+        have been initialized partially.
+        """
+        results = dict()
+        errors = []
+
+        def run_phase(name, fn):
+            try:
+                with self.phase(name):
+                    results[name] = fn()
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run_phase, args=(name, fn)) for name, fn in phases.items()]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            for name in reversed(list((cleanups or dict()).keys())):
+                try:
+                    cleanups[name]()
+                except Exception:
+                    # The exception of the phase is more relevant.
+                    pass
+            raise errors[0]
+        return results
+
+    def get_total_duration(self):
+        return time.perf_counter() - self.start_time
+
+    def format_text(self):
+        lines = ["{:30s} {:>10s} {:>10s}".format("startup phase", "start (ms)", "took (ms)")]
+        for name, start, duration in sorted(self.phases, key=lambda phase: phase[1]):
+            lines.append("{:30s} {:10.1f} {:10.1f}".format(name, start * 1e3, duration * 1e3))
+        lines.append("{:30s} {:10s} {:10.1f}".format("total", "", self.get_total_duration() * 1e3))
+        return "\n".join(lines)
@@ -1,20 +1,60 @@
 import datetime
 import json
+import os
 import queue
 import secrets
 import threading
+import time
+
+from .log_buffer import LogMessage
+
+
+def serialize_value(value):
+    if isinstance(value, datetime.datetime) or isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, LogMessage):
+        # Formatted by the writing thread instead of the caller.
+        return str(value)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
 
 
 class Statistics:
-    def __init__(self, filename):
+    """Writes log records as json lines from a background thread.
+
+    The file stays open and queued records are written in batches. If the filename contains '<date>',
+    a new file is started at each (UTC) date change.
+
+    fsync_policy: "never" leaves syncing to the OS, "flush" syncs at every periodic flush and
+        "batch" flushes and syncs after every written batch.
+    report_interval: Interval in seconds in which the writer logs its own queue depth and throughput.
+        None disables the reports.
+    """
+
+    def __init__(self, filename, flush_interval=1.0, fsync_policy="never", max_batch_size=1000, report_interval=60.0):
+
+        if fsync_policy not in ("never", "flush", "batch"):
+            raise ValueError("Unknown fsync policy '{}'.".format(fsync_policy))
 
         self.filename = filename
         self.queue = queue.Queue()
 
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
+        self.max_batch_size = max_batch_size
+        self.report_interval = report_interval
+
         self.running = True
         self.token = secrets.token_urlsafe()
 
-        self.filename = filename
+        self.encoder = json.JSONEncoder(default=serialize_value)
+        self.file = None
+        self.current_filename = None
+
+        self.records_written = 0
+        self.bytes_written = 0
+        self.last_report_time = time.monotonic()
+        self.last_report_records = 0
+        self.last_report_bytes = 0
 
         self.thread = threading.Thread(target=self.run, args=())
         self.thread.daemon = False  # No daemon, so writing is not cut off.
@@ -39,26 +79,106 @@ class Statistics:
         self.queue.put(None)
         self.thread.join()
 
+    def get_queue_depth(self):
+        return self.queue.qsize()
+
+    def get_status(self):
+        """Returns the current queue depth and the throughput since the last report."""
+        now = time.monotonic()
+        duration = max(now - self.last_report_time, 1e-9)
+        return dict(
+            queue_depth=self.get_queue_depth(),
+            records_written=self.records_written,
+            bytes_written=self.bytes_written,
+            records_per_second=(self.records_written - self.last_report_records) / duration,
+            bytes_per_second=(self.bytes_written - self.last_report_bytes) / duration,
+        )
+
+    def get_filename(self):
+        filename = self.filename
+        if "<date>" in filename:
+            filename = filename.replace(
+                "<date>", datetime.datetime.utcnow().date().isoformat()
+            )
+        return filename
+
+    def ensure_file(self):
+        filename = self.get_filename()
+        if filename != self.current_filename:
+            self.close_file()
+            self.file = open(filename, "a")
+            self.current_filename = filename
+
+    def flush_file(self, sync):
+        if self.file is None:
+            return
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def close_file(self):
+        if self.file is None:
+            return
+        self.flush_file(sync=self.fsync_policy != "never")
+        self.file.close()
+        self.file = None
+        self.current_filename = None
+
+    def serialize(self, data):
+        try:
+            return self.encoder.encode(data)
+        except Exception as e:
+            return json.dumps({"text": "serilization_error", "what": str(e), "payload": str(data)})
+
+    def write_batch(self, batch):
+        self.ensure_file()
+
+        buffer = "".join(self.serialize(data) + "\n" for data in batch)
+        self.file.write(buffer)
+
+        self.records_written += len(batch)
+        self.bytes_written += len(buffer)
+
+        if self.fsync_policy == "batch":
+            self.flush_file(sync=True)
+
+    def report_status(self):
+        status = self.get_status()
+        self.last_report_time = time.monotonic()
+        self.last_report_records = self.records_written
+        self.last_report_bytes = self.bytes_written
+        self.log("statistics writer status", **status)
+
     def run(self):
-        while self.running:
-            data = self.queue.get()
-
-            if data is None:
-                continue
-
-            for k, v in data.items():
-                if isinstance(v, datetime.datetime) or isinstance(v, datetime.date):
-                    data[k] = v.isoformat()
-            try:
-                buffer = json.dumps(data)
-            except Exception as e:
-                buffer = json.dumps({"text": "serilization_error", "what": str(e), "payload": str(data)})
-
-            filename = self.filename
-            if "<date>" in filename:
-                filename = filename.replace(
-                    "<date>", datetime.datetime.utcnow().date().isoformat()
-                )
-
-            with open(filename, "a") as f:
-                f.write(buffer + "\n")
+        last_flush_time = time.monotonic()
+        stopping = False
+
+        try:
+            while not stopping:
+                batch = []
+                try:
+                    data = self.queue.get(timeout=self.flush_interval)
+                    # Collect everything else that is already waiting.
+                    while True:
+                        if data is None:
+                            stopping = not self.running
+                        else:
+                            batch.append(data)
+                        if len(batch) >= self.max_batch_size or stopping:
+                            break
+                        data = self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+                if len(batch) > 0:
+                    self.write_batch(batch)
+
+                now = time.monotonic()
+                if now - last_flush_time >= self.flush_interval:
+                    self.flush_file(sync=self.fsync_policy == "flush")
+                    last_flush_time = now
+
+                if self.report_interval is not None and not stopping and now - self.last_report_time >= self.report_interval:
+                    self.report_status()
+        finally:
+            self.close_file()
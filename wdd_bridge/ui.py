@@ -0,0 +1,492 @@
+import multiprocessing.connection
+import numpy as np
+import pickle
+import threading
+import time
+
+from .azimuth import world_angle_to_direction_string
+from .wdd_listener import run_handshake
+
+ARROWS = ["→", "↗", "↑", "↖", "←", "↙", "↓", "↘", "→"]
+# Number of log lines included in a snapshot.
+SNAPSHOT_LOG_LINES = 50
+
+
+class TerminalUI:
+    """Renders snapshots of the bridge's state (see Bridge.get_ui_snapshot) to the terminal.
+
+    The border is only drawn after the screen was (re)opened or the layout changed. Afterwards, only the cells
+    that changed since the previous snapshot are drawn: new waggles, closed dances, switched actuators and log lines.
+
+    Snapshots only contain the new points of the dances, so every snapshot has to be rendered (or merged into
+    the next one with merge_snapshots). The points of the open dances are kept to redraw them after a reset.
+    """
+
+    # Actuators are drawn above the waggles of the dances.
+    DANCE_LAYER = 0
+    ACTUATOR_LAYER = 1
+
+    def __init__(self, draw_arrows=False):
+        # Only imported when the UI is actually drawn in this process.
+        import asciimatics.screen
+        self.screen_class = asciimatics.screen.Screen
+        self.side_colours = [self.screen_class.COLOUR_YELLOW, self.screen_class.COLOUR_CYAN]
+
+        self.draw_arrows = draw_arrows
+        self.screen = None
+        self.layout = None
+        # Maps (side index, dance index) to the comb points of all open dances.
+        self.dance_points = dict()
+
+    def get_key(self):
+        if self.screen is None:
+            return None
+        return self.screen.get_key()
+
+    def render(self, snapshot):
+        if self.screen is not None and self.screen.has_resized():
+            self.screen.close()
+            self.screen = None
+
+        if self.screen is None:
+            self.screen = self.screen_class.open()
+            self.layout = None
+
+        if snapshot["layout"] != self.layout:
+            self.reset(snapshot["layout"])
+
+        self.draw(snapshot)
+
+    def reset(self, layout):
+        """Fits the comb to the screen, clears it and draws the static parts."""
+        screen = self.screen
+        self.layout = layout
+
+        hx0, hy0, hx1, hy1 = layout["comb_rectangle"]
+        hwidth, hheight = hx1 - hx0, hy1 - hy0
+
+        # Make sure we have enough space for the logs below the screen.
+        log_margin_lines = 10
+
+        # Usually, fonts are higher than wide. Account a bit for that.
+        for font_width_factor in (1.5, 1.25, 1.0):
+            ctop, cbottom = 3, int(screen.height - log_margin_lines)
+            cheight = cbottom - ctop
+            cwidth = int(font_width_factor * cheight * (hwidth / hheight))
+            if cwidth < screen.width:
+                break
+
+        cleft, cright = int(0.5 * (screen.width - cwidth)), int(0.5 * (screen.width + cwidth))
+        self.comb_box = (cleft, ctop, cright, cbottom)
+        self.comb_transform = (hx0, hy0, cwidth / hwidth, cheight / hheight)
+
+        # Maps a screen cell to everything drawn into it: {key: (layer, char, colour)}.
+        self.cells = dict()
+        self.dirty_cells = set()
+        # Maps (side index, dance index) to the cells of the dance's waggles.
+        self.drawn_dances = dict()
+        # Maps the actuator index to whether it was drawn as active.
+        self.drawn_actuators = dict()
+        self.drawn_log = []
+
+        screen.clear_buffer(7, 2, 0)
+        self.draw_border()
+
+    def draw_border(self):
+        screen = self.screen
+        cleft, ctop, cright, cbottom = self.comb_box
+
+        def draw_border(start, to):
+            screen.move(*start)
+            screen.draw(*to)
+
+        draw_border((cleft, ctop), (cright, ctop))
+        draw_border((cright, ctop), (cright, cbottom))
+        draw_border((cright, cbottom), (cleft, cbottom))
+        draw_border((cleft, cbottom), (cleft, ctop))
+
+    def is_border_cell(self, x, y):
+        cleft, ctop, cright, cbottom = self.comb_box
+        return ((x in (cleft, cright) and ctop <= y <= cbottom)
+                or (y in (ctop, cbottom) and cleft <= x <= cright))
+
+    def get_screen_cell(self, x, y):
+        hx0, hy0, scale_x, scale_y = self.comb_transform
+        cleft, ctop, _, cbottom = self.comb_box
+        x, y = int((x - hx0) * scale_x + cleft), int((y - hy0) * scale_y + ctop)
+        if self.layout["origin_y"] == "bottom":
+            y = (cbottom - ctop) - (y - ctop) + ctop
+        return (x, y)
+
+    def set_cell(self, cell, key, layer, char, colour):
+        self.cells.setdefault(cell, dict())[key] = (layer, char, colour)
+        self.dirty_cells.add(cell)
+
+    def clear_cell(self, cell, key):
+        entries = self.cells.get(cell)
+        if entries is None:
+            return
+        entries.pop(key, None)
+        if len(entries) == 0:
+            del self.cells[cell]
+        self.dirty_cells.add(cell)
+
+    def erase_dance(self, dance_key):
+        for idx, cell in enumerate(self.drawn_dances.pop(dance_key)):
+            self.clear_cell(cell, (dance_key, idx))
+
+    def update_dances(self, snapshot):
+        apply_dance_deltas(self.dance_points, snapshot["dances"])
+
+        for dance_key, dance_positions in self.dance_points.items():
+            colour = self.side_colours[dance_key[0] % len(self.side_colours)]
+
+            drawn_cells = self.drawn_dances.get(dance_key, [])
+            if len(dance_positions) == len(drawn_cells):
+                continue
+            if len(dance_positions) < len(drawn_cells):
+                self.erase_dance(dance_key)
+                drawn_cells = []
+            self.drawn_dances[dance_key] = drawn_cells
+
+            # The previously last waggle is drawn again, as it is not the last one anymore.
+            for idx in range(max(len(drawn_cells) - 1, 0), len(dance_positions)):
+                x, y, o = dance_positions[idx]
+                char = "." if idx < len(dance_positions) - 1 else "o"
+                if self.draw_arrows and o is not None:
+                    o = o / np.pi * 180
+                    o = (o + 360) % 360
+                    char = ARROWS[int(round(o / 45, 0))]
+
+                if idx == len(drawn_cells):
+                    drawn_cells.append(self.get_screen_cell(x, y))
+                self.set_cell(drawn_cells[idx], (dance_key, idx), self.DANCE_LAYER, char, colour)
+
+        for dance_key in [key for key in self.drawn_dances if key not in self.dance_points]:
+            self.erase_dance(dance_key)
+
+    def update_actuators(self, snapshot):
+        for idx, ((x, y), remaining_time) in enumerate(
+                zip(self.layout["sensor_coordinates"], snapshot["actuator_remaining_times"])):
+            is_active = remaining_time > 0.0
+            if self.drawn_actuators.get(idx) == is_active:
+                continue
+            self.drawn_actuators[idx] = is_active
+
+            self.set_cell(
+                self.get_screen_cell(x, y),
+                ("actuator", idx),
+                self.ACTUATOR_LAYER,
+                char="X",
+                colour=self.screen_class.COLOUR_BLUE if not is_active else self.screen_class.COLOUR_YELLOW,
+            )
+
+    def draw_dirty_cells(self):
+        redraw_border = False
+        for (x, y) in self.dirty_cells:
+            entries = self.cells.get((x, y))
+            if entries:
+                # The topmost layer wins; within a layer, whatever was drawn last.
+                _, char, colour = max(reversed(list(entries.values())), key=lambda entry: entry[0])
+                self.screen.print_at(char, x, y, colour=colour)
+            elif self.is_border_cell(x, y):
+                redraw_border = True
+            else:
+                self.screen.print_at(" ", x, y, colour=7, attr=2, bg=0)
+        self.dirty_cells.clear()
+
+        if redraw_border:
+            self.draw_border()
+
+    def draw(self, snapshot):
+        screen = self.screen
+
+        self.update_dances(snapshot)
+        self.update_actuators(snapshot)
+        self.draw_dirty_cells()
+
+        current_azimuth = snapshot["azimuth"]
+        screen.print_at(
+            "{} -- sun at {} ({:3.1f}°)".format(
+                snapshot["timestamp"].isoformat(),
+                world_angle_to_direction_string(current_azimuth), current_azimuth / np.pi * 180
+            ).ljust(screen.width - 2),
+            1,
+            1,
+            colour=self.screen_class.COLOUR_CYAN,
+        )
+
+        _, _, _, cbottom = self.comb_box
+        space = max(screen.height - cbottom - 1, 0)
+        log = snapshot["log"][-space:] if space > 0 else []
+        log_lines = log + [""] * (space - len(log))
+        for i, line in enumerate(log_lines):
+            if i < len(self.drawn_log) and self.drawn_log[i] == line:
+                continue
+            screen.print_at(
+                line.ljust(screen.width),
+                0,
+                cbottom + 1 + i,
+                colour=self.screen_class.COLOUR_CYAN,
+            )
+        self.drawn_log = log_lines
+
+        # Only the cells that differ from the previous frame are written to the terminal.
+        screen.refresh()
+
+    def close(self):
+        if self.screen is not None:
+            self.screen.close()
+            self.screen = None
+
+
+def apply_dance_deltas(dance_points, dances):
+    """Adds the new points of the dances of a snapshot to dance_points {(side index, dance index): [points]}.
+
+    Dances that are not part of the snapshot were closed and are removed.
+    """
+    open_dances = set()
+    for side_index, side_dances in enumerate(dances):
+        for dance_index, start, new_points in side_dances:
+            dance_key = (side_index, dance_index)
+            open_dances.add(dance_key)
+            points = dance_points.setdefault(dance_key, [])
+            # The new points might overlap the known ones, e.g. when a viewer gets the full state after connecting.
+            del points[start:]
+            points.extend(new_points)
+
+    if len(dance_points) > len(open_dances):
+        for dance_key in [key for key in dance_points if key not in open_dances]:
+            del dance_points[dance_key]
+
+def merge_snapshots(older, newer):
+    """Returns newer, including the dance points that were only part of older. For snapshots that are skipped."""
+    dances = []
+    for side_index, side_dances in enumerate(newer["dances"]):
+        older_dances = dict()
+        if side_index < len(older["dances"]):
+            older_dances = {dance[0]: dance for dance in older["dances"][side_index]}
+
+        merged_dances = []
+        for dance_index, start, new_points in side_dances:
+            older_dance = older_dances.get(dance_index, None)
+            if older_dance is not None and older_dance[1] < start:
+                _, older_start, older_points = older_dance
+                new_points = older_points[:start - older_start] + new_points
+                start = older_start
+            merged_dances.append((dance_index, start, new_points))
+        dances.append(merged_dances)
+
+    return dict(newer, dances=dances)
+
+def get_full_dances(dance_points, n_sides):
+    """Returns the dances of a snapshot that contains all points of dance_points (see apply_dance_deltas)."""
+    dances = [[] for _ in range(n_sides)]
+    for (side_index, dance_index), points in dance_points.items():
+        dances[side_index].append((dance_index, 0, list(points)))
+    return dances
+
+def parse_ui_key(ev):
+    """Translates a key press into a UI command: ("quit",), ("test_waggle", index or None) or None."""
+    if ev in (ord("Q"), ord("q")):
+        return ("quit",)
+    if ev in (ord("t"), ord("T")):
+        return ("test_waggle", None)
+    if ev is not None and ev >= ord("0") and ev <= ord("9"):
+        return ("test_waggle", ev - ord("0"))
+    return None
+
+
+class UIPublisher:
+    """Sends the latest snapshot of the bridge's state to all connected UI processes.
+
+    publish() only hands the snapshot over, so the caller never waits for a slow terminal or connection.
+    Snapshots that were not sent yet are merged into the next one, so no dance points are lost. New viewers
+    first get all points of the open dances. Commands sent by the UIs (e.g. test waggles) are passed to
+    command_fn from a background thread.
+    """
+
+    def __init__(self, port, authkey, command_fn, print_fn, handshake_timeout=5.0):
+        """handshake_timeout: Time in seconds a new viewer has to complete the authentication."""
+
+        self.authkey = authkey.encode()
+        self.listener = multiprocessing.connection.Listener(("localhost", port), authkey=self.authkey)
+        self.handshake_timeout = handshake_timeout
+        self.command_fn = command_fn
+        self.print_fn = print_fn
+
+        self.connections = []
+        # Connections that did not get the full state yet.
+        self.new_connections = []
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.snapshot = None
+        # All points of the open dances, as sent so far. Only used by the sending thread.
+        self.dance_points = dict()
+
+        self.running = True
+        self.sending_thread = threading.Thread(target=self.run_sender, args=())
+        self.sending_thread.daemon = True
+        self.sending_thread.start()
+        self.receiving_thread = threading.Thread(target=self.run_receiver, args=())
+        self.receiving_thread.daemon = True
+        self.receiving_thread.start()
+
+    def publish(self, snapshot):
+        with self.condition:
+            if self.snapshot is not None:
+                snapshot = merge_snapshots(self.snapshot, snapshot)
+            self.snapshot = snapshot
+            self.condition.notify()
+
+    def get_connections(self):
+        with self.lock:
+            return list(self.connections)
+
+    def remove_connection(self, con):
+        with self.lock:
+            if con in self.new_connections:
+                self.new_connections.remove(con)
+            elif con in self.connections:
+                self.connections.remove(con)
+            else:
+                return
+        try:
+            con.close()
+        except OSError:
+            pass
+        self.print_fn("UI: Viewer disconnected.")
+
+    def accept_connection(self):
+        # Like WDDListener.accept_connection: a viewer can stall the authentication, so it runs on a short-lived
+        # thread instead of blocking the commands of the other viewers.
+        try:
+            con = self.listener._listener.accept()
+        except Exception as e:
+            self.print_fn("UI: Error accepting viewer: {}", e)
+            return
+
+        thread = threading.Thread(target=self.authenticate_connection, args=(con,))
+        thread.daemon = True
+        thread.start()
+
+    def authenticate_connection(self, con):
+        try:
+            run_handshake(con, self.authkey, self.handshake_timeout)
+        except EOFError:
+            self.print_fn("UI: Viewer closed the connection or timed out during the authentication.")
+            con.close()
+            return
+        except Exception as e:
+            self.print_fn("UI: Error authenticating viewer: {}", e)
+            con.close()
+            return
+
+        with self.lock:
+            if not self.running:
+                con.close()
+                return
+            self.new_connections.append(con)
+        self.print_fn("UI: Viewer connected.")
+
+    def run_sender(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.snapshot is not None or not self.running)
+                if not self.running:
+                    return
+                snapshot, self.snapshot = self.snapshot, None
+
+            apply_dance_deltas(self.dance_points, snapshot["dances"])
+            with self.lock:
+                new_connections, self.new_connections = self.new_connections, []
+                self.connections.extend(new_connections)
+
+            full_data = None
+            if new_connections:
+                full_snapshot = dict(snapshot, dances=get_full_dances(self.dance_points, len(snapshot["dances"])))
+                full_data = pickle.dumps(full_snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+
+            # Serialize once for all viewers.
+            data = pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+            for con in self.get_connections():
+                try:
+                    con.send_bytes(full_data if con in new_connections else data)
+                except OSError:
+                    self.remove_connection(con)
+
+    def run_receiver(self):
+        listener_socket = self.listener._listener._socket
+
+        while self.running:
+            # Time out regularly to notice new connections (and stop).
+            ready = multiprocessing.connection.wait([listener_socket] + self.get_connections(), timeout=0.5)
+            for con in ready:
+                if con is listener_socket:
+                    self.accept_connection()
+                    continue
+
+                try:
+                    command = con.recv()
+                except (EOFError, OSError):
+                    self.remove_connection(con)
+                    continue
+                self.command_fn(command)
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.sending_thread.join()
+        self.receiving_thread.join()
+
+        with self.lock:
+            connections = self.connections + self.new_connections
+        for con in connections:
+            self.remove_connection(con)
+        self.listener.close()
+
+
+class UIViewer:
+    """Connects to a bridge's UIPublisher and renders the received snapshots at its own frame rate."""
+
+    def __init__(self, port, authkey, draw_arrows=False, frame_rate=10.0):
+        self.connection = multiprocessing.connection.Client(("localhost", port), authkey=authkey.encode())
+        self.terminal_ui = TerminalUI(draw_arrows=draw_arrows)
+        self.frame_rate = frame_rate
+        # Snapshot that was not rendered yet.
+        self.snapshot = None
+
+    def receive_latest_snapshot(self, timeout):
+        """Waits up to timeout seconds for new snapshots. Merges them, so only the latest one is rendered."""
+        while self.connection.poll(timeout):
+            snapshot = pickle.loads(self.connection.recv_bytes())
+            if self.snapshot is not None:
+                snapshot = merge_snapshots(self.snapshot, snapshot)
+            self.snapshot = snapshot
+            timeout = 0.0
+
+    def run(self):
+        try:
+            while True:
+                frame_start = time.monotonic()
+
+                command = parse_ui_key(self.terminal_ui.get_key())
+                if command == ("quit",):
+                    break
+                elif command is not None:
+                    self.connection.send(command)
+
+                if self.snapshot is not None:
+                    self.terminal_ui.render(self.snapshot)
+                    self.snapshot = None
+
+                self.receive_latest_snapshot(max(0.0, 1.0 / self.frame_rate - (time.monotonic() - frame_start)))
+        except EOFError:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        self.terminal_ui.close()
+        self.connection.close()
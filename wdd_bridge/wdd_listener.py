@@ -1,120 +1,465 @@
+import collections
 import datetime
+import heapq
 import multiprocessing.connection
+import os
 import pytz
 import queue
+import socket
 import threading
 import time
 
 from .dance_detector import Waggle
+from .wdd_protocol import (PROTOCOL_PICKLE, PROTOCOL_WAGGLE_FRAMES, FRAME_CLOSE, FRAME_WAGGLES, decode_frame,
+                           is_hello, make_cam_id_map, make_hello_reply, records_to_waggles)
+
+
+def message_to_waggle(message):
+    """Converts a message of the WDD to a Waggle.
+
+    Returns None for detections that are no waggles. Raises a ValueError for invalid messages.
+    """
+
+    def is_datetime_timezone_aware(dt):
+        return dt.tzinfo is not None and dt.tzinfo.utcoffset(dt) is not None
+
+    label = message.get("predicted_class_label", None)
+    if label and label != "waggle":
+        return None
+
+    if "timestamp_waggle" not in message:
+        raise ValueError("Message does not contain a waggle timestamp.")
+
+    angle = None
+    duration = None
+    cam_id = message["cam_id"]
+    if "waggle_angle" in message:
+        angle = message["waggle_angle"]
+        duration = message["waggle_duration"]
+    waggle_timestamp = message["timestamp_waggle"]
+
+    if not is_datetime_timezone_aware(waggle_timestamp):
+        waggle_timestamp = pytz.UTC.localize(waggle_timestamp)
+    else:
+        assert int(waggle_timestamp.utcoffset().total_seconds()) == 0
+
+    return Waggle(
+        message["x"], message["y"], angle, duration, waggle_timestamp, cam_id, uuid=message["waggle_id"]
+    )
+
+
+def run_handshake(con, authkey, timeout):
+    """Authenticates a connection accepted from Listener._listener, like Listener.accept does.
+
+    Raises an EOFError if the remote side closed the connection or did not complete the handshake
+    within timeout seconds.
+    """
+    # Shutting the socket down makes a stalled handshake fail.
+    handshake_socket = socket.socket(fileno=os.dup(con.fileno()))
+    timer = threading.Timer(timeout, handshake_socket.shutdown, args=(socket.SHUT_RDWR,))
+    timer.start()
+    try:
+        multiprocessing.connection.deliver_challenge(con, authkey)
+        multiprocessing.connection.answer_challenge(con, authkey)
+    finally:
+        timer.cancel()
+        handshake_socket.close()
+
+
+class IngestionBuffer:
+    """Bounded buffer of received waggles with a separate capacity for each camera.
+
+    Waggles are returned in the order they were put. When the buffer of a camera is full, the overflow policy
+    decides which waggle is discarded: "drop_oldest" drops the camera's oldest waggle, "coalesce" replaces a waiting
+    waggle from the same spatial cell (of coalesce_cell_size pixels) and only drops the oldest one if there is none.
+    None can be put to wake up a waiting consumer.
+    """
+
+    def __init__(self, max_size_per_camera=100, overflow_policy="drop_oldest", coalesce_cell_size=50.0):
+
+        if overflow_policy not in ("drop_oldest", "coalesce"):
+            raise ValueError("Unknown overflow policy '{}'.".format(overflow_policy))
+
+        self.max_size_per_camera = max_size_per_camera
+        self.overflow_policy = overflow_policy
+        self.coalesce_cell_size = coalesce_cell_size
+
+        # (sequence number, waggle) by camera.
+        self.buffers = dict()
+        self.sequence_number = 0
+        self.n_wakeups = 0
+        self.condition = threading.Condition()
+
+        self.n_received = 0
+        self.n_dropped = 0
+        self.n_coalesced = 0
+
+    def get_cell(self, waggle):
+        return (int(waggle.x // self.coalesce_cell_size), int(waggle.y // self.coalesce_cell_size))
+
+    def make_room(self, buffer, waggle):
+        if self.overflow_policy == "coalesce":
+            cell = self.get_cell(waggle)
+            for index, (_, queued_waggle) in enumerate(buffer):
+                if self.get_cell(queued_waggle) == cell:
+                    del buffer[index]
+                    self.n_coalesced += 1
+                    return
+
+        buffer.popleft()
+        self.n_dropped += 1
+
+    def put(self, waggle):
+        with self.condition:
+            if waggle is None:
+                self.n_wakeups += 1
+            else:
+                buffer = self.buffers.get(waggle.cam_id, None)
+                if buffer is None:
+                    buffer = collections.deque()
+                    self.buffers[waggle.cam_id] = buffer
+
+                self.n_received += 1
+                if len(buffer) >= self.max_size_per_camera:
+                    self.make_room(buffer, waggle)
+
+                buffer.append((self.sequence_number, waggle))
+                self.sequence_number += 1
+
+            self.condition.notify()
+
+    def get_nowait(self):
+        if self.n_wakeups > 0:
+            self.n_wakeups -= 1
+            return None
+
+        oldest_buffer = None
+        for buffer in self.buffers.values():
+            if buffer and (oldest_buffer is None or buffer[0][0] < oldest_buffer[0][0]):
+                oldest_buffer = buffer
+        if oldest_buffer is None:
+            raise queue.Empty()
+        return oldest_buffer.popleft()[1]
+
+    def get(self, block=True, timeout=None):
+        with self.condition:
+            if block:
+                self.condition.wait_for(lambda: self.n_wakeups > 0 or self.qsize() > 0, timeout=timeout)
+            return self.get_nowait()
+
+    def qsize(self):
+        return sum(len(buffer) for buffer in self.buffers.values())
+
+    def get_counters(self):
+        with self.condition:
+            return dict(
+                received_waggles=self.n_received,
+                dropped_waggles=self.n_dropped,
+                coalesced_waggles=self.n_coalesced,
+                buffered_waggles=self.qsize(),
+            )
+
+
+class ReorderBuffer:
+    """Holds received waggles for up to max_hold_time seconds to release them in the order of their timestamps.
+
+    Waggles of each camera are released as soon as no waggle of that camera that arrived at most max_hold_time
+    seconds ago can precede them anymore. Waggles arriving later than that are released right away and counted as late.
+    """
+
+    def __init__(self, max_hold_time=0.05):
+        self.max_hold_time = max_hold_time
+
+        # By camera: min-heap of (timestamp, sequence number, waggle) and the waggles in the order they arrived.
+        self.heaps = dict()
+        self.arrivals = dict()
+        # By camera: all waggles up to this timestamp can be released.
+        self.release_timestamps = dict()
+        self.last_released_timestamps = dict()
+        self.sequence_number = 0
+
+        self.n_late = 0
+
+    def add(self, waggle, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        cam_id = waggle.cam_id
+        if cam_id not in self.heaps:
+            self.heaps[cam_id] = []
+            self.arrivals[cam_id] = collections.deque()
+
+        heapq.heappush(self.heaps[cam_id], (waggle.timestamp, self.sequence_number, waggle))
+        self.arrivals[cam_id].append((now + self.max_hold_time, waggle.timestamp))
+        self.sequence_number += 1
+
+    def get_time_until_next_release(self, now=None):
+        """Returns the number of seconds until the next waggle is due, or None if there is none."""
+        if now is None:
+            now = time.monotonic()
+
+        release_time = None
+        for arrivals in self.arrivals.values():
+            if arrivals and (release_time is None or arrivals[0][0] < release_time):
+                release_time = arrivals[0][0]
+        if release_time is None:
+            return None
+        return max(0.0, release_time - now)
+
+    def pop_released(self, now=None):
+        """Returns the waggles that are due, ordered by timestamp for each camera."""
+        if now is None:
+            now = time.monotonic()
+
+        released = []
+        for cam_id, arrivals in self.arrivals.items():
+            release_timestamp = self.release_timestamps.get(cam_id, None)
+            while arrivals and arrivals[0][0] <= now:
+                _, timestamp = arrivals.popleft()
+                if release_timestamp is None or timestamp > release_timestamp:
+                    release_timestamp = timestamp
+            if release_timestamp is None:
+                continue
+            self.release_timestamps[cam_id] = release_timestamp
+
+            heap = self.heaps[cam_id]
+            last_released_timestamp = self.last_released_timestamps.get(cam_id, None)
+            while heap and heap[0][0] <= release_timestamp:
+                timestamp, _, waggle = heapq.heappop(heap)
+                if last_released_timestamp is not None and timestamp < last_released_timestamp:
+                    self.n_late += 1
+                else:
+                    last_released_timestamp = timestamp
+                waggle.stage_timestamps["released"] = time.monotonic()
+                released.append(waggle)
+            self.last_released_timestamps[cam_id] = last_released_timestamp
+
+        return released
+
+    def get_buffered_count(self):
+        return sum(len(heap) for heap in self.heaps.values())
 
 
 class WDDListener:
-    def __init__(self, port, authkey, print_fn, log_fn):
+    def __init__(self, port, authkey, print_fn, log_fn, capture_writer=None,
+                 max_buffered_waggles=100, overflow_policy="drop_oldest", handshake_timeout=5.0, cam_ids=()):
+        """max_buffered_waggles: Number of waggles per camera that can wait for processing (see IngestionBuffer).
+        handshake_timeout: Time in seconds a new connection has to complete the authentication.
+        cam_ids: The configured camera IDs. Binary frames only contain strings, which are mapped back to them.
+        """
 
+        self.authkey = authkey.encode()
         self.listener = multiprocessing.connection.Listener(
-            ("localhost", port), authkey=authkey.encode()
+            ("localhost", port), authkey=self.authkey
         )
+        self.handshake_timeout = handshake_timeout
+        self.cam_id_map = make_cam_id_map(cam_ids)
 
         self.print_fn = print_fn
         self.log_fn = log_fn
+        # Records every received message, e.g. to replay it later (see capture.CaptureWriter).
+        self.capture_writer = capture_writer
 
-        self.incoming_queue = queue.Queue()
-        self.connections = []  # Note that access to lists is generally thread-safe.
+        self.incoming_queue = IngestionBuffer(max_size_per_camera=max_buffered_waggles, overflow_policy=overflow_policy)
+        self.connections = []  # Only modified by the receiving thread.
+        # Protocol negotiated by each connection (see wdd_protocol). Connections without an entry send pickled dicts.
+        self.connection_protocols = dict()
 
-        self.running = True
+        # Authenticated connections (and their address) that the receiving thread has not taken over yet.
+        self.accepted_connections = queue.SimpleQueue()
+
+        # Allows close() and the authentication to wake up the receiving thread while it is blocked waiting for data.
+        self.wakeup_reader, self.wakeup_writer = multiprocessing.connection.Pipe(duplex=False)
+        self.wakeup_lock = threading.Lock()
 
-        self.listener_thread = threading.Thread(target=self.run_listener, args=())
-        self.listener_thread.daemon = True
-        self.listener_thread.start()
+        self.running = True
 
         self.receiving_thread = threading.Thread(target=self.run_receivers, args=())
         self.receiving_thread.daemon = True
         self.receiving_thread.start()
 
-    def run_listener(self):
+    def get_listener_socket(self):
+        # multiprocessing.connection.Listener does not expose its socket publicly,
+        # but we need it to wait for new connections and incoming data at the same time.
+        return self.listener._listener._socket
 
-        while self.running:
-            self.print_fn("WDD: Waiting for connection...")
+    def wake_up(self):
+        with self.wakeup_lock:
+            self.wakeup_writer.send(None)
+
+    def accept_connection(self):
+        # Only the socket is accepted here (like Listener.accept does before the handshake). A client can stall
+        # the authentication, so it runs on a short-lived thread that hands the connection to the receiving thread.
+        try:
+            con = self.listener._listener.accept()
+        except Exception as e:
+            self.print_fn("WDD: Error accepting new connection:")
+            self.print_fn("WDD: {}", e)
+            return
+
+        thread = threading.Thread(target=self.authenticate_connection, args=(con, self.listener.last_accepted))
+        thread.daemon = True
+        thread.start()
+
+    def authenticate_connection(self, con, address):
+        try:
+            run_handshake(con, self.authkey, self.handshake_timeout)
+        except EOFError:
+            self.print_fn("WDD: Connection from {} was closed or timed out during the authentication.", address)
+            con.close()
+            return
+        except Exception as e:
+            self.print_fn("WDD: Error authenticating connection from {}:", address)
+            self.print_fn("WDD: {}", e)
+            con.close()
+            return
+
+        self.accepted_connections.put((con, address))
+        self.wake_up()
+
+    def add_accepted_connections(self):
+        while True:
             try:
-                con = self.listener.accept()
-                self.print_fn(
-                    "WDD: Accepted connection {} from {}".format(
-                        len(self.connections), self.listener.last_accepted
-                    )
-                )
-                self.connections.append(con)
-            except Exception as e:
-                self.print_fn("WDD: Error accepting new connection:")
-                self.print_fn("WDD: " + str(e))
-                continue
+                con, address = self.accepted_connections.get_nowait()
+            except queue.Empty:
+                return
+            self.print_fn("WDD: Accepted connection {} from {}", len(self.connections), address)
+            self.connections.append(con)
+
+    def close_connection(self, con):
+        try:
+            con.close()
+        except OSError:
+            pass
+        self.connections.remove(con)
+        self.connection_protocols.pop(con, None)
+
+    def negotiate_protocol(self, con, hello, connection_index):
+        reply = make_hello_reply(hello)
+        try:
+            con.send(reply)
+        except OSError:
+            return
+        self.connection_protocols[con] = reply["protocol"]
+        self.print_fn("WDD: Connection {} uses protocol '{}'.", connection_index, reply["protocol"])
 
     def run_receivers(self):
 
-        def is_datetime_timezone_aware(dt):
-            return dt.tzinfo is not None and dt.tzinfo.utcoffset(dt) is not None
+        listener_socket = self.get_listener_socket()
+        self.print_fn("WDD: Waiting for connection...")
 
         while self.running:
-            has_active_connection = False
-            for i in range(len(self.connections)):
-                con = self.connections[i]
-                if not con.poll():
+            # Block until a new connection arrives, any connection has data or we are woken up by close().
+            ready = multiprocessing.connection.wait(
+                [listener_socket, self.wakeup_reader] + self.connections
+            )
+
+            if not self.running:
+                break
+
+            for con in ready:
+                if con is self.wakeup_reader:
+                    self.wakeup_reader.recv()
+                    self.add_accepted_connections()
+                    continue
+                if con is listener_socket:
+                    self.accept_connection()
+                    continue
+
+                i = self.connections.index(con)
+                is_binary = self.connection_protocols.get(con, PROTOCOL_PICKLE) == PROTOCOL_WAGGLE_FRAMES
+                try:
+                    if is_binary:
+                        message = con.recv_bytes()
+                    else:
+                        message = con.recv()
+                except (EOFError, OSError):
+                    self.print_fn("WDD: Connection {} was closed by the remote side.", i)
+                    self.close_connection(con)
+                    continue
+
+                if is_binary:
+                    self.handle_frame(message, i)
                     continue
 
-                has_active_connection = True
-                message = con.recv()
                 if message == "close":
-                    self.print_fn("WDD: Closing connection {} on request.".format(i))
-                    con.close()
-                    del self.connections[i]
-                    break
+                    self.print_fn("WDD: Closing connection {} on request.", i)
+                    self.close_connection(con)
+                    continue
 
-                label = message.get("predicted_class_label", None)
-                if label and label != "waggle":
+                if is_hello(message):
+                    self.negotiate_protocol(con, message, i)
                     continue
 
-                if "timestamp_waggle" in message:
-                    angle = None
-                    duration = None
-                    cam_id = message["cam_id"]
-                    if "waggle_angle" in message:
-                        angle = message["waggle_angle"]
-                        duration = message["waggle_duration"]
-                    waggle_timestamp = message["timestamp_waggle"]
-                    
-                    if not is_datetime_timezone_aware(waggle_timestamp):
-                        waggle_timestamp = pytz.UTC.localize(waggle_timestamp)
-                    else:
-                        assert int(waggle_timestamp.utcoffset().total_seconds()) == 0
-                        
-                    waggle = Waggle(
-                        message["x"], message["y"], angle, duration, waggle_timestamp, cam_id, uuid=message["waggle_id"]
-                    )
-                    self.print_fn(
-                        "WDD: received waggle detected {:4.3f}s ago (cam: '{}', con. {})".format(
-                            (
-                                datetime.datetime.utcnow()
-                                - message["system_timestamp_waggle"]
-                            ).total_seconds(),
-                            cam_id, i
-                        ),
-                        cam_id=cam_id, waggle_timestamp=waggle.timestamp, waggle_angle=angle, waggle_id=waggle.uuid
-                    )
-                    self.incoming_queue.put(waggle)
-                else:
-                    self.print_fn("WDD: received invalid message ({}).".format(str(message)))
-            
-            if not has_active_connection:
-                time.sleep(1.0)
+                if self.capture_writer is not None:
+                    self.capture_writer.write(message, i)
+
+                self.handle_message(message, i)
+
+    def handle_frame(self, data, connection_index):
+        try:
+            frame_type, records = decode_frame(data)
+        except ValueError as e:
+            self.print_fn("WDD: received invalid frame ({}).", e)
+            return
+
+        if frame_type == FRAME_CLOSE:
+            self.print_fn("WDD: Closing connection {} on request.", connection_index)
+            self.close_connection(self.connections[connection_index])
+            return
+        if frame_type != FRAME_WAGGLES:
+            self.print_fn("WDD: received frame of unknown type {}.", frame_type)
+            return
+
+        # Frames are captured as they are, so they can be replayed without converting them back.
+        if self.capture_writer is not None:
+            self.capture_writer.write(data, connection_index)
+
+        now = time.time()
+        detection_delays = (now - records["system_timestamp_ns"] * 1e-9).tolist()
+        for waggle, detection_delay in zip(records_to_waggles(records, self.cam_id_map), detection_delays):
+            waggle.detection_delay = detection_delay
+            self.accept_waggle(waggle, connection_index)
+
+    def handle_message(self, message, connection_index):
+
+        try:
+            waggle = message_to_waggle(message)
+        except ValueError:
+            self.print_fn("WDD: received invalid message ({}).", message)
+            return
+        if waggle is None:
+            return
+
+        waggle.detection_delay = (
+            datetime.datetime.utcnow()
+            - message["system_timestamp_waggle"]
+        ).total_seconds()
+        self.accept_waggle(waggle, connection_index)
+
+    def accept_waggle(self, waggle, connection_index):
+        waggle.stage_timestamps["received"] = time.monotonic()
+        self.print_fn(
+            "WDD: received waggle detected {:4.3f}s ago (cam: '{}', con. {})",
+            waggle.detection_delay, waggle.cam_id, connection_index,
+            cam_id=waggle.cam_id, waggle_timestamp=waggle.timestamp, waggle_angle=waggle.angle, waggle_id=waggle.uuid
+        )
+        self.incoming_queue.put(waggle)
 
     def close(self):
         self.running = False
+        self.wake_up()
+        self.receiving_thread.join()
+
+        for con in self.connections:
+            con.close()
+        self.connections = []
+
         l = self.listener
         self.listener = None
         if l is not None:
             l.close()
         self.incoming_queue.put(None)
-        # Don't join the listener thread here because it might be hanging on trying to get a connection.
-        self.receiving_thread.join()
 
     def get_message(self, block=True, timeout=None):
 
@@ -0,0 +1,156 @@
+"""Compact binary protocol for sending waggles from the WDD to the bridge.
+
+By default, the WDD sends every detection as a pickled dict. A client can instead negotiate binary frames
+right after connecting: it sends the pickled dict HELLO with the protocols it supports, and the bridge answers
+with the protocol to use. Bridges that do not know the binary protocol ignore the hello (it is no valid waggle),
+so connect() falls back to pickled dicts after a timeout.
+
+With PROTOCOL_WAGGLE_FRAMES, every message is a frame (sent with send_bytes) of a FRAME_HEADER followed by
+a number of fixed-size records of WAGGLE_RECORD_DTYPE. Only waggles are sent this way. Camera IDs are sent as
+strings, so the receiver maps them back to the configured IDs (see make_cam_id_map).
+"""
+import calendar
+import datetime
+import multiprocessing.connection
+import struct
+
+import numpy as np
+import pytz
+
+from .dance_detector import Waggle
+
+PROTOCOL_PICKLE = "pickle"
+PROTOCOL_WAGGLE_FRAMES = "waggle_frames_v1"
+SUPPORTED_PROTOCOLS = (PROTOCOL_WAGGLE_FRAMES, PROTOCOL_PICKLE)
+
+# Magic, frame type, number of records.
+FRAME_HEADER = struct.Struct("<4sII")
+FRAME_MAGIC = b"WDDF"
+FRAME_WAGGLES = 1
+# Replaces the pickled "close" message.
+FRAME_CLOSE = 2
+
+# Missing angles and durations are NaN. Timestamps are nanoseconds since the epoch (UTC).
+WAGGLE_RECORD_DTYPE = np.dtype([
+    ("cam_id", "S16"),
+    ("waggle_id", "S32"),
+    ("x", "<f8"),
+    ("y", "<f8"),
+    ("angle", "<f8"),
+    ("duration", "<f8"),
+    ("timestamp_ns", "<i8"),
+    ("system_timestamp_ns", "<i8"),
+])
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.UTC)
+
+
+def is_hello(message):
+    return isinstance(message, dict) and message.get("message_type", None) == "hello"
+
+def make_hello(protocols=SUPPORTED_PROTOCOLS):
+    return dict(message_type="hello", protocols=list(protocols))
+
+def make_hello_reply(hello):
+    """Returns the bridge's answer to a client's hello: the first of the client's protocols that is supported."""
+    protocol = PROTOCOL_PICKLE
+    for candidate in hello.get("protocols", []):
+        if candidate in SUPPORTED_PROTOCOLS:
+            protocol = candidate
+            break
+    return dict(message_type="hello", protocol=protocol)
+
+def datetime_to_ns(dt):
+    """Converts a datetime (naive ones are taken as UTC) to nanoseconds since the epoch."""
+    if dt.tzinfo is not None and dt.tzinfo.utcoffset(dt) is not None:
+        dt = dt.astimezone(pytz.UTC)
+    return calendar.timegm(dt.utctimetuple()) * 1000000000 + dt.microsecond * 1000
+
+def ns_to_datetime(ns):
+    return EPOCH + datetime.timedelta(microseconds=ns // 1000)
+
+def encode_waggle_frame(messages):
+    """Packs WDD messages (dicts as accepted by wdd_listener.message_to_waggle) into one frame.
+
+    Raises a ValueError if a camera or waggle ID does not fit into its field.
+    """
+    records = np.zeros(len(messages), dtype=WAGGLE_RECORD_DTYPE)
+    for record, message in zip(records, messages):
+        cam_id = str(message["cam_id"]).encode("utf-8")
+        waggle_id = str(message["waggle_id"]).encode("utf-8")
+        if len(cam_id) > WAGGLE_RECORD_DTYPE["cam_id"].itemsize or len(waggle_id) > WAGGLE_RECORD_DTYPE["waggle_id"].itemsize:
+            raise ValueError("Camera or waggle ID too long for a waggle record ({}, {}).".format(cam_id, waggle_id))
+
+        angle = message.get("waggle_angle", None)
+        duration = message.get("waggle_duration", None)
+        record["cam_id"] = cam_id
+        record["waggle_id"] = waggle_id
+        record["x"] = message["x"]
+        record["y"] = message["y"]
+        record["angle"] = np.nan if angle is None else angle
+        record["duration"] = np.nan if duration is None else duration
+        record["timestamp_ns"] = datetime_to_ns(message["timestamp_waggle"])
+        record["system_timestamp_ns"] = datetime_to_ns(message.get("system_timestamp_waggle", message["timestamp_waggle"]))
+
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_WAGGLES, len(messages)) + records.tobytes()
+
+def encode_close_frame():
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_CLOSE, 0)
+
+def decode_frame(data):
+    """Returns the frame type and the waggle records of a frame. The records are a view on data.
+
+    Raises a ValueError for invalid frames.
+    """
+    if len(data) < FRAME_HEADER.size:
+        raise ValueError("Frame too short ({} bytes).".format(len(data)))
+    magic, frame_type, n_records = FRAME_HEADER.unpack_from(data)
+    if magic != FRAME_MAGIC:
+        raise ValueError("Invalid frame magic {}.".format(magic))
+    if len(data) != FRAME_HEADER.size + n_records * WAGGLE_RECORD_DTYPE.itemsize:
+        raise ValueError("Frame length {} does not match its {} records.".format(len(data), n_records))
+
+    records = np.frombuffer(data, dtype=WAGGLE_RECORD_DTYPE, count=n_records, offset=FRAME_HEADER.size)
+    return frame_type, records
+
+def make_cam_id_map(cam_ids):
+    """Maps the camera IDs as they are decoded from a frame to the configured ones (e.g. "0" to 0)."""
+    return {str(cam_id): cam_id for cam_id in cam_ids}
+
+def records_to_waggles(records, cam_id_map=None):
+    """Converts waggle records to Waggles.
+
+    cam_id_map: Maps the decoded camera IDs to the configured ones (see make_cam_id_map). Unknown IDs are kept.
+    """
+    waggles = []
+    for (cam_id, waggle_id, x, y, angle, duration, timestamp_ns, _) in records.tolist():
+        cam_id = cam_id.decode("utf-8")
+        if cam_id_map is not None:
+            cam_id = cam_id_map.get(cam_id, cam_id)
+        waggles.append(Waggle(
+            x, y,
+            None if angle != angle else angle,
+            None if duration != duration else duration,
+            ns_to_datetime(timestamp_ns),
+            cam_id,
+            uuid=waggle_id.decode("utf-8"),
+        ))
+    return waggles
+
+def connect(address, authkey, protocols=SUPPORTED_PROTOCOLS, timeout=1.0):
+    """Opens a connection to a bridge and negotiates the protocol.
+
+    Returns the connection and the protocol the bridge chose. Falls back to PROTOCOL_PICKLE if the bridge
+    does not answer within timeout seconds.
+    """
+    con = multiprocessing.connection.Client(address, authkey=authkey)
+    if list(protocols) == [PROTOCOL_PICKLE]:
+        return con, PROTOCOL_PICKLE
+
+    con.send(make_hello(protocols))
+    if not con.poll(timeout):
+        return con, PROTOCOL_PICKLE
+    reply = con.recv()
+    if not is_hello(reply):
+        return con, PROTOCOL_PICKLE
+    return con, reply["protocol"]